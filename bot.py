@@ -11,18 +11,41 @@
 
 import os
 import sys
+import glob
 import json
+import hmac
+import hashlib
+import heapq
 import asyncio
 import aiohttp
 import logging
+import random
+import shutil
+import signal
+import socket
+import sqlite3
 import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Tuple
 from urllib.parse import urlparse
 
-from aiogram import Bot, Dispatcher, Router, F
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: блокировка файлов между процессами недоступна
+
+from aiohttp import web
+
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import (
-    Message, CallbackQuery, FSInputFile,
+    Message, CallbackQuery, FSInputFile, Chat, TelegramObject, Update,
     ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardRemove
@@ -30,8 +53,15 @@ from aiogram.types import (
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.methods import TelegramMethod, SendDocument, SendMediaGroup, GetUpdates
 
 # Импорт промптов для документов
 
@@ -763,6 +793,7 @@ class PresaleStates(StatesGroup):
     generating_docs = State()       # Этап 3: Генерация выбранных документов
     waiting_for_constraints = State()  # Ожидание ограничений
     processing = State()            # Обработка задачи Manus
+    choosing_cache = State()        # Выбор: готовые документы или новая генерация
 
 # Типы документов для выбора
 DOCUMENT_TYPES = {
@@ -850,6 +881,82 @@ QUICK_MODE_DEFAULT = os.getenv("QUICK_MODE", "0") == "1"
 POLLING_INTERVAL = int(os.getenv("POLLING_INTERVAL", "10"))
 TASK_TIMEOUT = int(os.getenv("TASK_TIMEOUT", "1500"))
 
+# Постоянное хранилище состояния (FSM, настройки, история, кэш, задачи в работе)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")  # sqlite | redis | memory
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.join("downloads", "jarvis.db"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+STATE_SAVE_INTERVAL = int(os.getenv("STATE_SAVE_INTERVAL", "5"))  # Как часто сохранять изменения, сек
+
+# Несколько реплик бота: общая очередь заданий через STATE_BACKEND (sqlite на одном хосте, redis — на нескольких)
+SHARED_STATE = os.getenv("SHARED_STATE", "0") == "1"
+REPLICA_ID = os.getenv("REPLICA_ID") or (f"{socket.gethostname()}-{os.getpid()}" if SHARED_STATE else socket.gethostname())
+LEASE_TTL = int(os.getenv("LEASE_TTL", "60"))  # Через сколько секунд без продления задачи реплики подхватывает другая
+LEASE_HEARTBEAT = int(os.getenv("LEASE_HEARTBEAT", "20"))  # Как часто продлевать аренду и искать брошенные задачи, сек
+QUEUE_POLL_INTERVAL = float(os.getenv("QUEUE_POLL_INTERVAL", "1"))  # Как часто свободный воркер проверяет общую очередь, сек
+
+# Журнал шагов заданий (только дозапись): после сбоя задания продолжаются с того же шага.
+# При SHARED_STATE у каждой реплики свой файл: journal-<REPLICA_ID>.jsonl рядом с JOURNAL_PATH
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "downloads/journal.jsonl")
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "500"))  # Сжимать журнал после стольких записей
+
+# Плавная остановка по SIGTERM: новые задания не принимаются, начатые создание задач и отправка файлов завершаются
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "25"))  # Сколько ждать их при остановке, сек
+
+# Защита от повторных нажатий и повторной доставки апдейтов
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "600"))  # Сколько помнить выполненное действие, сек
+UPDATE_DEDUP_TTL = int(os.getenv("UPDATE_DEDUP_TTL", "300"))  # Сколько помнить обработанные апдейты, сек
+
+# Модель длительности задач Manus (прогресс и оценка ожидания)
+MANUS_AGENT_PROFILE = os.getenv("MANUS_AGENT_PROFILE", "manus-1.6-max")
+ETA_DEFAULT_SECONDS = int(os.getenv("ETA_DEFAULT_SECONDS", "1200"))  # Оценка, пока нет статистики
+ETA_WINDOW = int(os.getenv("ETA_WINDOW", "50"))  # Сколько последних замеров хранить на тип задачи
+ETA_MIN_SAMPLES = int(os.getenv("ETA_MIN_SAMPLES", "5"))  # Замеров, после которых статистике можно верить
+
+# Пул HTTP-соединений к Manus API
+MANUS_POOL_SIZE = int(os.getenv("MANUS_POOL_SIZE", "20"))  # Всего соединений в пуле
+MANUS_POOL_PER_HOST = int(os.getenv("MANUS_POOL_PER_HOST", "10"))  # Соединений на один хост
+MANUS_DNS_TTL = int(os.getenv("MANUS_DNS_TTL", "300"))  # Кэш DNS в секундах
+MANUS_KEEPALIVE = int(os.getenv("MANUS_KEEPALIVE", "60"))  # Keep-alive простаивающих соединений
+
+# Повторы запросов к Manus API и автомат защиты (circuit breaker)
+MANUS_RETRY_ATTEMPTS = int(os.getenv("MANUS_RETRY_ATTEMPTS", "4"))  # Попыток на один запрос
+MANUS_RETRY_BASE_DELAY = float(os.getenv("MANUS_RETRY_BASE_DELAY", "1"))  # Начальная пауза, сек (растёт x2)
+MANUS_RETRY_MAX_DELAY = float(os.getenv("MANUS_RETRY_MAX_DELAY", "30"))  # Максимальная пауза, сек
+MANUS_BREAKER_THRESHOLD = int(os.getenv("MANUS_BREAKER_THRESHOLD", "5"))  # Сбоев подряд до размыкания
+MANUS_BREAKER_COOLDOWN = float(os.getenv("MANUS_BREAKER_COOLDOWN", "60"))  # Пауза до пробного запроса, сек
+MANUS_OUTAGE_GRACE = int(os.getenv("MANUS_OUTAGE_GRACE", "900"))  # Доп. ожидание задачи, если Manus недоступен
+
+# Бюджет запросов к Manus API (token bucket)
+MANUS_MAX_RPS = float(os.getenv("MANUS_MAX_RPS", "5"))  # Всего запросов в секунду
+MANUS_CREATE_PER_MINUTE = float(os.getenv("MANUS_CREATE_PER_MINUTE", "20"))  # Создание задач в минуту
+MANUS_CREATE_BURST = int(os.getenv("MANUS_CREATE_BURST", "8"))  # Сколько задач можно создать залпом
+MANUS_POLL_RPS = float(os.getenv("MANUS_POLL_RPS", "3"))  # Запросов статуса в секунду
+
+# Центральный опрос статусов задач Manus
+POLLER_FAST_INTERVAL = float(os.getenv("POLLER_FAST_INTERVAL", "5"))  # Интервал в первые минуты задачи
+POLLER_FAST_PERIOD = int(os.getenv("POLLER_FAST_PERIOD", "120"))  # Сколько секунд опрашивать часто
+POLLER_SLOW_AFTER = int(os.getenv("POLLER_SLOW_AFTER", "600"))  # После скольких секунд опрашивать реже
+POLLER_MAX_INTERVAL = float(os.getenv("POLLER_MAX_INTERVAL", "30"))  # Максимальный интервал опроса
+POLLER_BATCH_SIZE = int(os.getenv("POLLER_BATCH_SIZE", "10"))  # Запросов статуса за один проход
+POLLER_MAX_RPS = float(os.getenv("POLLER_MAX_RPS", "5"))  # Потолок запросов статуса в секунду
+
+# Встроенный HTTP-сервер
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", os.getenv("PORT", "8000")))
+READY_MAX_POLL_AGE = float(os.getenv("READY_MAX_POLL_AGE", "90"))  # Бот не готов, если getUpdates не отвечал дольше (сек)
+
+# Приём апдейтов Telegram: webhook на встроенном HTTP-сервере, если задан адрес, иначе long polling
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")  # Публичный адрес бота, например https://bot.example.com
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")  # Если не задан — выводится из токена бота
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Свой Bot API сервер или локальная заглушка Telegram
+
+# Push-уведомления Manus о завершении задач (если URL не задан — только polling)
+MANUS_WEBHOOK_URL = os.getenv("MANUS_WEBHOOK_URL", "")  # Публичный адрес бота, например https://bot.example.com
+MANUS_WEBHOOK_PATH = os.getenv("MANUS_WEBHOOK_PATH", "/manus/webhook")
+MANUS_WEBHOOK_SECRET = os.getenv("MANUS_WEBHOOK_SECRET", "")
+MANUS_WEBHOOK_FALLBACK_INTERVAL = float(os.getenv("MANUS_WEBHOOK_FALLBACK_INTERVAL", "60"))  # Страховочный опрос в push-режиме
+
 VERSION = "3.0"
 START_TIME = datetime.now()
 
@@ -881,27 +988,627 @@ stats = {
     "files_sent": 0
 }
 
-# Кэш результатов по URL (домен -> данные задачи)
+# Кэш результатов (ключ запроса -> данные задачи)
 url_cache: Dict[str, Dict] = {}
 CACHE_TTL_HOURS = int(os.getenv("CACHE_TTL_HOURS", "24"))  # Время жизни кэша в часах
 
+# Задачи Manus в работе по ключу запроса: одинаковые запросы ждут одну задачу
+running_requests: Dict[str, asyncio.Future] = {}  # ключ запроса -> future с task_id
+
 # Очередь задач для параллельной обработки
-task_queue: asyncio.Queue = None  # Инициализируется при запуске
-active_tasks: Dict[str, Dict] = {}  # task_id -> информация о задаче
+queue_changed = asyncio.Event()  # Новое задание в очереди или освободился слот пользователя
+active_tasks: Dict[str, Dict] = {}  # job_id -> информация о выполняемом задании
+pending_jobs: List[Dict] = []  # Задания в очереди (порядок запуска — у fair_scheduler)
 MAX_CONCURRENT_TASKS = int(os.getenv("MAX_CONCURRENT_TASKS", "3"))  # Макс параллельных задач
 
+# Справедливая очередь: досье и отдельные документы раньше пакетов, пользователи — по весам из ALLOWED_USER_IDS
+USER_MAX_ACTIVE_JOBS = int(os.getenv("USER_MAX_ACTIVE_JOBS", "2"))  # Заданий одного пользователя в работе одновременно
+USER_DAILY_QUOTA = int(os.getenv("USER_DAILY_QUOTA", "0"))  # Заданий на пользователя в сутки с учётом веса, 0 — без лимита
+PRIORITY_MAX_DOCS = int(os.getenv("PRIORITY_MAX_DOCS", "1"))  # Пакет до стольких документов идёт в приоритетной полосе
+QUEUE_AGING_SECONDS = int(os.getenv("QUEUE_AGING_SECONDS", "900"))  # После такого ожидания пакет тоже становится приоритетным
+user_quota: Dict[int, Dict] = {}  # user_id -> {"date": "YYYY-MM-DD", "jobs": поставлено за день}
+
+# Параллельная генерация документов Этапа 3
+MAX_PARALLEL_DOCS = int(os.getenv("MAX_PARALLEL_DOCS", "10"))  # Всего документов одновременно
+MAX_PARALLEL_DOCS_PER_USER = int(os.getenv("MAX_PARALLEL_DOCS_PER_USER", "4"))  # На одного пользователя
+doc_semaphore = asyncio.Semaphore(MAX_PARALLEL_DOCS)
+user_doc_semaphores: Dict[int, asyncio.Semaphore] = {}
+
+# Длительности задач Manus для оценки времени ("тип|профиль|загрузка" -> последние замеры, сек)
+task_durations: Dict[str, List[float]] = {}
+
 # Хранилище завершённых задач с документами (user_id -> [{task_id, domain, files, date}])
 completed_tasks: Dict[int, List[Dict]] = {}
 
+# Хранилище сгенерированных документов на диске (том downloads/)
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", os.path.join("downloads", "artifacts"))
+ARTIFACTS_MAX_MB = int(os.getenv("ARTIFACTS_MAX_MB", "2048"))  # Квота на размер хранилища
+ARTIFACTS_MAX_AGE_DAYS = int(os.getenv("ARTIFACTS_MAX_AGE_DAYS", "30"))  # Сколько хранить файл без обращений
+
+# Доставка файлов: потоковая загрузка и лимиты отправки в Telegram
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))  # Одновременных скачиваний
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))  # Размер чанка, байт
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # Сообщений в секунду в один чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))  # Сообщений в секунду всего
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))  # Сообщений в секунду в групповой чат
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))  # Повторов после flood control (429)
+download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "3"))  # Не чаще одной правки прогресса за N сек
+
+# Лимиты скорости: с нулевым или отрицательным лимитом token bucket не выдаст ни одного токена
+for _rate_name in ("MANUS_MAX_RPS", "MANUS_CREATE_PER_MINUTE", "MANUS_POLL_RPS", "POLLER_MAX_RPS",
+                   "TELEGRAM_CHAT_RATE", "TELEGRAM_GLOBAL_RATE", "TELEGRAM_GROUP_RATE"):
+    if globals()[_rate_name] <= 0:
+        print(f"❌ ERROR: {_rate_name} must be positive")
+        raise ValueError(f"{_rate_name} must be a positive number, got {globals()[_rate_name]}")
+
+# ═══════════════════════════════════════════════════════════════
+# ПОСТОЯННОЕ ХРАНИЛИЩЕ СОСТОЯНИЯ
+# ═══════════════════════════════════════════════════════════════
+
+@contextmanager
+def file_lock(path: str):
+    """Блокировка файла между процессами (flock на path.lock); блокирующая — держать недолго"""
+    if fcntl is None:
+        yield
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class MemoryBackend:
+    """Хранилище ключ-значение в памяти процесса (теряется при перезапуске)"""
+
+    def __init__(self):
+        self.data: Dict[str, str] = {}
+
+    async def get(self, key: str) -> Optional[Any]:
+        raw = self.data.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: Any):
+        self.data[key] = json.dumps(value, ensure_ascii=False)
+
+    async def delete(self, key: str):
+        self.data.pop(key, None)
+
+    async def items(self, prefix: str) -> Dict[str, Any]:
+        return {k: json.loads(v) for k, v in self.data.items() if k.startswith(prefix)}
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        """Берёт или продлевает аренду ключа, если она свободна, истекла или уже наша"""
+        lease = await self.get(key)
+        if lease and lease["owner"] != owner and lease["expires"] > time.time():
+            return False
+        await self.set(key, {"owner": owner, "expires": time.time() + ttl})
+        return True
+
+    async def release(self, key: str, owner: str):
+        lease = await self.get(key)
+        if lease and lease["owner"] == owner:
+            await self.delete(key)
+
+    async def take(self, key: str) -> Optional[Any]:
+        """Атомарно забирает значение: из нескольких конкурентов его получит один"""
+        raw = self.data.pop(key, None)
+        return json.loads(raw) if raw is not None else None
+
+    async def close(self):
+        pass
+
+class SQLiteBackend:
+    """Хранилище ключ-значение в SQLite (по умолчанию — файл на томе downloads/)"""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # timeout — ожидание блокировки, когда файл делят несколько процессов
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    async def _run(self, sql: str, params: tuple = ()) -> List[tuple]:
+        def run():
+            with self._lock:
+                return self.conn.execute(sql, params).fetchall()
+        return await asyncio.to_thread(run)
+
+    async def get(self, key: str) -> Optional[Any]:
+        rows = await self._run("SELECT value FROM kv WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def set(self, key: str, value: Any):
+        await self._run(
+            "INSERT OR REPLACE INTO kv (key, value, updated_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), time.time())
+        )
+
+    async def delete(self, key: str):
+        await self._run("DELETE FROM kv WHERE key = ?", (key,))
+
+    async def items(self, prefix: str) -> Dict[str, Any]:
+        rows = await self._run("SELECT key, value FROM kv WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff"))
+        return {key: json.loads(value) for key, value in rows}
+
+    async def _transaction(self, body: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Чтение и запись под блокировкой файла — атомарно и для других процессов"""
+        def run():
+            with self._lock:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    result = body(self.conn)
+                except BaseException:
+                    self.conn.execute("ROLLBACK")
+                    raise
+                self.conn.execute("COMMIT")
+                return result
+        return await asyncio.to_thread(run)
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        def body(conn: sqlite3.Connection) -> bool:
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row:
+                lease = json.loads(row[0])
+                if lease["owner"] != owner and lease["expires"] > now:
+                    return False
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps({"owner": owner, "expires": now + ttl}), now)
+            )
+            return True
+        return await self._transaction(body)
+
+    async def release(self, key: str, owner: str):
+        def body(conn: sqlite3.Connection):
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            if row and json.loads(row[0])["owner"] == owner:
+                conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+        await self._transaction(body)
+
+    async def take(self, key: str) -> Optional[Any]:
+        def body(conn: sqlite3.Connection) -> Optional[str]:
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+            return row[0] if row else None
+        raw = await self._transaction(body)
+        return json.loads(raw) if raw is not None else None
+
+    async def close(self):
+        with self._lock:
+            self.conn.close()
+
+class RedisBackend:
+    """Хранилище ключ-значение в Redis или совместимом сервере (нужен пакет redis)"""
+
+    def __init__(self, url: str, prefix: str = "jarvis:"):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis requires the redis package: pip install redis")
+        self.redis = redis_asyncio.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[Any]:
+        raw = await self.redis.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: Any):
+        await self.redis.set(self.prefix + key, json.dumps(value, ensure_ascii=False))
+
+    async def delete(self, key: str):
+        await self.redis.delete(self.prefix + key)
+
+    async def items(self, prefix: str) -> Dict[str, Any]:
+        result = {}
+        async for full_key in self.redis.scan_iter(match=f"{self.prefix}{prefix}*"):
+            raw = await self.redis.get(full_key)
+            if raw is not None:
+                result[full_key[len(self.prefix):]] = json.loads(raw)
+        return result
+
+    # Аренда и выемка — Lua-скриптами, чтобы проверка и запись были одной операцией
+    CLAIM_SCRIPT = """
+    local current = redis.call('GET', KEYS[1])
+    if current and cjson.decode(current)['owner'] ~= ARGV[1] then return 0 end
+    redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3])
+    return 1
+    """
+    RELEASE_SCRIPT = """
+    local current = redis.call('GET', KEYS[1])
+    if current and cjson.decode(current)['owner'] == ARGV[1] then redis.call('DEL', KEYS[1]) end
+    return 0
+    """
+    TAKE_SCRIPT = """
+    local current = redis.call('GET', KEYS[1])
+    if current then redis.call('DEL', KEYS[1]) end
+    return current
+    """
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        lease = json.dumps({"owner": owner, "expires": time.time() + ttl})
+        return bool(await self.redis.eval(self.CLAIM_SCRIPT, 1, self.prefix + key, owner, lease, int(ttl * 1000)))
+
+    async def release(self, key: str, owner: str):
+        await self.redis.eval(self.RELEASE_SCRIPT, 1, self.prefix + key, owner)
+
+    async def take(self, key: str) -> Optional[Any]:
+        raw = await self.redis.eval(self.TAKE_SCRIPT, 1, self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    async def close(self):
+        await self.redis.aclose()
+
+def create_state_backend():
+    if STATE_BACKEND == "memory":
+        return MemoryBackend()
+    if STATE_BACKEND == "redis":
+        return RedisBackend(REDIS_URL)
+    return SQLiteBackend(STATE_DB_PATH)
+
+class PersistentStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх state_backend — состояние диалогов переживает перезапуск"""
+
+    def __init__(self, backend=None):
+        self._backend = backend
+
+    @property
+    def backend(self):
+        # Без явного бэкенда — общий state_backend, который создаёт main()
+        return self._backend or state_backend
+
+    @staticmethod
+    def _key(key: StorageKey, part: str) -> str:
+        return f"fsm:{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:{key.destiny}:{part}"
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        if value is None:
+            await self.backend.delete(self._key(key, "state"))
+        else:
+            await self.backend.set(self._key(key, "state"), value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self.backend.get(self._key(key, "state"))
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if not data:
+            await self.backend.delete(self._key(key, "data"))
+        else:
+            await self.backend.set(self._key(key, "data"), data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(await self.backend.get(self._key(key, "data")) or {})
+
+    async def close(self) -> None:
+        # Бэкенд общий с остальным состоянием и закрывается в main()
+        pass
+
+# Создаётся в main(): импорт модуля (тесты, утилиты) не должен открывать базу на диске
+state_backend = None
+
+# Словари, которые сохраняются между перезапусками (имя -> объект)
+PERSISTED_STATE = {
+    "user_tasks": user_tasks,
+    "user_settings": user_settings,
+    "stats": stats,
+    "url_cache": url_cache,
+    "completed_tasks": completed_tasks,
+    "task_durations": task_durations,
+    "user_quota": user_quota
+}
+# Словари с user_id в ключах (JSON хранит ключи строками)
+USER_KEYED_STATE = {"user_tasks", "user_settings", "completed_tasks", "user_quota"}
+_saved_state: Dict[str, str] = {}
+
+async def load_state():
+    """Восстанавливает настройки, историю, статистику и кэш после перезапуска"""
+    for name, target in PERSISTED_STATE.items():
+        value = await state_backend.get(f"state:{name}")
+        if not isinstance(value, dict):
+            continue
+        if name in USER_KEYED_STATE:
+            value = {int(k): v for k, v in value.items()}
+        target.clear()
+        target.update(value)
+        _saved_state[name] = json.dumps(target, ensure_ascii=False, sort_keys=True, default=str)
+    logger.info(f"State loaded from {STATE_BACKEND} backend")
+
+async def save_state():
+    """Сохраняет изменившиеся словари состояния"""
+    for name, target in PERSISTED_STATE.items():
+        raw = json.dumps(target, ensure_ascii=False, sort_keys=True, default=str)
+        if SHARED_STATE:
+            await sync_shared_state(name, target, raw)
+        elif _saved_state.get(name) != raw:
+            await state_backend.set(f"state:{name}", json.loads(raw))
+            _saved_state[name] = raw
+
+async def sync_shared_state(name: str, target: Dict, raw: str):
+    """Слияние с записями других реплик: поверх сохранённого словаря ложатся только ключи,
+    изменённые этой репликой, а чужие изменения попадают в память"""
+    stored = await state_backend.get(f"state:{name}") or {}
+    previous = json.loads(_saved_state.get(name, "{}"))
+    current = json.loads(raw)
+    merged = dict(stored)
+    for key in set(previous) | set(current):
+        if key not in current:
+            merged.pop(key, None)
+        elif previous.get(key) != current[key]:
+            merged[key] = current[key]
+    merged_raw = json.dumps(merged, ensure_ascii=False, sort_keys=True, default=str)
+    if merged != stored:
+        await state_backend.set(f"state:{name}", merged)
+    # Записи, которые здесь не менялись, заменяем чужими; свои объекты оставляем —
+    # на них ссылаются выполняющиеся конвейеры
+    convert = int if name in USER_KEYED_STATE else str
+    for key in set(current) - set(merged):
+        target.pop(convert(key), None)
+    for key, value in merged.items():
+        if current.get(key) != value:
+            target[convert(key)] = value
+    _saved_state[name] = merged_raw
+
+async def state_autosave():
+    while True:
+        await asyncio.sleep(STATE_SAVE_INTERVAL)
+        try:
+            await save_state()
+            await artifact_store.flush()
+        except Exception as e:
+            logger.error(f"Error saving state: {e}")
+
+async def remember_inflight(task_id: str, record: Dict):
+    """Запоминает задачу Manus в работе, чтобы подхватить её после перезапуска.
+    Одну задачу могут ждать несколько чатов — запись у каждого своя."""
+    await state_backend.set(f"inflight:{task_id}:{record['chat_id']}", {**record, "task_id": task_id})
+
+async def remember_completed(task_id: str, chat_id: int, artifacts: List[Dict]):
+    """Результат задачи сохраняется до выдачи: после сбоя его отправят, не опрашивая Manus и не создавая задачу заново"""
+    key = f"inflight:{task_id}:{chat_id}"
+    record = await state_backend.get(key)
+    if record is not None:
+        await state_backend.set(key, {**record, "artifacts": artifacts})
+
+async def forget_inflight(task_id: str, chat_id: int):
+    await state_backend.delete(f"inflight:{task_id}:{chat_id}")
+
+async def forget_package(package_id: str):
+    """Удаляет записи всех документов пакета Этапа 3"""
+    records = await state_backend.items("inflight:")
+    for key, record in records.items():
+        if record.get("package_id") == package_id:
+            await state_backend.delete(key)
+
+# Аренды этой реплики: конвейер (досье или пакет документов) -> задача, которая его ведёт
+owned_leases: Dict[str, Optional[asyncio.Task]] = {}
+
+def inflight_unit(record: Dict) -> str:
+    """Конвейер, к которому относится задача в работе: аренда и подхват — по конвейерам"""
+    if record.get("kind") == "document":
+        return f"package:{record['package_id']}"
+    return f"presale:{record['task_id']}:{record['chat_id']}"
+
+async def forget_pipeline(job_id: Optional[str] = None, unit: Optional[str] = None):
+    """Удаляет записи конвейера, упавшего с ошибкой: иначе после освобождения аренды его подхватывали бы снова и снова"""
+    for key, record in (await state_backend.items("inflight:")).items():
+        record = {**record, "task_id": record.get("task_id") or key[len("inflight:"):]}
+        if (job_id and record.get("job_id") == job_id) or (unit and inflight_unit(record) == unit):
+            await state_backend.delete(key)
+
+async def acquire_lease(unit: str, task: Optional[asyncio.Task] = None) -> bool:
+    """Закрепляет конвейер за репликой; False — его ведёт другая живая реплика.
+    Без SHARED_STATE процесс один и аренды в хранилище не пишутся: иначе после перезапуска
+    под другим именем хоста (REPLICA_ID) он ждал бы истечения собственных старых аренд"""
+    if SHARED_STATE and not await state_backend.claim(f"lease:{unit}", REPLICA_ID, LEASE_TTL):
+        return False
+    owned_leases[unit] = task or asyncio.current_task()
+    return True
+
+async def release_lease(unit: str):
+    owned_leases.pop(unit, None)
+    if SHARED_STATE:
+        await state_backend.release(f"lease:{unit}", REPLICA_ID)
+
+# ═══════════════════════════════════════════════════════════════
+# ЖУРНАЛ ЗАДАНИЙ
+# ═══════════════════════════════════════════════════════════════
+
+# Задание, в рамках которого выполняется текущий конвейер (наследуется дочерними задачами asyncio)
+current_job_id: ContextVar[Optional[str]] = ContextVar("current_job_id", default=None)
+
+class JobJournal:
+    """Журнал шагов заданий: queued → started → task_created → task_completed → delivered → finished.
+    Каждая запись дописывается в конец файла с fsync; завершённые задания удаляются при сжатии."""
+
+    FINAL_EVENTS = ("finished", "cancelled")
+
+    def __init__(self, path: str, compact_every: int):
+        self.path = path
+        self.compact_every = compact_every
+        self.appended = 0
+        self._lock = asyncio.Lock()
+
+    def _write(self, entries: List[Dict], path: str, mode: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode, encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _append(self, entry: Dict):
+        with file_lock(self.path):
+            self._write([entry], self.path, "a")
+
+    def _read(self) -> Dict[str, List[Dict]]:
+        jobs: Dict[str, List[Dict]] = {}
+        if not os.path.exists(self.path):
+            return jobs
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Запись, оборванная сбоем на середине
+                    continue
+                jobs.setdefault(entry["job_id"], []).append(entry)
+        return jobs
+
+    async def append(self, job_id: Optional[str], event: str, **fields):
+        if not job_id:
+            return
+        entry = {"ts": time.time(), "job_id": job_id, "event": event, **fields}
+        async with self._lock:
+            await asyncio.to_thread(self._append, entry)
+            self.appended += 1
+            if self.appended >= self.compact_every:
+                await self._compact()
+
+    def _pending(self) -> Dict[str, List[Dict]]:
+        return {job_id: entries for job_id, entries in self._read().items()
+                if not any(entry["event"] in self.FINAL_EVENTS for entry in entries)}
+
+    async def pending(self) -> Dict[str, List[Dict]]:
+        """Задания, не дошедшие до конца"""
+        return await asyncio.to_thread(self._pending)
+
+    async def compact(self):
+        async with self._lock:
+            await self._compact()
+
+    def _rewrite(self) -> int:
+        # Чтение и подмена — под одной блокировкой: дозапись другого процесса не потеряется
+        with file_lock(self.path):
+            pending = self._pending()
+            tmp_path = self.path + ".tmp"
+            self._write([entry for entries in pending.values() for entry in entries], tmp_path, "w")
+            os.replace(tmp_path, self.path)
+        return len(pending)
+
+    async def _compact(self):
+        """Переписывает журнал без завершённых заданий; файл подменяется атомарно"""
+        unfinished = await asyncio.to_thread(self._rewrite)
+        self.appended = 0
+        logger.info(f"Journal compacted: {unfinished} unfinished jobs")
+
+    def _remove(self):
+        with file_lock(self.path):
+            for path in (self.path, self.path + ".lock"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    async def remove(self):
+        """Удаляет журнал, задания которого разобраны (журнал упавшей реплики)"""
+        async with self._lock:
+            await asyncio.to_thread(self._remove)
+
+def replica_journal_path(replica_id: str) -> str:
+    """При SHARED_STATE у каждой реплики свой журнал: общий файл разбирали бы сразу несколько процессов"""
+    if not SHARED_STATE:
+        return JOURNAL_PATH
+    root, ext = os.path.splitext(JOURNAL_PATH)
+    return f"{root}-{replica_id}{ext}"
+
+journal = JobJournal(replica_journal_path(REPLICA_ID), JOURNAL_COMPACT_EVERY)
+
+async def journal_step(event: str, **fields):
+    """Шаг конвейера текущего задания"""
+    await journal.append(current_job_id.get(), event, **fields)
+
+# ═══════════════════════════════════════════════════════════════
+# ЗАЩИТА ОТ ПОВТОРОВ
+# ═══════════════════════════════════════════════════════════════
+
+class RecentKeys:
+    """Короткоживущий набор ключей: claim() срабатывает для ключа один раз за ttl секунд"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.expires: Dict[str, float] = {}  # Порядок вставки = порядок истечения
+
+    def _prune(self, now: float):
+        for key in list(self.expires):
+            if self.expires[key] > now:
+                break
+            del self.expires[key]
+
+    def claim(self, key: str) -> bool:
+        """True — ключ новый и теперь занят; False — повтор"""
+        now = time.monotonic()
+        self._prune(now)
+        if key in self.expires:
+            return False
+        self.expires[key] = now + self.ttl
+        return True
+
+    def release(self, key: str):
+        self.expires.pop(key, None)
+
+class UpdateDedupMiddleware(BaseMiddleware):
+    """Отбрасывает апдейты и callback-запросы, которые Telegram доставил повторно"""
+
+    def __init__(self, ttl: float):
+        self.seen = RecentKeys(ttl)
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: Update, data: Dict[str, Any]) -> Any:
+        keys = [f"update:{event.update_id}"]
+        if event.callback_query:
+            keys.append(f"callback:{event.callback_query.id}")
+        if not all([self.seen.claim(key) for key in keys]):
+            logger.info(f"Dropped duplicate update {event.update_id}")
+            return None
+        return await handler(event, data)
+
+class IdempotencyMiddleware(BaseMiddleware):
+    """Действие с флагом idempotent выполняется один раз на пользователя и сообщение с кнопками.
+    Повторное нажатие (пока состояние ещё не сменилось) только подтверждается."""
+
+    def __init__(self, ttl: float):
+        self.actions = RecentKeys(ttl)
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: CallbackQuery, data: Dict[str, Any]) -> Any:
+        action = get_flag(data, "idempotent")
+        if not action or event.message is None:
+            return await handler(event, data)
+        key = f"{event.from_user.id}:{action}:{event.message.chat.id}:{event.message.message_id}"
+        if not self.actions.claim(key):
+            logger.info(f"Ignored repeated {action} from user {event.from_user.id}")
+            await event.answer("⏳ Уже выполняется")
+            return None
+        try:
+            return await handler(event, data)
+        except Exception:
+            # Действие не выполнено — повторное нажатие должно сработать
+            self.actions.release(key)
+            raise
+
 # ═══════════════════════════════════════════════════════════════
 # ИНИЦИАЛИЗАЦИЯ БОТА
 # ═══════════════════════════════════════════════════════════════
 
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
-storage = MemoryStorage()
+bot = Bot(
+    token=TELEGRAM_BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+storage = MemoryStorage() if STATE_BACKEND == "memory" else PersistentStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
+dp.update.outer_middleware(UpdateDedupMiddleware(UPDATE_DEDUP_TTL))
+router.callback_query.middleware(IdempotencyMiddleware(IDEMPOTENCY_TTL))
 
 # ═══════════════════════════════════════════════════════════════
 # КЛАВИАТУРЫ
@@ -989,11 +1696,11 @@ def get_tasks_keyboard(user_id: int) -> InlineKeyboardMarkup:
     buttons.append([InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_menu")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_cache_keyboard(domain: str) -> InlineKeyboardMarkup:
+def get_cache_keyboard(cache_key: str) -> InlineKeyboardMarkup:
     """Клавиатура для выбора: использовать кэш или перегенерировать"""
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="⚡ Использовать готовые документы", callback_data=f"use_cache_{domain}")],
+            [InlineKeyboardButton(text="⚡ Использовать готовые документы", callback_data=f"use_cache_{cache_key}")],
             [InlineKeyboardButton(text="🔄 Сгенерировать заново", callback_data="regenerate")],
             [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")]
         ]
@@ -1062,11 +1769,39 @@ def add_user_task(user_id: int, task: Dict):
     tasks.insert(0, task)
     user_tasks[user_id] = tasks[:10]
 
+def parse_allowed_users(value: str) -> Dict[int, float]:
+    """ALLOWED_USER_IDS: id через запятую, у id может быть вес в очереди — «id:вес» (по умолчанию 1)"""
+    allowed = {}
+    for item in value.split(","):
+        user_id, _, weight = item.partition(":")
+        if not user_id.strip():
+            continue
+        try:
+            user_id = int(user_id.strip())
+        except ValueError:
+            logger.warning(f"ALLOWED_USER_IDS: skipping invalid user id {item.strip()!r}")
+            continue
+        try:
+            allowed[user_id] = float(weight) if weight.strip() else 1.0
+        except ValueError:
+            allowed[user_id] = 0.0
+        if not allowed[user_id] > 0:
+            # Нулевой или отрицательный вес обнулил бы долю в очереди — оставляем доступ с весом 1
+            logger.warning(f"ALLOWED_USER_IDS: invalid weight {weight.strip()!r} for user {user_id}, using 1")
+            allowed[user_id] = 1.0
+    return allowed
+
+ALLOWED_USERS = parse_allowed_users(ALLOWED_USER_IDS)
+
 def is_user_allowed(user_id: int) -> bool:
-    if not ALLOWED_USER_IDS:
+    if not ALLOWED_USER_IDS.replace(",", "").strip():
         return True
-    allowed = [int(x.strip()) for x in ALLOWED_USER_IDS.split(",") if x.strip()]
-    return user_id in allowed if allowed else True
+    # Список задан, но ни один id не разобрался — доступ закрыт, а не открыт всем
+    return user_id in ALLOWED_USERS
+
+def user_weight(user_id: int) -> float:
+    """Вес пользователя: доля слотов в очереди и множитель дневной квоты"""
+    return ALLOWED_USERS.get(user_id, 1.0)
 
 def validate_url(url: str) -> bool:
     try:
@@ -1086,30 +1821,96 @@ def get_progress_bar(percent: int, length: int = 10) -> str:
     return "█" * filled + "░" * (length - filled)
 
 # Функции кэширования
-def get_cached_result(domain: str) -> Optional[Dict]:
-    """Получить закэшированный результат по домену"""
-    if domain in url_cache:
-        cached = url_cache[domain]
+def normalize_domain(domain: str) -> str:
+    """Приводит домен к единому виду: без регистра, www и порта"""
+    domain = (domain or "").strip().lower().rstrip(".")
+    domain = domain.split(":")[0]
+    if domain.startswith("www."):
+        domain = domain[4:]
+    return domain
+
+def normalize_constraints(constraints: str) -> str:
+    text = " ".join((constraints or "").lower().split())
+    return "" if text in ("-", "—", "нет") else text
+
+def get_cache_key(domain: str, goal: str, constraints: str, docs: List[str]) -> str:
+    """Ключ кэша: домен + цель + ограничения + набор документов"""
+    raw = json.dumps([
+        normalize_domain(domain),
+        (goal or "").strip().lower(),
+        normalize_constraints(constraints),
+        sorted(set(docs))
+    ], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+def get_cached_result(cache_key: str) -> Optional[Dict]:
+    """Получить закэшированный результат по ключу запроса"""
+    if cache_key in url_cache:
+        cached = url_cache[cache_key]
         cache_time = datetime.fromisoformat(cached.get("cached_at", "2000-01-01"))
         if datetime.now() - cache_time < timedelta(hours=CACHE_TTL_HOURS):
-            logger.info(f"Cache hit for {domain}")
+            logger.info(f"Cache hit for {cached.get('domain')} ({cache_key})")
             return cached
         else:
             # Кэш устарел
-            del url_cache[domain]
-            logger.info(f"Cache expired for {domain}")
+            del url_cache[cache_key]
+            logger.info(f"Cache expired for {cached.get('domain')} ({cache_key})")
     return None
 
-def set_cached_result(domain: str, task_id: str, files: List[Dict]):
+def set_cached_result(cache_key: str, task_ids: List[str], files: List[Dict], domain: str = ""):
     """Сохранить результат в кэш"""
-    url_cache[domain] = {
-        "task_id": task_id,
+    if not files:
+        return
+    url_cache[cache_key] = {
+        "domain": domain,
+        "task_ids": task_ids,
         "files": files,
         "cached_at": datetime.now().isoformat()
     }
-    logger.info(f"Cached result for {domain}")
+    logger.info(f"Cached result for {domain} ({cache_key})")
+
+def invalidate_cached_result(cache_key: str):
+    url_cache.pop(cache_key, None)
 
 # Функции работы с завершёнными задачами
+async def join_running_task(key: str) -> Optional[str]:
+    """task_id уже запущенной задачи с тем же запросом, если такая есть"""
+    while key in running_requests:
+        task_id = await asyncio.shield(running_requests[key])
+        if task_id:
+            return task_id
+    return None
+
+async def start_or_join_task(key: str, create: Callable[[], Awaitable[Optional[str]]]) -> Tuple[Optional[str], bool]:
+    """Присоединяется к задаче с тем же запросом или создаёт новую; второй элемент — присоединились ли"""
+    task_id = await join_running_task(key)
+    if task_id:
+        return task_id, True
+    future = asyncio.get_running_loop().create_future()
+    running_requests[key] = future
+    try:
+        # Прерванное создание оставило бы в Manus задачу, о которой бот не знает
+        with drain_guard:
+            task_id = await create()
+    finally:
+        future.set_result(task_id)
+        if not task_id:
+            running_requests.pop(key, None)
+    return task_id, False
+
+def register_running_task(key: str, task_id: str):
+    """Регистрирует уже созданную задачу (например, подхваченную после перезапуска)"""
+    if key not in running_requests:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(task_id)
+        running_requests[key] = future
+
+def release_running_task(key: str, task_id: str):
+    """Снимает задачу с реестра, когда её результат получен"""
+    future = running_requests.get(key)
+    if future is not None and future.done() and future.result() == task_id:
+        running_requests.pop(key, None)
+
 def get_completed_tasks(user_id: int) -> List[Dict]:
     """Получить список завершённых задач пользователя"""
     if user_id not in completed_tasks:
@@ -1159,6 +1960,371 @@ def get_stages_visual(percent: int) -> str:
         lines.append(f"{status} {stage['icon']} {stage['name']}")
     return "\n".join(lines)
 
+# ═══════════════════════════════════════════════════════════════
+# ОГРАНИЧЕНИЕ СКОРОСТИ
+# ═══════════════════════════════════════════════════════════════
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, запас не больше capacity
+    (но не меньше одного токена — иначе при rate < 1 запрос ждал бы вечно)"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._priority_lock = asyncio.Lock()
+        self._priority_waiting = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1, priority: bool = False):
+        """Ждёт, пока наберётся нужное число токенов (ожидающие обслуживаются по очереди).
+        Приоритетные запросы получают токены раньше обычных."""
+        if priority:
+            self._priority_waiting += 1
+            try:
+                async with self._priority_lock:
+                    await self._take(tokens, priority=True)
+            finally:
+                self._priority_waiting -= 1
+            return
+        async with self._lock:
+            await self._take(tokens)
+
+    def idle(self) -> bool:
+        """Запас полон и никто не ждёт — такая корзина ничем не отличается от новой"""
+        self._refill()
+        return self.tokens >= self.capacity and not self._lock.locked() and not self._priority_lock.locked()
+
+    async def _take(self, tokens: float, priority: bool = False):
+        while True:
+            self._refill()
+            if self.tokens >= tokens and (priority or not self._priority_waiting):
+                self.tokens -= tokens
+                return
+            await asyncio.sleep(max(tokens - self.tokens, 0.1) / self.rate)
+
+class TelegramOutboundScheduler(BaseRequestMiddleware):
+    """Все исходящие запросы бота в чаты: лимиты Telegram на чат и на бота,
+    ответы пользователю раньше массовой выдачи файлов, повтор после TelegramRetryAfter"""
+
+    BULK_METHODS = (SendDocument, SendMediaGroup)
+    PRUNE_INTERVAL = 60  # Как часто забывать истёкшие блокировки и простаивающие чаты, сек
+
+    def __init__(self, chat_rate: float, group_rate: float, global_rate: float, max_retries: int):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: Dict[Any, TokenBucket] = {}
+        self.blocked_until: Dict[Any, float] = {}  # chat_id -> до какого момента Telegram просил подождать
+        self.counters = {"interactive": 0, "bulk": 0, "retry_after": 0, "wait_seconds": 0.0}
+        self.last_updates_at: Optional[float] = None  # Когда последний раз успешно отработал getUpdates
+        self.pruned_at = time.monotonic()
+
+    def chat_bucket(self, chat_id: Any) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            self.chat_buckets[chat_id] = TokenBucket(self.group_rate if is_group else self.chat_rate, 1)
+        return self.chat_buckets[chat_id]
+
+    def prune(self, now: float):
+        """Без этого словари росли бы с каждым новым чатом за всё время работы бота"""
+        self.pruned_at = now
+        for chat_id in [chat_id for chat_id, until in self.blocked_until.items() if until <= now]:
+            del self.blocked_until[chat_id]
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.idle()]:
+            del self.chat_buckets[chat_id]
+
+    async def _acquire(self, chat_id: Any, priority: bool):
+        start = time.monotonic()
+        if start - self.pruned_at >= self.PRUNE_INTERVAL:
+            self.prune(start)
+        blocked = self.blocked_until.get(chat_id, 0) - start
+        if blocked > 0:
+            await asyncio.sleep(blocked)
+        await self.chat_bucket(chat_id).acquire(priority=priority)
+        await self.global_bucket.acquire(priority=priority)
+        self.counters["wait_seconds"] += time.monotonic() - start
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery и т.п. — без очереди
+            result = await make_request(bot, method)
+            if isinstance(method, GetUpdates):
+                self.last_updates_at = time.monotonic()
+            return result
+        bulk = isinstance(method, self.BULK_METHODS)
+        self.counters["bulk" if bulk else "interactive"] += 1
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority=not bulk)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.counters["retry_after"] += 1
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning(f"Telegram flood control for chat {chat_id}: retry {attempt} after {e.retry_after}s")
+                self.blocked_until[chat_id] = time.monotonic() + e.retry_after
+
+telegram_scheduler = TelegramOutboundScheduler(TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE, TELEGRAM_GLOBAL_RATE, TELEGRAM_MAX_RETRIES)
+bot.session.middleware(telegram_scheduler)
+
+class ManusRateLimiter:
+    """Бюджет запросов к Manus API: общий лимит и отдельные на создание задач и опрос статусов"""
+
+    KINDS = ("create", "poll", "other")
+
+    def __init__(self):
+        self.total = TokenBucket(MANUS_MAX_RPS, MANUS_MAX_RPS)
+        self.budgets = {
+            "create": TokenBucket(MANUS_CREATE_PER_MINUTE / 60, MANUS_CREATE_BURST),
+            "poll": TokenBucket(MANUS_POLL_RPS, MANUS_POLL_RPS)
+        }
+        self.counters = {kind: {"requests": 0, "throttled": 0, "wait_seconds": 0.0} for kind in self.KINDS}
+        self.recent: deque = deque()  # (время, вид) запросов за последнюю минуту
+
+    async def acquire(self, kind: str, priority: bool = False):
+        """Ждёт места в бюджете вида запроса и в общем лимите"""
+        start = time.monotonic()
+        if kind in self.budgets:
+            await self.budgets[kind].acquire(priority=priority)
+        await self.total.acquire(priority=priority)
+        now = time.monotonic()
+        counter = self.counters[kind]
+        counter["requests"] += 1
+        if now - start > 0.01:
+            counter["throttled"] += 1
+            counter["wait_seconds"] += now - start
+        self.recent.append((now, kind))
+
+    def last_minute(self) -> Dict[str, int]:
+        cutoff = time.monotonic() - 60
+        while self.recent and self.recent[0][0] < cutoff:
+            self.recent.popleft()
+        counts = {kind: 0 for kind in self.KINDS}
+        for _, kind in self.recent:
+            counts[kind] += 1
+        return counts
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Счётчики и загрузка бюджета за последнюю минуту"""
+        counts = self.last_minute()
+        limits = {"create": MANUS_CREATE_PER_MINUTE, "poll": MANUS_POLL_RPS * 60, "other": MANUS_MAX_RPS * 60}
+        return {
+            kind: {
+                **self.counters[kind],
+                "last_minute": counts[kind],
+                "budget_per_minute": limits[kind],
+                "usage_percent": round(counts[kind] * 100 / limits[kind]) if limits[kind] else 0
+            }
+            for kind in self.KINDS
+        }
+
+manus_rate_limiter = ManusRateLimiter()
+
+class ProgressRenderer:
+    """Правки сообщений о прогрессе: частые обновления склеиваются, неизменённый текст не отправляется.
+    Правки идут через лимиты Telegram; RetryAfter повторяет сам планировщик исходящих запросов."""
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.messages: Dict[Tuple[int, int], Message] = {}
+        self.pending: Dict[Tuple[int, int], str] = {}  # Последний ещё не отправленный текст
+        self.sent: Dict[Tuple[int, int], str] = {}
+        self.last_edit: Dict[Tuple[int, int], float] = {}
+        self.flushers: Dict[Tuple[int, int], asyncio.Task] = {}
+        self.counters = {"requested": 0, "edits": 0, "coalesced": 0, "unchanged": 0, "retry_after": 0, "failed": 0}
+
+    def update(self, message: Message, text: str):
+        """Запрашивает обновление; отправлен будет только последний текст"""
+        key = (message.chat.id, message.message_id)
+        self.counters["requested"] += 1
+        if key in self.pending:
+            self.counters["coalesced"] += 1
+        self.pending[key] = text
+        self.messages[key] = message
+        if key not in self.flushers:
+            self.flushers[key] = asyncio.create_task(self._flush(key))
+
+    async def finish(self, message: Message, text: str):
+        """Финальный текст: отложенные обновления отменяются, правка отправляется сразу"""
+        key = (message.chat.id, message.message_id)
+        self.pending.pop(key, None)
+        flusher = self.flushers.pop(key, None)
+        if flusher is not None:
+            flusher.cancel()
+        self.messages[key] = message
+        await self._edit(key, text)
+        for store in (self.messages, self.sent, self.last_edit):
+            store.pop(key, None)
+
+    def discard(self, message: Message):
+        """Забывает сообщение конвейера, который отменён, упал или брошен: отложенная правка не уйдёт после /cancel"""
+        key = (message.chat.id, message.message_id)
+        flusher = self.flushers.pop(key, None)
+        if flusher is not None:
+            flusher.cancel()
+        for store in (self.pending, self.messages, self.sent, self.last_edit):
+            store.pop(key, None)
+
+    async def _flush(self, key: Tuple[int, int]):
+        try:
+            while key in self.pending:
+                delay = self.last_edit.get(key, 0) + self.min_interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                text = self.pending.pop(key, None)
+                if text is not None:
+                    await self._edit(key, text)
+        finally:
+            if self.flushers.get(key) is asyncio.current_task():
+                self.flushers.pop(key, None)
+
+    async def _edit(self, key: Tuple[int, int], text: str) -> bool:
+        if self.sent.get(key) == text:
+            self.counters["unchanged"] += 1
+            return True
+        message = self.messages[key]
+        try:
+            await message.edit_text(text)
+        except TelegramRetryAfter as e:
+            # Планировщик уже исчерпал повторы: прогресс не стоит того, чтобы задерживать выдачу файлов
+            self.counters["retry_after"] += 1
+            self.counters["failed"] += 1
+            logger.warning(f"Progress edit dropped after flood control retries (retry after {e.retry_after}s)")
+            return False
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                self.counters["failed"] += 1
+                logger.warning(f"Progress edit failed: {e}")
+                return False
+        except Exception as e:
+            self.counters["failed"] += 1
+            logger.warning(f"Progress edit failed: {e}")
+            return False
+        self.counters["edits"] += 1
+        self.sent[key] = text
+        self.last_edit[key] = time.monotonic()
+        return True
+
+progress_renderer = ProgressRenderer(PROGRESS_MIN_INTERVAL)
+
+# ═══════════════════════════════════════════════════════════════
+# МЕТРИКИ
+# ═══════════════════════════════════════════════════════════════
+
+class LatencyStats:
+    """Задержки операции: счётчик, сумма и последние замеры для квантилей"""
+
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+# Запрос статуса задачи в Manus (включая ожидание бюджета и повторы)
+poll_latency = LatencyStats()
+# От завершения задачи до файла в чате (скачивание и отправка в Telegram)
+delivery_latency = LatencyStats()
+
+# ═══════════════════════════════════════════════════════════════
+# ОЦЕНКА ДЛИТЕЛЬНОСТИ
+# ═══════════════════════════════════════════════════════════════
+
+def load_bucket(active: int) -> str:
+    """Загрузка на момент запуска: сколько задач Manus уже в работе"""
+    if active < 3:
+        return "idle"
+    if active < 10:
+        return "busy"
+    return "peak"
+
+def current_load() -> str:
+    return load_bucket(len(task_poller.tasks))
+
+def format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 60:
+        return "< 1 мин"
+    return f"~{int(round(seconds / 60))} мин"
+
+class DurationModel:
+    """Реальные длительности задач (создание → завершение) по типу, профилю агента и загрузке.
+    Скользящее окно замеров; при нехватке данных оценка берётся с более общего уровня."""
+
+    def __init__(self, samples: Dict[str, List[float]], window: int, min_samples: int, default: float):
+        self.samples = samples
+        self.window = window
+        self.min_samples = min_samples
+        self.default = default
+
+    @staticmethod
+    def keys(kind: str, load: str) -> List[str]:
+        return [f"{kind}|{MANUS_AGENT_PROFILE}|{load}", f"{kind}|{MANUS_AGENT_PROFILE}", kind]
+
+    def record(self, kind: str, load: str, seconds: float):
+        """Добавляет замер на всех уровнях детализации"""
+        for key in self.keys(kind, load):
+            values = self.samples.setdefault(key, [])
+            values.append(round(seconds, 1))
+            del values[:-self.window]
+
+    def percentile(self, kind: str, load: str, q: float) -> float:
+        for key in self.keys(kind, load):
+            values = self.samples.get(key)
+            if values and len(values) >= self.min_samples:
+                ordered = sorted(values)
+                return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+        return self.default
+
+    def estimate(self, kind: str, load: Optional[str] = None) -> Tuple[float, float]:
+        """Медиана и 90-й перцентиль длительности"""
+        load = load or current_load()
+        p50 = self.percentile(kind, load, 0.5)
+        return p50, max(self.percentile(kind, load, 0.9), p50)
+
+    def progress(self, kind: str, load: Optional[str], elapsed: float) -> Tuple[int, int]:
+        """Процент и оставшееся время: до медианы шкала идёт до 80%, дальше медленно до 95%"""
+        p50, p90 = self.estimate(kind, load)
+        if elapsed < p50:
+            return int(80 * elapsed / p50), int(p50 - elapsed)
+        span = max(p90 - p50, 1)
+        return int(80 + 15 * min((elapsed - p50) / span, 1)), int(max(p90 - elapsed, 0))
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Статистика для планирования мощностей"""
+        result = {}
+        for key, values in self.samples.items():
+            ordered = sorted(values)
+            result[key] = {
+                "count": len(ordered),
+                "p50": ordered[len(ordered) // 2],
+                "p90": ordered[min(int(len(ordered) * 0.9), len(ordered) - 1)]
+            }
+        return result
+
+duration_model = DurationModel(task_durations, ETA_WINDOW, ETA_MIN_SAMPLES, ETA_DEFAULT_SECONDS)
+
 # ═══════════════════════════════════════════════════════════════
 # СООБЩЕНИЯ JARVIS
 # ═══════════════════════════════════════════════════════════════
@@ -1232,7 +2398,25 @@ def msg_processing_start() -> str:
 
 ⏳ Подключение к Manus AI..."""
 
-def msg_processing_progress(elapsed_min: int, elapsed_sec: int, stage: str, percent: int) -> str:
+def msg_queued(position: int, wait_seconds: Optional[float] = None) -> str:
+    return f"""┌─────────────────────────────────────┐
+│  📥 ЗАДАЧА ПОСТАВЛЕНА В ОЧЕРЕДЬ     │
+└─────────────────────────────────────┘
+
+🔢 Позиция в очереди: {position}
+⏳ Ожидание старта: {format_eta(wait_seconds)}
+
+💡 JARVIS начнёт работу, как только
+   освободится слот генерации."""
+
+def msg_quota_exceeded(limit: int) -> str:
+    return f"""⛔ Дневной лимит заданий исчерпан ({limit}).
+
+Готовые документы доступны в «📊 Мои задачи».
+Новые задания можно запускать с 00:00."""
+
+def msg_processing_progress(elapsed_min: int, elapsed_sec: int, stage: str, percent: int,
+                            remaining: Optional[float] = None) -> str:
     progress = get_progress_bar(percent)
     return f"""╔══════════════════════════════════════╗
 ║  ⚙️ АНАЛИЗ В ПРОЦЕССЕ               ║
@@ -1242,11 +2426,59 @@ def msg_processing_progress(elapsed_min: int, elapsed_sec: int, stage: str, perc
 │ ⏱️ Время: {elapsed_min:02d}:{elapsed_sec:02d}                       │
 │ 📊 Прогресс: [{progress}] {percent}%       │
 │ 🔧 Этап: {stage[:25]:<25} │
+│ ⏳ Осталось: {format_eta(remaining):<22} │
 └─────────────────────────────────────┘
 
 💡 Пожалуйста, подождите...
    JARVIS анализирует данные."""
 
+def msg_cache_found(domain: str, cached: Dict) -> str:
+    cached_at = datetime.fromisoformat(cached["cached_at"]).strftime("%d.%m.%Y %H:%M")
+    files_count = len(cached.get("files", []))
+    return f"""┌─────────────────────────────────────┐
+│  ⚡ НАЙДЕН ГОТОВЫЙ РЕЗУЛЬТАТ        │
+│  {domain[:35]:<35} │
+└─────────────────────────────────────┘
+
+📅 Создан: {cached_at}
+📁 Документов: {files_count}
+
+Использовать готовые документы
+или сгенерировать заново?"""
+
+DOC_STATUS_ICONS = {
+    "waiting": "⬜",
+    "running": "⏳",
+    "sending": "📤",
+    "done": "✅",
+    "error": "❌"
+}
+
+def msg_documents_progress(progress: Dict[str, str], start_time: datetime, remaining: Optional[float] = None) -> str:
+    """Сводный прогресс генерации документов Этапа 3"""
+    elapsed_sec = int((datetime.now() - start_time).total_seconds())
+    done = sum(1 for s in progress.values() if s in ("done", "error"))
+    percent = int(done * 100 / len(progress)) if progress else 0
+    lines = []
+    for doc_id, status in progress.items():
+        doc = DOCUMENT_TYPES.get(doc_id, {})
+        lines.append(f"{DOC_STATUS_ICONS.get(status, '⬜')} {doc.get('icon', '📄')} {doc.get('name', doc_id)}")
+    docs_text = "\n".join(lines)
+    return f"""╔══════════════════════════════════════╗
+║  ⚙️ ГЕНЕРАЦИЯ ДОКУМЕНТОВ            ║
+╚══════════════════════════════════════╝
+
+┌─────────────────────────────────────┐
+│ ⏱️ Время: {elapsed_sec // 60:02d}:{elapsed_sec % 60:02d}                       │
+│ 📊 Готово: [{get_progress_bar(percent)}] {done}/{len(progress)}        │
+│ ⏳ Осталось: {format_eta(remaining):<22} │
+└─────────────────────────────────────┘
+
+{docs_text}
+
+💡 Документы создаются параллельно
+   и приходят по мере готовности."""
+
 def msg_processing_complete(elapsed: str, files_count: int) -> str:
     return f"""╔══════════════════════════════════════╗
 ║  ✅ МИССИЯ ВЫПОЛНЕНА                ║
@@ -1343,6 +2575,21 @@ def msg_status(user_id: int) -> str:
     quick_mode = "✅ ВКЛ" if settings.get("quick_mode") else "❌ ВЫКЛ"
     notifications = "✅ ВКЛ" if settings.get("notifications", True) else "❌ ВЫКЛ"
     now = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+    manus_state = {
+        "closed": "🟢 ПОДКЛЮЧЕНО",
+        "half_open": "🟡 ПРОВЕРКА",
+        "open": "🔴 НЕДОСТУПЕН"
+    }[get_manus_client().breaker.state]
+    budget = manus_rate_limiter.snapshot()
+    create_usage = f"{budget['create']['last_minute']}/{budget['create']['budget_per_minute']:.0f} ({budget['create']['usage_percent']}%)"
+    poll_usage = f"{budget['poll']['last_minute']}/{budget['poll']['budget_per_minute']:.0f} ({budget['poll']['usage_percent']}%)"
+    throttled = sum(counter["throttled"] for counter in budget.values())
+    updates_mode = "✅ webhook" if TELEGRAM_WEBHOOK_URL else "✅ long polling"
+    dossier_p50, dossier_p90 = duration_model.estimate("dossier")
+    dossier_eta = f"{format_eta(dossier_p50)} / {format_eta(dossier_p90)}"
+    queue_eta = format_eta(estimate_queue_wait(len(pending_jobs) + 1))
+    left = quota_left(user_id)
+    quota = "без лимита" if left is None else f"{left} из {daily_quota(user_id)}"
     
     return f"""╔══════════════════════════════════════╗
 ║  📈 СТАТУС СИСТЕМЫ JARVIS           ║
@@ -1361,7 +2608,7 @@ def msg_status(user_id: int) -> str:
 
 🔌 MANUS API
 ┌─────────────────────────────────────┐
-│ Статус:      🟢 ПОДКЛЮЧЕНО          │
+│ Статус:      {manus_state:<22} │
 │ Endpoint:    api.manus.ai           │
 │ Project ID:  {MANUS_PROJECT_ID[:20]:<20} │
 └─────────────────────────────────────┘
@@ -1370,7 +2617,7 @@ def msg_status(user_id: int) -> str:
 ┌─────────────────────────────────────┐
 │ Статус:      🟢 АКТИВЕН             │
 │ Username:    @bimar_presale_bot     │
-│ Polling:     ✅ работает            │
+│ Апдейты:     {updates_mode:<22} │
 └─────────────────────────────────────┘
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
@@ -1381,6 +2628,22 @@ def msg_status(user_id: int) -> str:
 │ ✅ Успешных анализов:    {stats['successful']:<10} │
 │ ❌ Ошибок:               {stats['errors']:<10} │
 │ 📁 Файлов отправлено:    {stats['files_sent']:<10} │
+│ ⚙️ Задач в работе:       {len(active_tasks):<10} │
+│ ⏳ Задач в очереди:      {len(pending_jobs):<10} │
+└─────────────────────────────────────┘
+
+📶 БЮДЖЕТ MANUS API (за минуту)
+┌─────────────────────────────────────┐
+│ 🆕 Создание задач:  {create_usage:<16} │
+│ 🔄 Опрос статусов:  {poll_usage:<16} │
+│ ⏱ Ожиданий лимита:  {throttled:<16} │
+└─────────────────────────────────────┘
+
+⏳ ОЦЕНКА ВРЕМЕНИ
+┌─────────────────────────────────────┐
+│ 📄 Досье (p50/p90): {dossier_eta:<16} │
+│ 📥 Старт нового:    {queue_eta:<16} │
+│ 🎫 Заданий сегодня: {quota:<16} │
 └─────────────────────────────────────┘
 
 ⚙️ ВАША КОНФИГУРАЦИЯ
@@ -1650,6 +2913,296 @@ def msg_access_denied() -> str:
 # MANUS API
 # ═══════════════════════════════════════════════════════════════
 
+# Временные ошибки: запрос можно повторить позже
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Ответы, при которых задача гарантированно не создана и POST безопасно повторить
+SAFE_RETRY_STATUSES = {429, 503}
+
+class ManusError(Exception):
+    """Ошибка вызова Manus API с классификацией"""
+
+    def __init__(self, message: str, status: Optional[int] = None, transient: bool = False,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.transient = transient  # Сбой на стороне Manus или сети (учитывается автоматом защиты)
+        self.retryable = transient  # Можно ли повторить именно этот запрос
+        self.retry_after = retry_after
+
+class ManusUnavailable(ManusError):
+    """Автомат защиты разомкнут — запрос не отправлялся"""
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах или в виде HTTP-даты"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+
+def retry_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Экспоненциальная пауза с полным джиттером; Retry-After от сервера в приоритете"""
+    if retry_after is not None:
+        return min(retry_after, MANUS_RETRY_MAX_DELAY)
+    return random.uniform(0, min(MANUS_RETRY_MAX_DELAY, MANUS_RETRY_BASE_DELAY * 2 ** attempt))
+
+class CircuitBreaker:
+    """Автомат защиты: после серии сбоев запросы к Manus не отправляются до пробного"""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def retry_in(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос; в полуоткрытом состоянии пропускает один пробный"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def release_probe(self):
+        self.probing = False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Manus API recovered, circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+            logger.warning(f"Manus API unavailable after {self.failures} failures, circuit open for {self.cooldown:.0f}s")
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    async def wait_available(self):
+        """Ждёт, пока запрос можно будет отправить (новые задания копятся в очереди)"""
+        while True:
+            state = self.state
+            if state == "closed" or (state == "half_open" and not self.probing):
+                return
+            await asyncio.sleep(max(self.retry_in(), 1.0))
+
+class ManusClient:
+    """Долгоживущий клиент Manus API с общим пулом keep-alive соединений"""
+
+    def __init__(self, base_url: str, api_key: Optional[str]):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.breaker = CircuitBreaker(MANUS_BREAKER_THRESHOLD, MANUS_BREAKER_COOLDOWN)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Сессия создаётся лениво внутри работающего event loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=MANUS_POOL_SIZE,
+                limit_per_host=MANUS_POOL_PER_HOST,
+                ttl_dns_cache=MANUS_DNS_TTL,
+                keepalive_timeout=MANUS_KEEPALIVE
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _headers(self, json_body: bool = False) -> Dict[str, str]:
+        # Ключ передаём только в запросах к API, а не на хосты с файлами
+        headers = {"API_KEY": self.api_key or ""}
+        if json_body:
+            headers["Content-Type"] = "application/json"
+        return headers
+
+    async def _send(self, method: str, url: str, json_body: Optional[Dict], timeout: float) -> Dict[str, Any]:
+        async with self.session.request(
+            method, url,
+            headers=self._headers(json_body=json_body is not None),
+            json=json_body,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise ManusError(
+                    f"HTTP {response.status} - {error_text[:200]}",
+                    status=response.status,
+                    transient=response.status in RETRYABLE_STATUSES,
+                    retry_after=parse_retry_after(response.headers.get("Retry-After"))
+                )
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                # HTML или пустое тело от прокси/шлюза перед Manus — такой же сбой, как 502
+                body = await response.text()
+                raise ManusError(f"HTTP {response.status} with non-JSON body - {body[:200]!r}",
+                                 status=response.status, transient=True)
+            return data
+
+    async def _request(self, method: str, path: str, json_body: Optional[Dict] = None, timeout: float = 30,
+                       idempotent: bool = True, wait: bool = False, budget: str = "other",
+                       priority: bool = False) -> Dict[str, Any]:
+        """Запрос к API с повторами временных ошибок через автомат защиты и бюджет запросов.
+        wait=True — при недоступности Manus дождаться восстановления, иначе сразу ManusUnavailable."""
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            if wait:
+                await self.breaker.wait_available()
+            # Автомат защиты проверяется до бюджета: отклонённая попытка не расходует токены
+            if not self.breaker.allow():
+                if wait:
+                    continue
+                raise ManusUnavailable(f"circuit open, retry in {self.breaker.retry_in():.0f}s", transient=True)
+            try:
+                await manus_rate_limiter.acquire(budget, priority)
+                result = await self._send(method, url, json_body, timeout)
+            except ManusError as e:
+                error = e
+                if not idempotent and e.status not in SAFE_RETRY_STATUSES:
+                    # Запрос мог быть выполнен — повтор создал бы дубликат
+                    error.retryable = False
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = ManusError(f"{type(e).__name__}: {e}", transient=True)
+                if not idempotent and not isinstance(e, aiohttp.ClientConnectorError):
+                    error.retryable = False
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+            
+            if error.transient:
+                self.breaker.record_failure()
+            else:
+                # Ответ по существу (4xx) — сам Manus доступен
+                self.breaker.record_success()
+            attempt += 1
+            if not error.retryable or attempt >= MANUS_RETRY_ATTEMPTS:
+                raise error
+            delay = retry_delay(attempt - 1, error.retry_after)
+            logger.warning(f"Manus {method} {path} failed ({error}), retry {attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def create_task(self, prompt: str, label: str, agent_profile: str = MANUS_AGENT_PROFILE) -> Optional[str]:
+        """Создаёт задачу в Manus и возвращает её task_id"""
+        payload = {
+            "prompt": prompt,
+            "projectId": MANUS_PROJECT_ID,
+            "agentProfile": agent_profile
+        }
+        try:
+            data = await self._request("POST", "/v1/tasks", json_body=payload, timeout=60, idempotent=False,
+                                       wait=True, budget="create")
+        except ManusError as e:
+            logger.error(f"Failed to create {label} task: {e}")
+            return None
+        logger.info(f"{label} task created: {data}")
+        return data.get("task_id")
+
+    async def get_task(self, task_id: str, priority: bool = False) -> Dict[str, Any]:
+        """Возвращает текущее состояние задачи; при недоступности API — статус error"""
+        try:
+            return await self._request("GET", f"/v1/tasks/{task_id}", budget="poll", priority=priority)
+        except ManusError as e:
+            logger.error(f"Error getting task status: {e}")
+            return {"status": "error", "error": str(e)}
+
+    async def stop_task(self, task_id: str) -> bool:
+        """Останавливает задачу в Manus, чтобы она не расходовала ресурсы"""
+        try:
+            await self._request("POST", f"/v1/tasks/{task_id}/stop", json_body={}, timeout=30)
+            logger.info(f"Task {task_id} stopped")
+            return True
+        except ManusError as e:
+            if e.status in (404, 405):
+                logger.warning(f"Stopping tasks is not supported by Manus API ({e.status}), task {task_id} keeps running")
+            else:
+                logger.error(f"Error stopping task {task_id}: {e}")
+            return False
+
+    async def download(self, url: str, filepath: str) -> bool:
+        """Скачивает файл результата в filepath (с повторами при обрывах)"""
+        for attempt in range(MANUS_RETRY_ATTEMPTS):
+            retry_after = None
+            try:
+                async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=None, sock_read=120)) as response:
+                    if response.status == 200:
+                        # Пишем на диск по чанкам — память не растёт с размером файла
+                        with open(filepath, 'wb') as f:
+                            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                                f.write(chunk)
+                        return True
+                    if response.status not in RETRYABLE_STATUSES:
+                        logger.error(f"Error downloading file: HTTP {response.status}")
+                        return False
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    logger.warning(f"Error downloading file: HTTP {response.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Error downloading file: {e}")
+            if attempt + 1 < MANUS_RETRY_ATTEMPTS:
+                await asyncio.sleep(retry_delay(attempt, retry_after))
+        logger.error(f"Giving up downloading {url}")
+        return False
+
+    async def register_webhook(self, url: str) -> Optional[str]:
+        """Регистрирует адрес для push-уведомлений о задачах"""
+        try:
+            data = await self._request("POST", "/v1/webhooks", json_body={"webhook": {"url": url}})
+        except ManusError as e:
+            logger.error(f"Failed to register webhook: {e}")
+            return None
+        logger.info(f"Webhook registered: {data}")
+        return data.get("webhook_id")
+
+    async def delete_webhook(self, webhook_id: str):
+        try:
+            await self._request("DELETE", f"/v1/webhooks/{webhook_id}", timeout=10)
+            logger.info(f"Webhook {webhook_id} deleted")
+        except ManusError as e:
+            logger.error(f"Error deleting webhook: {e}")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+# Создаётся в main() и закрывается при остановке бота
+manus_client: Optional[ManusClient] = None
+
+def get_manus_client() -> ManusClient:
+    global manus_client
+    if manus_client is None:
+        manus_client = ManusClient(MANUS_BASE_URL, MANUS_API_KEY)
+    return manus_client
+
 # ═══════════════════════════════════════════════════════════════
 # ПРОМПТ 1: ЭТАП 1 — АНАЛИЗ И ДОСЬЕ (только 1 документ)
 # ═══════════════════════════════════════════════════════════════
@@ -1758,30 +3311,7 @@ JARVIS v3.0 — ЭТАП 1: АНАЛИЗ КОМПАНИИ И СОЗДАНИЕ Д
 Они будут созданы на следующем этапе по запросу пользователя.
 """
 
-    headers = {
-        "API_KEY": MANUS_API_KEY,
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "prompt": prompt,
-        "projectId": MANUS_PROJECT_ID,
-        "agentProfile": "manus-1.6-max"
-    }
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{MANUS_BASE_URL}/v1/tasks",
-                headers=headers,
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=60)
-            ) as response:
-                data = await response.json()
-                logger.info(f"Stage 1 task created: {data}")
-                return data.get("task_id")
-    except Exception as e:
-        logger.error(f"Error creating stage 1 task: {e}")
-        return None
+    return await get_manus_client().create_task(prompt, "Stage 1")
 
 # ═══════════════════════════════════════════════════════════════
 # ПРОМПТ 2: ЭТАП 3 — ГЕНЕРАЦИЯ ВЫБРАННЫХ ДОКУМЕНТОВ
@@ -1915,98 +3445,613 @@ JARVIS v3.0 — ЭТАП 3: ГЕНЕРАЦИЯ ПРЕСЕЙЛ-ПАКЕТА
 - Фокус на закрытии сделки
 """
 
-    headers = {
-        "API_KEY": MANUS_API_KEY,
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "prompt": prompt,
-        "projectId": MANUS_PROJECT_ID,
-        "agentProfile": "manus-1.6-max"
-    }
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{MANUS_BASE_URL}/v1/tasks",
-                headers=headers,
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=60)
-            ) as response:
-                data = await response.json()
-                logger.info(f"Stage 3 task created: {data}")
-                return data.get("task_id")
-    except Exception as e:
-        logger.error(f"Error creating stage 3 task: {e}")
-        return None
+    return await get_manus_client().create_task(prompt, "Stage 3")
 
 # Для обратной совместимости — старая функция вызывает Этап 1
 async def create_manus_task_single_doc(prompt: str) -> Optional[str]:
     """Создаёт задачу для генерации одного документа"""
-    try:
-        headers = {
-            "API_KEY": MANUS_API_KEY,
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "prompt": prompt,
-            "projectId": MANUS_PROJECT_ID,
-            "agentProfile": "manus-1.6-max"
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{MANUS_BASE_URL}/v1/tasks",
-                headers=headers,
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=60)
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    task_id = data.get("task_id")
-                    logger.info(f"Single doc task created: {data}")
-                    return task_id
-                else:
-                    error_text = await response.text()
-                    logger.error(f"Failed to create single doc task: {response.status} - {error_text}")
-                    return None
-    except Exception as e:
-        logger.error(f"Exception in create_manus_task_single_doc: {e}")
-        return None
+    return await get_manus_client().create_task(prompt, "Single doc")
 
 async def create_manus_task(url: str, goal: str, constraints: str) -> Optional[str]:
     """Обратная совместимость — вызывает Этап 1"""
     return await create_manus_task_stage1(url, goal, constraints)
 
-async def get_task_status(task_id: str) -> Dict[str, Any]:
-    headers = {"API_KEY": MANUS_API_KEY}
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{MANUS_BASE_URL}/v1/tasks/{task_id}",
-                headers=headers,
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as response:
-                return await response.json()
-    except Exception as e:
-        logger.error(f"Error getting task status: {e}")
-        return {"status": "error", "error": str(e)}
+async def get_task_status(task_id: str, priority: bool = False) -> Dict[str, Any]:
+    return await get_manus_client().get_task(task_id, priority)
+
+def extract_artifacts(task_status: Dict[str, Any]) -> List[Dict]:
+    """Извлекает ссылки на файлы из ответа Manus"""
+    artifacts = []
+    for output_item in task_status.get("output", []):
+        content = output_item.get("content", [])
+        if isinstance(content, list):
+            for item in content:
+                if item.get("type") == "output_file" and item.get("fileUrl"):
+                    artifacts.append({
+                        "url": item.get("fileUrl"),
+                        "name": item.get("fileName", "file")
+                    })
+    return artifacts
 
 async def download_file(url: str, filename: str) -> Optional[str]:
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=120)) as response:
-                if response.status == 200:
-                    temp_dir = tempfile.mkdtemp()
-                    filepath = os.path.join(temp_dir, filename)
-                    with open(filepath, 'wb') as f:
-                        f.write(await response.read())
-                    return filepath
-    except Exception as e:
-        logger.error(f"Error downloading file: {e}")
+    temp_dir = tempfile.mkdtemp()
+    filepath = os.path.join(temp_dir, filename)
+    if await get_manus_client().download(url, filepath):
+        return filepath
+    shutil.rmtree(temp_dir, ignore_errors=True)
     return None
 
+# ═══════════════════════════════════════════════════════════════
+# ХРАНИЛИЩЕ АРТЕФАКТОВ
+# ═══════════════════════════════════════════════════════════════
+
+class ArtifactStore:
+    """Хранилище документов на диске с адресацией по содержимому (sha256)"""
+
+    def __init__(self, root: str, max_bytes: int, max_age: timedelta):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_path = os.path.join(root, "index.json")
+        # sha256 -> {"size", "names", "created_at", "last_access"}
+        self.blobs: Dict[str, Dict] = {}
+        # URL файла в Manus -> sha256, чтобы не скачивать его повторно
+        self.urls: Dict[str, str] = {}
+        self._fetching: Dict[str, asyncio.Task] = {}  # url -> загрузка в процессе
+        self._removed: set = set()  # Удалённые с последнего сохранения: слияние не должно их вернуть
+        self._loaded = False
+        self._dirty = False  # Индекс в памяти новее, чем на диске
+        self._save_lock = asyncio.Lock()
+
+    def _read_index(self) -> Dict:
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Artifact index is unreadable, ignoring it: {e}")
+            return {}
+
+    def _read_locked(self) -> Dict:
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+        with file_lock(self.index_path):
+            return self._read_index()
+
+    def _write_locked(self, snapshot: Dict, removed: set) -> Dict:
+        """Перечитывает индекс под блокировкой, подмешивает его в снимок и записывает; возвращает прочитанное.
+        Выполняется в отдельном потоке, поэтому работает только со снимком, а не с self.blobs"""
+        # Перечитываем индекс под блокировкой: иначе процессы затирали бы записи друг друга
+        with file_lock(self.index_path):
+            index = self._read_index()
+            self._merge_into(snapshot["blobs"], snapshot["urls"], index, removed)
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        return index
+
+    async def load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        self._merge(await asyncio.to_thread(self._read_locked))
+        # Индекс мог разойтись с диском после сбоя
+        shas = list(self.blobs)
+        missing = await asyncio.to_thread(lambda: [sha for sha in shas if not os.path.exists(self.blob_path(sha))])
+        for sha in missing:
+            self._forget(sha)
+
+    @staticmethod
+    def _merge_into(blobs: Dict, urls: Dict, index: Dict, removed: set):
+        for sha, meta in index.get("blobs", {}).items():
+            if sha in removed:
+                continue
+            mine = blobs.get(sha)
+            if mine is None:
+                blobs[sha] = meta
+                continue
+            mine["names"] += [name for name in meta.get("names", []) if name not in mine["names"]]
+            mine["last_access"] = max(mine.get("last_access", ""), meta.get("last_access", ""))
+            file_ids = {**meta.get("file_ids", {}), **mine.get("file_ids", {})}
+            if file_ids:
+                mine["file_ids"] = file_ids
+        for url, sha in index.get("urls", {}).items():
+            if sha in blobs:
+                urls.setdefault(url, sha)
+
+    def _merge(self, index: Dict):
+        """Подмешивает записи, сохранённые другими процессами (реплики на одном хосте делят индекс)"""
+        self._merge_into(self.blobs, self.urls, index, self._removed)
+
+    async def flush(self):
+        """Записывает индекс, если он менялся. Отметки об обращении и file_id копятся в памяти
+        и уходят на диск здесь (из state_autosave), а не при каждом чтении"""
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            removed = set(self._removed)
+            # Снимок: пока поток пишет файл, обработчики продолжают менять индекс в памяти
+            snapshot = json.loads(json.dumps({"blobs": self.blobs, "urls": self.urls}))
+            try:
+                index = await asyncio.to_thread(self._write_locked, snapshot, removed)
+            except Exception:
+                self._dirty = True
+                raise
+            # Записи других реплик, прочитанные под блокировкой, — в память
+            self._merge(index)
+            self._removed -= removed
+
+    def blob_path(self, sha: str) -> str:
+        return os.path.join(self.root, sha[:2], sha)
+
+    def _forget(self, sha: str):
+        self._removed.add(sha)
+        self._dirty = True
+        self.blobs.pop(sha, None)
+        for url in [url for url, value in self.urls.items() if value == sha]:
+            del self.urls[url]
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _ingest(self, tmp_path: str) -> tuple:
+        """Хэширует файл и переносит его в хранилище (одинаковые байты хранятся один раз)"""
+        sha = self._hash_file(tmp_path)
+        size = os.path.getsize(tmp_path)
+        target = self.blob_path(sha)
+        if os.path.exists(target):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(tmp_path, target)
+        return sha, size
+
+    async def put_file(self, tmp_path: str, name: str, source_url: Optional[str] = None) -> Dict:
+        """Кладёт скачанный файл в хранилище и возвращает ссылку на артефакт"""
+        await self.load()
+        sha, size = await asyncio.to_thread(self._ingest, tmp_path)
+        self._removed.discard(sha)
+        now = datetime.now().isoformat()
+        meta = self.blobs.setdefault(sha, {"size": size, "names": [], "created_at": now})
+        meta["last_access"] = now
+        if name not in meta["names"]:
+            meta["names"].append(name)
+        if source_url:
+            self.urls[source_url] = sha
+        self.evict(keep=sha)
+        # Новый файл сразу виден другим репликам
+        self._dirty = True
+        await self.flush()
+        return {"sha256": sha, "name": name, "size": size, "url": source_url}
+
+    async def get_path(self, sha: str) -> Optional[str]:
+        """Путь к файлу артефакта (и отметка об обращении для LRU)"""
+        await self.load()
+        if sha not in self.blobs and os.path.exists(self.blob_path(sha)):
+            # Файл положила другая реплика после нашего чтения индекса
+            self._merge(await asyncio.to_thread(self._read_locked))
+        if sha not in self.blobs:
+            return None
+        path = self.blob_path(sha)
+        if not os.path.exists(path):
+            self._forget(sha)
+            return None
+        self.blobs[sha]["last_access"] = datetime.now().isoformat()
+        self._dirty = True
+        return path
+
+    async def fetch(self, url: str, name: str) -> Optional[Dict]:
+        """Файл результата Manus: из хранилища, а если его там нет — скачивается один раз"""
+        await self.load()
+        sha = self.urls.get(url)
+        if sha and await self.get_path(sha):
+            meta = self.blobs[sha]
+            return {"sha256": sha, "name": name, "size": meta["size"], "url": url}
+        # Один и тот же файл нужен нескольким пользователям — скачиваем его один раз
+        if url not in self._fetching:
+            self._fetching[url] = asyncio.ensure_future(self._download(url, name))
+            self._fetching[url].add_done_callback(lambda _: self._fetching.pop(url, None))
+        record = await asyncio.shield(self._fetching[url])
+        return {**record, "name": name} if record else None
+
+    async def _download(self, url: str, name: str) -> Optional[Dict]:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        os.close(fd)
+        async with download_semaphore:
+            downloaded = await get_manus_client().download(url, tmp_path)
+        if not downloaded:
+            os.remove(tmp_path)
+            return None
+        return await self.put_file(tmp_path, name, source_url=url)
+
+    async def get_file_id(self, sha: str, name: str) -> Optional[str]:
+        """file_id, под которым Telegram уже хранит этот файл с этим именем"""
+        await self.load()
+        return self.blobs.get(sha, {}).get("file_ids", {}).get(name)
+
+    async def set_file_id(self, sha: str, name: str, file_id: Optional[str]):
+        await self.load()
+        if sha not in self.blobs:
+            return
+        file_ids = self.blobs[sha].setdefault("file_ids", {})
+        if file_id:
+            file_ids[name] = file_id
+        else:
+            file_ids.pop(name, None)
+        self._dirty = True
+
+    def evict(self, keep: Optional[str] = None):
+        """Удаляет файлы старше max_age, затем самые давно использованные сверх квоты"""
+        cutoff = (datetime.now() - self.max_age).isoformat()
+        by_access = sorted(self.blobs.items(), key=lambda item: item[1].get("last_access", ""))
+        total = sum(meta["size"] for meta in self.blobs.values())
+        for sha, meta in by_access:
+            if meta.get("last_access", "") >= cutoff and total <= self.max_bytes:
+                break
+            if sha == keep:
+                continue
+            try:
+                os.remove(self.blob_path(sha))
+            except FileNotFoundError:
+                pass
+            total -= meta["size"]
+            self._forget(sha)
+            logger.info(f"Evicted artifact {sha[:12]} ({meta.get('names')})")
+
+artifact_store = ArtifactStore(ARTIFACTS_DIR, ARTIFACTS_MAX_MB * 1024 * 1024, timedelta(days=ARTIFACTS_MAX_AGE_DAYS))
+
+# ═══════════════════════════════════════════════════════════════
+# ЦЕНТРАЛЬНЫЙ ОПРОС ЗАДАЧ MANUS
+# ═══════════════════════════════════════════════════════════════
+
+class TaskPoller:
+    """Единый фоновый опрос всех задач Manus в работе"""
+
+    def __init__(self):
+        # task_id -> {"future", "created_at", "next_poll", "callbacks", "waiters", "polls"}
+        self.tasks: Dict[str, Dict] = {}
+        # task_id -> {"kind", "load", "started_at"} для модели длительности
+        self.meta: Dict[str, Dict] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+        self.push_enabled = False
+
+    def interval_for(self, age: float) -> float:
+        """Адаптивный интервал: часто в начале, реже для долгих задач, с джиттером"""
+        if age < POLLER_FAST_PERIOD:
+            interval = POLLER_FAST_INTERVAL
+        elif age < POLLER_SLOW_AFTER:
+            interval = POLLING_INTERVAL
+        else:
+            interval = min(POLLING_INTERVAL * 3, POLLER_MAX_INTERVAL)
+        if self.push_enabled:
+            # Завершение придёт push-уведомлением, опрос остаётся страховкой
+            interval = max(interval, MANUS_WEBHOOK_FALLBACK_INTERVAL)
+        return interval * random.uniform(0.8, 1.2)
+
+    def track(self, task_id: str, on_poll: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None) -> asyncio.Future:
+        """Ставит задачу на опрос; повторный вызов подписывается на ту же задачу"""
+        entry = self.tasks.get(task_id)
+        if entry is None:
+            now = asyncio.get_running_loop().time()
+            entry = {
+                "future": asyncio.get_running_loop().create_future(),
+                "created_at": now,
+                "next_poll": now + self.interval_for(0),
+                "callbacks": [],
+                "waiters": 0,
+                "polls": 0
+            }
+            self.tasks[task_id] = entry
+            self._wake()
+        entry["waiters"] += 1
+        if on_poll:
+            entry["callbacks"].append(on_poll)
+        return entry["future"]
+
+    def release(self, task_id: str, on_poll: Optional[Callable] = None):
+        """Отписка ожидающего; задача снимается с опроса, когда ждать больше некому"""
+        entry = self.tasks.get(task_id)
+        if entry is None:
+            return
+        entry["waiters"] -= 1
+        if on_poll in entry["callbacks"]:
+            entry["callbacks"].remove(on_poll)
+        if entry["waiters"] <= 0:
+            self.tasks.pop(task_id, None)
+            self.meta.pop(task_id, None)
+            if not entry["future"].done():
+                entry["future"].cancel()
+
+    async def wait(self, task_id: str, timeout: float,
+                   on_poll: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None) -> Dict[str, Any]:
+        """Ждёт финального статуса задачи (completed/failed) или таймаута"""
+        future = self.track(task_id, on_poll)
+        try:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                if get_manus_client().breaker.state == "closed":
+                    raise
+            # Manus недоступен — статус задачи неизвестен, ждём дольше вместо ложного таймаута
+            logger.warning(f"Task {task_id} timed out during Manus outage, waiting {MANUS_OUTAGE_GRACE}s more")
+            return await asyncio.wait_for(asyncio.shield(future), MANUS_OUTAGE_GRACE)
+        except asyncio.TimeoutError:
+            return {"status": "timeout"}
+        finally:
+            self.release(task_id, on_poll)
+
+    def describe(self, task_id: str, kind: str, started_at: Optional[datetime] = None, load: Optional[str] = None):
+        """Тип задачи и время её создания: по ним считается прогресс и пополняется статистика длительностей.
+        Присоединившиеся к задаче не сдвигают время создания — сохраняется самое раннее."""
+        started_at = started_at or datetime.now()
+        meta = self.meta.get(task_id)
+        if meta is None:
+            self.meta[task_id] = {"kind": kind, "load": load or current_load(), "started_at": started_at}
+        elif started_at < meta["started_at"]:
+            meta["started_at"] = started_at
+
+    def progress(self, task_id: str) -> Optional[Tuple[int, int]]:
+        """Процент и оставшиеся секунды по статистике длительностей таких же задач"""
+        meta = self.meta.get(task_id)
+        if meta is None:
+            return None
+        elapsed = (datetime.now() - meta["started_at"]).total_seconds()
+        return duration_model.progress(meta["kind"], meta["load"], elapsed)
+
+    def poke(self, task_id: str):
+        """Опросить задачу при ближайшем проходе"""
+        entry = self.tasks.get(task_id)
+        if entry is not None:
+            entry["next_poll"] = 0
+            entry["poked"] = True
+            self._wake()
+
+    def is_priority(self, entry: Dict) -> bool:
+        """Почти готовые задачи (долгие или с push-уведомлением) опрашиваются вне общей очереди"""
+        age = asyncio.get_running_loop().time() - entry["created_at"]
+        return entry.get("poked", False) or age >= POLLER_SLOW_AFTER
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _poll_one(self, task_id: str, entry: Dict):
+        started = time.monotonic()
+        task_status = await get_task_status(task_id, self.is_priority(entry))
+        poll_latency.observe(time.monotonic() - started)
+        entry["polls"] += 1
+        status = task_status.get("status", "running")
+        loop = asyncio.get_running_loop()
+        if status in ("completed", "failed"):
+            self.tasks.pop(task_id, None)
+            meta = self.meta.pop(task_id, None)
+            if status == "completed" and meta:
+                duration = (datetime.now() - meta["started_at"]).total_seconds()
+                duration_model.record(meta["kind"], meta["load"], duration)
+            if not entry["future"].done():
+                entry["future"].set_result(task_status)
+            return
+        entry["next_poll"] = loop.time() + self.interval_for(loop.time() - entry["created_at"])
+        for callback in list(entry["callbacks"]):
+            # Обновления интерфейса не должны задерживать проход опроса
+            asyncio.create_task(callback(task_status))
+
+    async def run(self):
+        """Проходы опроса: не больше POLLER_BATCH_SIZE задач за раз и POLLER_MAX_RPS запросов в секунду"""
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        while True:
+            breaker = get_manus_client().breaker
+            if breaker.state == "open":
+                # Manus недоступен — не опрашиваем до пробного запроса
+                await asyncio.sleep(max(breaker.retry_in(), 0.05))
+                continue
+            now = loop.time()
+            due = sorted(
+                (item for item in self.tasks.items() if item[1]["next_poll"] <= now),
+                key=lambda item: (not self.is_priority(item[1]), item[1]["next_poll"])
+            )[:POLLER_BATCH_SIZE]
+            if due:
+                results = await asyncio.gather(
+                    *[self._poll_one(task_id, entry) for task_id, entry in due],
+                    return_exceptions=True
+                )
+                for (task_id, _), result in zip(due, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Poller error for {task_id}: {result}")
+                await asyncio.sleep(len(due) / POLLER_MAX_RPS)
+                continue
+            # Спим до ближайшего опроса или до появления новой задачи
+            next_poll = min((entry["next_poll"] for entry in self.tasks.values()), default=now + 60)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_poll - now, 0.05))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> asyncio.Task:
+        self._runner = asyncio.create_task(self.run())
+        return self._runner
+
+    def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+
+task_poller = TaskPoller()
+
+# ═══════════════════════════════════════════════════════════════
+# HTTP-СЕРВЕР
+# ═══════════════════════════════════════════════════════════════
+
+def extract_webhook_task_id(payload: Dict[str, Any]) -> Optional[str]:
+    """Достаёт task_id из push-уведомления Manus"""
+    detail = payload.get("task_detail")
+    if isinstance(detail, dict) and detail.get("task_id"):
+        return str(detail["task_id"])
+    if payload.get("task_id"):
+        return str(payload["task_id"])
+    return None
+
+async def handle_manus_webhook(request: web.Request) -> web.Response:
+    """Приём push-уведомлений Manus: будит ожидающий пайплайн без ожидания опроса"""
+    # Без проверки токена любой мог бы тратить бюджет опроса, дёргая задачи в приоритетную очередь
+    token = request.query.get("token", "")
+    if not hmac.compare_digest(token, get_manus_webhook_secret()):
+        logger.warning("Rejected Manus webhook with invalid token")
+        return web.json_response({"error": "forbidden"}, status=403)
+    try:
+        payload = await request.json()
+    except Exception:
+        return web.json_response({"error": "invalid json"}, status=400)
+    if not isinstance(payload, dict):
+        return web.json_response({"error": "invalid payload"}, status=400)
+    
+    task_id = extract_webhook_task_id(payload)
+    if not task_id:
+        return web.json_response({"error": "task_id missing"}, status=400)
+    
+    # Статус и файлы забираем обычным запросом — так push и polling
+    # разбирают один и тот же формат ответа
+    if task_id in task_poller.tasks:
+        logger.info(f"Manus webhook for {task_id}: {payload.get('event_type', 'unknown')}")
+        task_poller.poke(task_id)
+    return web.json_response({"ok": True})
+
+async def handle_health(request: web.Request) -> web.Response:
+    """Liveness: цикл событий отвечает"""
+    return web.json_response({"status": "ok", "uptime": get_uptime()})
+
+def readiness() -> Dict[str, bool]:
+    """Готовность: Telegram отдаёт апдейты (или webhook зарегистрирован), Manus не в аварийном режиме, бот не останавливается"""
+    last_updates = telegram_scheduler.last_updates_at
+    if TELEGRAM_WEBHOOK_URL:
+        telegram_ok = telegram_webhook_active
+    else:
+        telegram_ok = last_updates is not None and time.monotonic() - last_updates < READY_MAX_POLL_AGE
+    return {
+        "telegram": telegram_ok,
+        "manus": manus_client is not None and manus_client.breaker.state != "open",
+        "accepting": not shutdown_event.is_set()
+    }
+
+async def handle_ready(request: web.Request) -> web.Response:
+    checks = readiness()
+    ready = all(checks.values())
+    return web.json_response({"status": "ready" if ready else "not ready", **checks}, status=200 if ready else 503)
+
+def render_metrics() -> str:
+    """Метрики в текстовом формате Prometheus"""
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples: List[Tuple[str, float]]):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{labels} {value}")
+
+    def summary(name: str, help_text: str, latency: LatencyStats):
+        metric(name, "summary", help_text,
+               [(f'{{quantile="{q}"}}', round(latency.quantile(q), 3)) for q in (0.5, 0.9, 0.99)])
+        lines.append(f"{name}_sum {round(latency.total, 3)}")
+        lines.append(f"{name}_count {latency.count}")
+
+    metric("jarvis_up", "gauge", "Bot process is running", [("", 1)])
+    metric("jarvis_ready", "gauge", "Readiness checks", [(f'{{check="{name}"}}', int(ok)) for name, ok in readiness().items()])
+    metric("jarvis_queue_depth", "gauge", "Jobs waiting for a worker", [("", len(pending_jobs))])
+    metric("jarvis_active_jobs", "gauge", "Jobs being processed", [("", len(active_tasks))])
+    metric("jarvis_manus_inflight_tasks", "gauge", "Manus tasks being polled", [("", len(task_poller.tasks))])
+    metric("jarvis_requests_total", "counter", "Presale requests received", [("", stats["requests_today"])])
+    metric("jarvis_successful_total", "counter", "Completed analyses and packages", [("", stats["successful"])])
+    metric("jarvis_errors_total", "counter", "Failed jobs and Manus tasks", [("", stats["errors"])])
+    metric("jarvis_files_sent_total", "counter", "Files delivered to Telegram", [("", stats["files_sent"])])
+    summary("jarvis_manus_poll_latency_seconds", "Manus task status request latency", poll_latency)
+    summary("jarvis_delivery_latency_seconds", "Time from task completion to file delivered", delivery_latency)
+
+    breaker_state = manus_client.breaker.state if manus_client is not None else "closed"
+    metric("jarvis_manus_breaker_state", "gauge", "Manus circuit breaker state",
+           [(f'{{state="{state}"}}', int(state == breaker_state)) for state in ("closed", "half_open", "open")])
+    budget = manus_rate_limiter.snapshot()
+    metric("jarvis_manus_requests_total", "counter", "Manus API requests by budget",
+           [(f'{{kind="{kind}"}}', counter["requests"]) for kind, counter in budget.items()])
+    metric("jarvis_manus_throttled_total", "counter", "Manus API requests delayed by the rate limiter",
+           [(f'{{kind="{kind}"}}', counter["throttled"]) for kind, counter in budget.items()])
+    metric("jarvis_telegram_requests_total", "counter", "Outgoing Telegram requests to chats",
+           [('{lane="interactive"}', telegram_scheduler.counters["interactive"]),
+            ('{lane="bulk"}', telegram_scheduler.counters["bulk"])])
+    metric("jarvis_telegram_retry_after_total", "counter", "Telegram flood control responses",
+           [("", telegram_scheduler.counters["retry_after"])])
+    metric("jarvis_progress_edits_total", "counter", "Progress message edit requests by outcome",
+           [(f'{{result="{name}"}}', value) for name, value in progress_renderer.counters.items()])
+    durations = duration_model.snapshot()
+    metric("jarvis_task_duration_seconds", "gauge", "Manus task duration percentiles by kind",
+           [(f'{{kind="{key}",quantile="{q}"}}', values[f"p{int(q * 100)}"])
+            for key, values in durations.items() if "|" not in key for q in (0.5, 0.9)])
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+def create_web_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/ready", handle_ready)
+    app.router.add_get("/metrics", handle_metrics)
+    if MANUS_WEBHOOK_URL:
+        app.router.add_post(MANUS_WEBHOOK_PATH, handle_manus_webhook)
+    if TELEGRAM_WEBHOOK_URL:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=get_telegram_webhook_secret()).register(
+            app, path=TELEGRAM_WEBHOOK_PATH
+        )
+    return app
+
+async def start_web_server(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEB_HOST, WEB_PORT).start()
+    logger.info(f"HTTP server listening on {WEB_HOST}:{WEB_PORT}")
+    return runner
+
+# Webhook Telegram зарегистрирован и апдейты приходят на этот сервер
+telegram_webhook_active = False
+
+def get_telegram_webhook_secret() -> str:
+    """Секрет заголовка X-Telegram-Bot-Api-Secret-Token; без явного значения одинаков у всех реплик"""
+    return TELEGRAM_WEBHOOK_SECRET or hashlib.sha256(TELEGRAM_BOT_TOKEN.encode()).hexdigest()
+
+async def run_telegram_webhook():
+    """Приём апдейтов через webhook до сигнала остановки.
+    При остановке webhook не удаляется: апдейты продолжают получать другие реплики."""
+    global telegram_webhook_active
+    url = TELEGRAM_WEBHOOK_URL.rstrip("/") + TELEGRAM_WEBHOOK_PATH
+    await dp.emit_startup(bot=bot)
+    try:
+        await bot.set_webhook(
+            url,
+            secret_token=get_telegram_webhook_secret(),
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        telegram_webhook_active = True
+        logger.info(f"Telegram webhook set to {url}")
+        await shutdown_event.wait()
+    finally:
+        telegram_webhook_active = False
+        await dp.emit_shutdown(bot=bot)
+
+def get_manus_webhook_url() -> str:
+    return MANUS_WEBHOOK_URL.rstrip("/") + MANUS_WEBHOOK_PATH + f"?token={get_manus_webhook_secret()}"
+
+def get_manus_webhook_secret() -> str:
+    """Токен адреса push-уведомлений Manus; без явного значения выводится из ключа API (одинаков у всех реплик)"""
+    return MANUS_WEBHOOK_SECRET or hashlib.sha256(f"manus-webhook:{MANUS_API_KEY or ''}".encode()).hexdigest()
+
 # ═══════════════════════════════════════════════════════════════
 # ОБРАБОТЧИКИ КОМАНД
 # ═══════════════════════════════════════════════════════════════
@@ -2033,6 +4078,7 @@ async def cmd_status(message: Message):
 
 @router.message(Command("cancel"))
 async def cmd_cancel(message: Message, state: FSMContext):
+    await cancel_user_jobs(message.from_user.id, message.chat.id)
     await state.clear()
     await message.answer("❌ Операция отменена.\n\nИспользуйте меню для навигации.", reply_markup=get_main_keyboard())
 
@@ -2083,6 +4129,11 @@ async def btn_help(message: Message):
 
 @router.callback_query(F.data == "cancel")
 async def callback_cancel(callback: CallbackQuery, state: FSMContext):
+    # Выход из ввода или выбора не трогает задания, запущенные раньше; всё сразу отменяет /cancel
+    if await state.get_state() in (PresaleStates.processing.state, PresaleStates.generating_docs.state):
+        job_id = (await state.get_data()).get("job_id")
+        if job_id:
+            await cancel_user_jobs(callback.from_user.id, callback.message.chat.id, job_id)
     await state.clear()
     await callback.message.edit_text("❌ Операция отменена.")
     await callback.message.answer("Используйте меню для навигации.", reply_markup=get_main_keyboard())
@@ -2197,7 +4248,7 @@ async def callback_refresh_status(callback: CallbackQuery):
     await callback.message.edit_text(msg_status(callback.from_user.id), reply_markup=get_status_keyboard())
     await callback.answer("✅ Статус обновлен")
 
-@router.callback_query(F.data.startswith("goal_"))
+@router.callback_query(F.data.startswith("goal_"), flags={"idempotent": "goal"})
 async def callback_select_goal(callback: CallbackQuery, state: FSMContext):
     goal_map = {
         "goal_intro": "Вводная/квалификация",
@@ -2210,7 +4261,7 @@ async def callback_select_goal(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     
     # Запускаем процесс генерации пресейл-пакета
-    await process_presale(callback.message, state, callback.from_user.id)
+    await submit_presale(callback.message, state, callback.from_user.id)
 
 # ═══════════════════════════════════════════════════════════════
 # ОБРАБОТЧИКИ СОСТОЯНИЙ
@@ -2233,7 +4284,7 @@ async def handle_url(message: Message, state: FSMContext):
     if settings.get("quick_mode") and settings.get("default_goal"):
         await state.update_data(goal=settings["default_goal"], constraints="-")
         await message.answer(f"✅ URL: {domain}\n✅ Цель: {settings['default_goal']}")
-        await process_presale(message, state, message.from_user.id)
+        await submit_presale(message, state, message.from_user.id)
     else:
         await state.set_state(PresaleStates.waiting_for_goal)
         await message.answer(msg_url_accepted(domain), reply_markup=get_goals_keyboard())
@@ -2242,7 +4293,542 @@ async def handle_url(message: Message, state: FSMContext):
 async def handle_constraints(message: Message, state: FSMContext):
     constraints = message.text.strip()
     await state.update_data(constraints=constraints)
-    await process_presale(message, state, message.from_user.id)
+    await submit_presale(message, state, message.from_user.id)
+
+# ═══════════════════════════════════════════════════════════════
+# ОСТАНОВКА БОТА
+# ═══════════════════════════════════════════════════════════════
+
+# Получен SIGTERM/SIGINT: бот дорабатывает начатое и передаёт остальное следующему процессу
+shutdown_event = asyncio.Event()
+
+class DrainGuard:
+    """Участки конвейера, которые при остановке не прерываются: создание задачи в Manus
+    и выдача готового результата — от обнаружения завершения до отправки последнего файла"""
+
+    def __init__(self):
+        self.active = 0
+
+    def __enter__(self):
+        self.active += 1
+
+    def __exit__(self, *exc):
+        self.active -= 1
+
+drain_guard = DrainGuard()
+
+def begin_shutdown():
+    """Перестаём принимать апдейты и новые задания; сам выход — в finally у main()"""
+    if shutdown_event.is_set():
+        return
+    logger.info("Shutdown requested, draining in-flight work")
+    shutdown_event.set()
+    if not TELEGRAM_WEBHOOK_URL:
+        asyncio.create_task(stop_polling())
+
+async def stop_polling():
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        # Polling ещё не запущен или уже остановлен
+        pass
+
+def install_signal_handlers():
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, begin_shutdown)
+        except NotImplementedError:
+            # Windows: остаётся KeyboardInterrupt
+            pass
+
+async def reject_if_shutting_down(message: Message) -> bool:
+    """Во время остановки новые задания не ставятся: их примет следующий процесс"""
+    if not shutdown_event.is_set():
+        return False
+    await message.answer("🔄 Бот перезапускается. Повторите запрос через минуту — введённые данные сохранены.")
+    return True
+
+async def drain_pipelines(pipelines: List[asyncio.Task]):
+    """Ждёт, пока конвейеры завершат создание задач и отправку файлов (не дольше DRAIN_TIMEOUT),
+    остальные прерывает: их задачи Manus сохранены в хранилище и продолжатся в следующем процессе"""
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while time.monotonic() < deadline:
+        running = [task for task in pipelines if not task.done()]
+        if not running or not drain_guard.active:
+            break
+        await asyncio.sleep(0.2)
+    running = [task for task in pipelines if not task.done()]
+    if drain_guard.active:
+        logger.warning(f"Drain deadline reached with {drain_guard.active} deliveries still running")
+    for task in running:
+        task.cancel()
+    await asyncio.gather(*running, return_exceptions=True)
+    handed_over = sorted({record["task_id"] for record in (await state_backend.items("inflight:")).values()
+                          if record.get("task_id") and "delivered" not in record})
+    logger.info(f"Drained: {len(pipelines) - len(running)} pipelines finished, {len(running)} handed over"
+                + (f" (Manus tasks: {', '.join(handed_over)})" if handed_over else ""))
+
+# ═══════════════════════════════════════════════════════════════
+# ПЛАНИРОВЩИК ЗАДАНИЙ
+# ═══════════════════════════════════════════════════════════════
+
+# Полосы очереди: досье и отдельные документы не ждут за пакетами документов
+LANE_PRIORITY = 0
+LANE_BULK = 1
+
+def job_lane(kind: str, docs: int = 0) -> int:
+    return LANE_BULK if kind == "documents" and docs > PRIORITY_MAX_DOCS else LANE_PRIORITY
+
+class FairScheduler:
+    """Взвешенная справедливая очередь (start-time fair queuing).
+    Задание пользователя стартует в виртуальное время max(окончание его прошлого задания, часы очереди)
+    и сдвигает окончание на ожидаемую длительность, делённую на вес: пользователь с пачкой пакетов
+    не задерживает остальных. Приоритетная полоса идёт первой; пакет, прождавший QUEUE_AGING_SECONDS,
+    переходит в неё, поэтому ожидание ограничено для всех."""
+
+    def __init__(self):
+        self.finish: Dict[int, float] = {}  # user_id -> виртуальное окончание последнего запущенного задания
+        self.clock = 0.0  # Виртуальное время старта последнего запущенного задания
+
+    def lane(self, job: Dict, now: datetime) -> int:
+        if (now - job["enqueued_at"]).total_seconds() >= QUEUE_AGING_SECONDS:
+            return LANE_PRIORITY
+        return job.get("lane", LANE_PRIORITY)
+
+    def cost(self, job: Dict) -> float:
+        return duration_model.estimate(f"job:{job['kind']}")[0] / user_weight(job["user_id"])
+
+    def _next(self, jobs: List[Dict], finish: Dict[int, float], clock: float, now: datetime) -> Tuple[Dict, float]:
+        """Следующее задание и его виртуальный старт; окончание пользователя сдвигается в finish"""
+        def start(job: Dict) -> float:
+            return max(finish.get(job["user_id"], clock), clock)
+        job = min(jobs, key=lambda job: (self.lane(job, now), start(job), job["enqueued_at"]))
+        begin = start(job)
+        finish[job["user_id"]] = begin + self.cost(job)
+        return job, begin
+
+    def select(self, jobs: List[Dict], running: Dict[int, int]) -> Optional[Dict]:
+        """Задание, которое пора запустить; пользователи на лимите USER_MAX_ACTIVE_JOBS пропускаются"""
+        eligible = [job for job in jobs if running.get(job["user_id"], 0) < USER_MAX_ACTIVE_JOBS]
+        if not eligible:
+            return None
+        return self._next(eligible, dict(self.finish), self.clock, datetime.now())[0]
+
+    def charge(self, job: Dict):
+        """Учитывает запуск задания, выбранного select"""
+        _, self.clock = self._next([job], self.finish, self.clock, datetime.now())
+
+    def order(self, jobs: List[Dict]) -> List[Dict]:
+        """Ожидаемый порядок запуска (без учёта лимитов) — для позиции в очереди и оценки ожидания"""
+        now = datetime.now()
+        finish, clock = dict(self.finish), self.clock
+        rest, ordered = list(jobs), []
+        while rest:
+            job, clock = self._next(rest, finish, clock, now)
+            rest.remove(job)
+            ordered.append(job)
+        return ordered
+
+fair_scheduler = FairScheduler()
+
+async def running_jobs_per_user() -> Dict[int, int]:
+    """Сколько заданий из очереди сейчас выполняется у каждого пользователя (на всех репликах)"""
+    running: Dict[int, int] = {}
+    if SHARED_STATE:
+        now = time.time()
+        for key, lease in (await state_backend.items("lease:job:")).items():
+            if lease["expires"] > now:
+                user_id = int(key.split(":")[2])
+                running[user_id] = running.get(user_id, 0) + 1
+        return running
+    for info in active_tasks.values():
+        if info.get("worker") is not None:
+            running[info["user_id"]] = running.get(info["user_id"], 0) + 1
+    return running
+
+def daily_quota(user_id: int) -> int:
+    return max(1, round(USER_DAILY_QUOTA * user_weight(user_id)))
+
+def quota_left(user_id: int) -> Optional[int]:
+    """Сколько заданий пользователь ещё может поставить сегодня; None — без лимита"""
+    if not USER_DAILY_QUOTA:
+        return None
+    usage = user_quota.get(user_id)
+    used = usage["jobs"] if usage and usage["date"] == datetime.now().strftime("%Y-%m-%d") else 0
+    return max(daily_quota(user_id) - used, 0)
+
+def spend_quota(user_id: int) -> str:
+    """Списывает задание из квоты при постановке в очередь; возвращает день списания"""
+    today = datetime.now().strftime("%Y-%m-%d")
+    usage = user_quota.get(user_id)
+    if not usage or usage["date"] != today:
+        usage = user_quota[user_id] = {"date": today, "jobs": 0}
+    usage["jobs"] += 1
+    return today
+
+def refund_quota(job: Dict):
+    """Возвращает в квоту задание, не давшее результата (отменено, не создана задача, Manus не справился).
+    job — задание или его запись в очереди; возврат не больше одного раза и только в день списания"""
+    date = job.pop("quota_date", None)
+    usage = user_quota.get(job["user_id"])
+    if date and usage and usage["date"] == date and usage["jobs"] > 0:
+        usage["jobs"] -= 1
+
+def refund_current_job():
+    """Возврат квоты за задание, в котором выполняется текущий конвейер"""
+    info = active_tasks.get(current_job_id.get())
+    if info is not None:
+        refund_quota(info["job"])
+
+async def reject_if_over_quota(message: Message, user_id: int) -> bool:
+    if quota_left(user_id) != 0:
+        return False
+    logger.info(f"User {user_id} reached daily quota of {daily_quota(user_id)} jobs")
+    await message.answer(msg_quota_exceeded(daily_quota(user_id)), reply_markup=get_main_keyboard())
+    return True
+
+def get_queue_position(job_id: str) -> int:
+    """Позиция задания в очереди (1 — следующее), 0 — если уже не в очереди"""
+    for idx, job in enumerate(fair_scheduler.order(pending_jobs), 1):
+        if job["job_id"] == job_id:
+            return idx
+    return 0
+
+def estimate_queue_wait(position: int) -> float:
+    """Сколько ждать старта задания на позиции position: слоты воркеров освобождаются
+    по медианной длительности выполняющихся и стоящих впереди заданий"""
+    now = datetime.now()
+    slots = []
+    for info in active_tasks.values():
+        if info.get("worker") is None:
+            continue
+        elapsed = (now - info["started_at"]).total_seconds()
+        slots.append(max(duration_model.estimate(f"job:{info['kind']}")[0] - elapsed, 0))
+    slots.extend([0.0] * max(MAX_CONCURRENT_TASKS - len(slots), 0))
+    heapq.heapify(slots)
+    for job in fair_scheduler.order(pending_jobs)[:max(position - 1, 0)]:
+        free_at = heapq.heappop(slots)
+        heapq.heappush(slots, free_at + duration_model.estimate(f"job:{job['kind']}")[0])
+    return slots[0]
+
+async def enqueue_job(user_id: int, kind: str, run: Callable[[], Awaitable[None]], message: Message,
+                      lane: int = LANE_PRIORITY) -> Dict:
+    """Ставит задание в очередь и сообщает пользователю позицию"""
+    job = {
+        "job_id": f"{kind}-{user_id}-{int(datetime.now().timestamp() * 1000)}",
+        "user_id": user_id,
+        "kind": kind,
+        "lane": lane,
+        "run": run,
+        "message": message,
+        "enqueued_at": datetime.now(),
+        "queue_msg": None
+    }
+    job["quota_date"] = spend_quota(user_id)
+    pending_jobs.append(job)
+    if SHARED_STATE:
+        queued = [queued_job(record) for record in (await state_backend.items("queue:")).values()]
+        position = fair_scheduler.order(queued + [job]).index(job) + 1
+    else:
+        position = get_queue_position(job["job_id"])
+    # Сообщаем о позиции только если все слоты заняты или у пользователя уже максимум заданий в работе
+    at_limit = (await running_jobs_per_user()).get(user_id, 0) >= USER_MAX_ACTIVE_JOBS
+    if at_limit or len(active_tasks) + position > MAX_CONCURRENT_TASKS:
+        job["queue_msg"] = await message.answer(msg_queued(position, estimate_queue_wait(position)))
+    await journal.append(event="queued", **job_record(job))
+    await push_job(job)
+    logger.info(f"Job {job['job_id']} queued at position {position}")
+    return job
+
+def job_record(job: Dict) -> Dict:
+    """Задание без замыканий — для общей очереди и журнала"""
+    return {
+        "job_id": job["job_id"], "user_id": job["user_id"], "kind": job["kind"], "lane": job["lane"],
+        "chat_id": job["message"].chat.id, "enqueued_at": job["enqueued_at"].isoformat(),
+        "queue_msg_id": job["queue_msg"].message_id if job.get("queue_msg") else None,
+        "quota_date": job.get("quota_date")
+    }
+
+async def push_job(job: Dict):
+    if SHARED_STATE:
+        # Общая очередь: задание заберёт первый свободный воркер любой реплики
+        await state_backend.set(f"queue:{int(job['enqueued_at'].timestamp() * 1000):015d}:{job['job_id']}", job_record(job))
+    else:
+        queue_changed.set()
+
+def queued_job(record: Dict, key: Optional[str] = None) -> Dict:
+    """Запись общей очереди в виде, понятном fair_scheduler"""
+    return {**record, "enqueued_at": datetime.fromisoformat(record["enqueued_at"]), "queue_key": key}
+
+def job_from_record(record: Dict) -> Dict:
+    """Задание из общей очереди; поставленное другой репликой собирается по типу и чату"""
+    local = next((job for job in pending_jobs if job["job_id"] == record["job_id"]), None)
+    if local is not None:
+        return local
+    runner = {"presale": process_presale, "documents": process_selected_documents}[record["kind"]]
+    message = chat_message(record["chat_id"])
+    state = chat_state(record["chat_id"], record["user_id"])
+    return {
+        "job_id": record["job_id"],
+        "user_id": record["user_id"],
+        "kind": record["kind"],
+        "lane": record.get("lane", LANE_PRIORITY),
+        "run": lambda: runner(message, state, record["user_id"]),
+        "message": message,
+        "enqueued_at": datetime.fromisoformat(record["enqueued_at"]),
+        "queue_msg": chat_message(record["chat_id"], record["queue_msg_id"]) if record.get("queue_msg_id") else None,
+        "quota_date": record.get("quota_date")
+    }
+
+async def next_job() -> Dict:
+    """Следующее задание по справедливой очереди: из локальной или из общей (забирает ровно одна реплика)"""
+    while True:
+        running = await running_jobs_per_user()
+        if not SHARED_STATE:
+            job = fair_scheduler.select(pending_jobs, running)
+            if job is not None:
+                fair_scheduler.charge(job)
+                pending_jobs.remove(job)
+                return job
+            queue_changed.clear()
+            await queue_changed.wait()
+            continue
+        queued = [queued_job(record, key) for key, record in (await state_backend.items("queue:")).items()]
+        candidate = fair_scheduler.select(queued, running)
+        if candidate is None:
+            await asyncio.sleep(QUEUE_POLL_INTERVAL)
+            continue
+        record = await state_backend.take(candidate["queue_key"])
+        if record is not None:
+            fair_scheduler.charge(candidate)
+            return job_from_record(record)
+
+async def notify_queue_positions():
+    """Обновляет позицию в очереди у ожидающих пользователей"""
+    if SHARED_STATE:
+        # Позиция — в общей очереди; задания, которые уже забрали другие реплики, больше не ждут
+        queued = [job["job_id"] for job in fair_scheduler.order(
+            [queued_job(record) for record in (await state_backend.items("queue:")).values()])]
+        pending_jobs[:] = [job for job in pending_jobs if job["job_id"] in queued]
+        positions = [(queued.index(job["job_id"]) + 1, job) for job in pending_jobs]
+    else:
+        positions = list(enumerate(fair_scheduler.order(pending_jobs), 1))
+    for position, job in positions:
+        if job.get("queue_msg"):
+            try:
+                await job["queue_msg"].edit_text(msg_queued(position, estimate_queue_wait(position)))
+            except Exception:
+                pass
+
+async def record_job_event(job_id: str, event: str, **fields):
+    """Запись в журнал из цикла воркера: сбой журнала не должен останавливать воркер"""
+    try:
+        await journal.append(job_id, event, **fields)
+    except Exception as e:
+        logger.error(f"Journal write for {job_id} ({event}) failed: {e}")
+
+async def job_worker(worker_id: int):
+    """Воркер: берёт задания из очереди и выполняет их по одному"""
+    while not shutdown_event.is_set():
+        # Пока Manus недоступен, новые задания ждут в очереди
+        await get_manus_client().breaker.wait_available()
+        try:
+            job = await next_job()
+        except Exception as e:
+            # Испорченная запись очереди не должна останавливать весь пул воркеров
+            logger.exception(f"Worker {worker_id} failed to take a job: {e}")
+            await asyncio.sleep(QUEUE_POLL_INTERVAL)
+            continue
+        if shutdown_event.is_set():
+            # Взято в момент остановки: из общей очереди возвращаем, локальное задание вернёт журнал
+            if SHARED_STATE:
+                await push_job(job)
+            break
+        if job.get("cancelled"):
+            # Отменено, пока ждало в очереди
+            continue
+        if job in pending_jobs:
+            pending_jobs.remove(job)
+        job_id = job["job_id"]
+        active_tasks[job_id] = {
+            "user_id": job["user_id"],
+            "kind": job["kind"],
+            "started_at": datetime.now(),
+            "worker": worker_id,
+            "job": job
+        }
+        logger.info(f"Worker {worker_id} started job {job_id}")
+        if job.get("queue_msg"):
+            try:
+                await job["queue_msg"].delete()
+            except Exception:
+                pass
+        try:
+            await notify_queue_positions()
+        except Exception as e:
+            logger.error(f"Queue position update failed: {e}")
+        await record_job_event(event="started", **job_record(job))
+        # Задание выполняется отдельной задачей, чтобы его можно было отменить, не останавливая воркер;
+        # шаги конвейера попадают в журнал под id задания
+        current_job_id.set(job_id)
+        job["task"] = asyncio.create_task(job["run"]())
+        if SHARED_STATE:
+            # Аренда задания — по ним реплики считают задания пользователя в работе
+            await acquire_lease(f"job:{job['user_id']}:{job_id}", job["task"])
+        load = current_load()
+        try:
+            await job["task"]
+            # Длительность задания целиком (вместе с доставкой) — для оценки ожидания в очереди
+            duration_model.record(f"job:{job['kind']}", load, (datetime.now() - active_tasks[job_id]["started_at"]).total_seconds())
+            await record_job_event(job_id, "finished")
+        except asyncio.CancelledError:
+            if not job.get("cancelled"):
+                # Остановка бота: задание остаётся в журнале незавершённым и продолжится после запуска
+                job["task"].cancel()
+                raise
+            logger.info(f"Job {job_id} cancelled")
+            await record_job_event(job_id, "cancelled")
+        except Exception as e:
+            stats["errors"] += 1
+            logger.exception(f"Job {job_id} failed: {e}")
+            refund_quota(job)
+            await record_job_event(job_id, "finished", error=str(e))
+            try:
+                await forget_pipeline(job_id=job_id)
+            except Exception as forget_error:
+                logger.error(f"Cleanup of failed job {job_id} failed: {forget_error}")
+            try:
+                await job["message"].answer(msg_error("Внутренняя ошибка задачи"), reply_markup=get_main_keyboard())
+            except Exception:
+                pass
+        finally:
+            active_tasks.pop(job_id, None)
+            if SHARED_STATE:
+                await release_lease(f"job:{job['user_id']}:{job_id}")
+            # Слот пользователя освободился — его следующее задание может стартовать
+            queue_changed.set()
+
+def track_background_job(user_id: int, kind: str, task: asyncio.Task, job_id: Optional[str] = None) -> Dict:
+    """Учитывает задание вне очереди (например, подхваченное после перезапуска), чтобы его можно было отменить"""
+    job_id = job_id or f"{kind}-{user_id}-{int(datetime.now().timestamp() * 1000)}-{id(task)}"
+    job = {"job_id": job_id, "user_id": user_id, "kind": kind, "task": task}
+    active_tasks[job_id] = {"user_id": user_id, "kind": kind, "started_at": datetime.now(), "worker": None, "job": job}
+    task.add_done_callback(lambda _: active_tasks.pop(job_id, None))
+    return job
+
+async def cancel_user_jobs(user_id: int, chat_id: int, job_id: Optional[str] = None) -> int:
+    """Отменяет задания пользователя: в очереди, выполняющиеся и их задачи в Manus.
+    С job_id — только это задание (кнопка «Отмена» в сценарии), без него — все (/cancel)."""
+    def selected(record: Dict) -> bool:
+        return record.get("user_id") == user_id and (job_id is None or record.get("job_id") == job_id)
+
+    cancelled = 0
+    if SHARED_STATE:
+        # Задания пользователя в общей очереди, в том числе поставленные через другие реплики
+        local_ids = {job["job_id"] for job in pending_jobs}
+        for key, record in (await state_backend.items("queue:")).items():
+            if not selected(record):
+                continue
+            if await state_backend.take(key) is None or record["job_id"] in local_ids:
+                continue
+            await journal.append(record["job_id"], "cancelled")
+            refund_quota(record)
+            cancelled += 1
+            if record.get("queue_msg_id"):
+                try:
+                    await chat_message(record["chat_id"], record["queue_msg_id"]).delete()
+                except Exception:
+                    pass
+    for job in [job for job in pending_jobs if selected(job)]:
+        job["cancelled"] = True
+        pending_jobs.remove(job)
+        await journal.append(job["job_id"], "cancelled")
+        refund_quota(job)
+        cancelled += 1
+        if job.get("queue_msg"):
+            try:
+                await job["queue_msg"].delete()
+            except Exception:
+                pass
+    
+    # Отмена пайплайна снимает его с опроса и освобождает слоты воркера и генерации документов
+    running = [info["job"] for info in active_tasks.values() if selected(info["job"]) and info["job"].get("task") and not info["job"]["task"].done()]
+    for job in running:
+        job["cancelled"] = True
+        refund_quota(job)
+        job["task"].cancel()
+    if running:
+        await asyncio.wait([job["task"] for job in running], timeout=10)
+    cancelled += len(running)
+    
+    # Задачи Manus останавливаем, только если их не ждут другие чаты
+    records = await state_backend.items("inflight:")
+    mine = {key: record for key, record in records.items() if record.get("chat_id") == chat_id and selected(record)}
+    still_needed = {record.get("task_id") for key, record in records.items() if key not in mine}
+    cancelled_ids = set()
+    for key, record in mine.items():
+        await state_backend.delete(key)
+        task_id = record.get("task_id")
+        if not task_id or "delivered" in record:
+            continue
+        cancelled_ids.add(task_id)
+        if task_id not in still_needed:
+            await get_manus_client().stop_task(task_id)
+            for request_key, future in list(running_requests.items()):
+                if future.done() and future.result() == task_id:
+                    running_requests.pop(request_key, None)
+    for task_info in get_user_tasks(user_id):
+        if task_info.get("task_id") in cancelled_ids and task_info.get("status") == "running":
+            task_info["status"] = "cancelled"
+    
+    if cancelled:
+        logger.info(f"Cancelled {cancelled} jobs and {len(cancelled_ids)} Manus tasks of user {user_id}")
+        await notify_queue_positions()
+    return cancelled
+
+def start_job_workers() -> List[asyncio.Task]:
+    """Запускает пул из MAX_CONCURRENT_TASKS воркеров"""
+    return [asyncio.create_task(job_worker(i)) for i in range(1, MAX_CONCURRENT_TASKS + 1)]
+
+async def offer_cached_result(message: Message, state: FSMContext, stage: str, docs: List[str]) -> bool:
+    """Если такой запрос уже выполнялся, предлагает готовые документы вместо новой задачи"""
+    data = await state.get_data()
+    cache_key = get_cache_key(data.get("domain"), data.get("goal"), data.get("constraints", "-"), docs)
+    cached = get_cached_result(cache_key)
+    if not cached:
+        return False
+    await state.set_state(PresaleStates.choosing_cache)
+    await state.update_data(cache_stage=stage)
+    await message.answer(msg_cache_found(data.get("domain", ""), cached), reply_markup=get_cache_keyboard(cache_key))
+    return True
+
+async def submit_presale(message: Message, state: FSMContext, user_id: int, check_cache: bool = True):
+    """Ставит Этап 1 в очередь, не блокируя обработчик"""
+    if await reject_if_shutting_down(message):
+        return
+    if check_cache and await offer_cached_result(message, state, "presale", ["dossier"]):
+        return
+    if await reject_if_over_quota(message, user_id):
+        return
+    await state.set_state(PresaleStates.processing)
+    job = await enqueue_job(user_id, "presale", lambda: process_presale(message, state, user_id), message)
+    # Кнопка «Отмена» этого сценария отменяет только это задание
+    await state.update_data(job_id=job["job_id"])
+
+async def submit_selected_documents(message: Message, state: FSMContext, user_id: int, check_cache: bool = True):
+    """Ставит Этап 3 в очередь, не блокируя обработчик"""
+    if await reject_if_shutting_down(message):
+        return
+    data = await state.get_data()
+    if check_cache and await offer_cached_result(message, state, "documents", data.get("selected_docs", [])):
+        return
+    if await reject_if_over_quota(message, user_id):
+        return
+    await state.set_state(PresaleStates.generating_docs)
+    job = await enqueue_job(user_id, "documents", lambda: process_selected_documents(message, state, user_id), message,
+                            lane=job_lane("documents", len(data.get("selected_docs", []))))
+    await state.update_data(job_id=job["job_id"])
 
 # ═══════════════════════════════════════════════════════════════
 # ОСНОВНАЯ ЛОГИКА ПРЕСЕЙЛА
@@ -2259,104 +4845,196 @@ async def process_presale(message: Message, state: FSMContext, user_id: int):
     status_msg = await message.answer(msg_processing_start())
     start_time = datetime.now()
     
-    task_id = await create_manus_task(url, goal, constraints)
+    # Такой же анализ уже выполняется — ждём его результата вместо новой задачи
+    request_key = get_cache_key(domain, goal, constraints, ["dossier"])
+    task_id, joined = await start_or_join_task(request_key, lambda: create_manus_task(url, goal, constraints))
+    if joined:
+        logger.info(f"Presale for {domain} joined running task {task_id}")
+        await message.answer(f"🔗 Анализ {domain} с теми же параметрами уже выполняется — вы получите тот же результат.")
     
     if not task_id:
         stats["errors"] += 1
+        refund_current_job()
         add_user_task(user_id, {"domain": domain, "goal": goal, "status": "error", "date": datetime.now().strftime("%d.%m.%Y %H:%M")})
-        await status_msg.edit_text(msg_error("Не удалось создать задачу в Manus"))
+        await progress_renderer.finish(status_msg, msg_error("Не удалось создать задачу в Manus"))
         await state.clear()
         await message.answer("Используйте меню для повторной попытки.", reply_markup=get_main_keyboard())
         return
     
+    load = current_load()
+    task_poller.describe(task_id, "dossier", start_time, load)
     task_info = {"task_id": task_id, "domain": domain, "goal": goal, "status": "running", "date": datetime.now().strftime("%d.%m.%Y %H:%M")}
     add_user_task(user_id, task_info)
+    record = {
+        "kind": "presale", "user_id": user_id, "chat_id": message.chat.id,
+        "created_at": start_time.isoformat(), "load": load, "data": data, "job_id": current_job_id.get()
+    }
+    # Аренда до записи в работе: другие реплики не подхватят конвейер, пока он жив здесь
+    unit = inflight_unit({**record, "task_id": task_id})
+    await acquire_lease(unit)
+    await remember_inflight(task_id, record)
+    await journal_step("task_created", task_id=task_id, chat_id=message.chat.id)
     
-    iteration = 0
-    stages = ["Анализ компании", "Сбор данных", "Генерация документов", "Финализация"]
+    try:
+        await finish_presale(message, state, user_id, task_id, task_info, start_time, status_msg, TASK_TIMEOUT)
+    finally:
+        progress_renderer.discard(status_msg)
+        await release_lease(unit)
+
+async def finish_presale(message: Message, state: FSMContext, user_id: int, task_id: str, task_info: Dict,
+                         start_time: datetime, status_msg: Message, timeout: int,
+                         artifacts: Optional[List[Dict]] = None):
+    """Ожидание задачи Этапа 1 и выдача досье (в том числе после перезапуска бота).
+    artifacts — результат задачи, завершившейся до перезапуска: тогда Manus не опрашивается."""
+    data = await state.get_data()
+    domain = data.get("domain")
+    goal = data.get("goal")
+    constraints = data.get("constraints", "-")
+    request_key = get_cache_key(domain, goal, constraints, ["dossier"])
     
-    while True:
-        elapsed = datetime.now() - start_time
-        elapsed_sec = int(elapsed.total_seconds())
-        elapsed_min = elapsed_sec // 60
-        elapsed_sec_display = elapsed_sec % 60
-        
-        if elapsed_sec > TASK_TIMEOUT:
-            stats["errors"] += 1
-            task_info["status"] = "error"
-            await status_msg.edit_text(msg_error("Превышено время ожидания"))
-            await state.clear()
-            await message.answer("Используйте меню для повторной попытки.", reply_markup=get_main_keyboard())
-            return
-        
-        task_status = await get_task_status(task_id)
-        status = task_status.get("status", "running")
-        
-        if status == "completed":
-            break
-        elif status == "failed":
-            stats["errors"] += 1
-            task_info["status"] = "error"
-            await status_msg.edit_text(msg_error("Задача завершилась с ошибкой"))
-            await state.clear()
-            await message.answer("Используйте меню для повторной попытки.", reply_markup=get_main_keyboard())
-            return
-        
-        iteration += 1
-        stage_idx = min(iteration // 10, len(stages) - 1)
-        percent = min(iteration * 3, 95)
-        
+    async def on_poll(task_status: Dict[str, Any]):
+        elapsed_sec = int((datetime.now() - start_time).total_seconds())
+        # Процент и остаток — по реальным длительностям прошлых досье
+        percent, remaining = task_poller.progress(task_id) or duration_model.progress("dossier", None, elapsed_sec)
+        stage = get_current_stage(percent)["name"]
+        progress_renderer.update(status_msg, msg_processing_progress(elapsed_sec // 60, elapsed_sec % 60, stage, percent, remaining))
+    
+    if artifacts is not None:
+        release_running_task(request_key, task_id)
+        task_status = {"status": "completed"}
+    else:
         try:
-            await status_msg.edit_text(msg_processing_progress(elapsed_min, elapsed_sec_display, stages[stage_idx], percent))
-        except:
-            pass
-        
-        await asyncio.sleep(POLLING_INTERVAL)
+            task_status = await task_poller.wait(task_id, timeout, on_poll)
+        finally:
+            release_running_task(request_key, task_id)
+    status = task_status.get("status")
     
-    task_info["status"] = "completed"
-    stats["successful"] += 1
+    if status == "timeout":
+        stats["errors"] += 1
+        refund_current_job()
+        task_info["status"] = "error"
+        await forget_inflight(task_id, message.chat.id)
+        await progress_renderer.finish(status_msg, msg_error("Превышено время ожидания"))
+        await state.clear()
+        await message.answer("Используйте меню для повторной попытки.", reply_markup=get_main_keyboard())
+        return
+    elif status == "failed":
+        stats["errors"] += 1
+        refund_current_job()
+        task_info["status"] = "error"
+        await forget_inflight(task_id, message.chat.id)
+        await progress_renderer.finish(status_msg, msg_error("Задача завершилась с ошибкой"))
+        await state.clear()
+        await message.answer("Используйте меню для повторной попытки.", reply_markup=get_main_keyboard())
+        return
     
-    # Извлекаем файлы (должен быть только 1 файл — досье)
-    artifacts = []
-    for output_item in task_status.get("output", []):
-        content = output_item.get("content", [])
-        if isinstance(content, list):
-            for item in content:
-                if item.get("type") == "output_file" and item.get("fileUrl"):
-                    artifacts.append({
-                        "url": item.get("fileUrl"),
-                        "name": item.get("fileName", "file")
-                    })
+    # Результат готов: остановка бота дожидается его выдачи, включая скачивание файлов
+    with drain_guard:
+        task_info["status"] = "completed"
+        stats["successful"] += 1
     
-    logger.info(f"Stage 1 completed: {len(artifacts)} files")
+        # Извлекаем файлы (должен быть только 1 файл — досье)
+        if artifacts is None:
+            artifacts = extract_artifacts(task_status)
+            await remember_completed(task_id, message.chat.id, artifacts)
+            await journal_step("task_completed", task_id=task_id, artifacts=artifacts)
     
-    # Вычисляем время генерации
-    elapsed = datetime.now() - start_time
-    elapsed_str = f"{int(elapsed.total_seconds()) // 60:02d}:{int(elapsed.total_seconds()) % 60:02d}"
+        logger.info(f"Stage 1 completed: {len(artifacts)} files")
     
-    await status_msg.edit_text(f"✅ Анализ завершён ({elapsed_str})")
+        # Вычисляем время генерации
+        elapsed = datetime.now() - start_time
+        elapsed_str = f"{int(elapsed.total_seconds()) // 60:02d}:{int(elapsed.total_seconds()) % 60:02d}"
     
-    # Отправляем досье
-    for artifact in artifacts:
-        file_url = artifact.get("url")
-        file_name = artifact.get("name", "file")
-        
-        if file_url:
-            filepath = await download_file(file_url, file_name)
-            if filepath:
-                try:
-                    caption = msg_file_caption(file_name)
-                    await message.answer_document(FSInputFile(filepath, filename=file_name), caption=caption)
-                    stats["files_sent"] += 1
-                except Exception as e:
-                    logger.error(f"Error sending file: {e}")
-                finally:
-                    try:
-                        os.remove(filepath)
-                    except:
-                        pass
-    
-    # Показываем меню выбора документов (ЭТАП 2)
+        await progress_renderer.finish(status_msg, f"✅ Анализ завершён ({elapsed_str})")
+    
+        # Отправляем досье
+        delivered = await send_artifacts(message, artifacts)
+        await journal_step("delivered", task_id=task_id, files=[{"sha256": r["sha256"], "name": r["name"]} for r in delivered])
+        history_id = record_completed_files(user_id, await state.get_data(), delivered)
+        await state.update_data(history_id=history_id)
+        if delivered and len(delivered) == len(artifacts):
+            set_cached_result(request_key, [task_id], delivered, domain)
+        await forget_inflight(task_id, message.chat.id)
+    
+        # Показываем меню выбора документов (ЭТАП 2)
+        await show_document_selector(message, state, domain)
+
+async def send_artifacts(message: Message, artifacts: List[Dict]) -> List[Dict]:
+    """Отправляет файлы результата пользователю; возвращает отправленные артефакты.
+    Скачивание идёт параллельно, первый файл уходит в Telegram, пока остальные ещё качаются."""
+    started = time.monotonic()
+    delivered = []
+    with drain_guard:
+        downloads = [asyncio.create_task(resolve_artifact(artifact)) for artifact in artifacts]
+        for download in downloads:
+            try:
+                record = await download
+            except Exception as e:
+                logger.error(f"Error downloading file: {e}")
+                continue
+            if not record:
+                continue
+            file_name = record["name"]
+            try:
+                caption = msg_file_caption(file_name)
+                await send_document(message, record, caption)
+                delivered.append(record)
+                stats["files_sent"] += 1
+                delivery_latency.observe(time.monotonic() - started)
+            except Exception as e:
+                logger.error(f"Error sending file: {e}")
+    return delivered
+
+async def send_document(message: Message, record: Dict, caption: str) -> Message:
+    """Отправка по file_id, если файл уже загружался в Telegram, иначе загрузка с диска"""
+    sha, file_name = record["sha256"], record["name"]
+    file_id = await artifact_store.get_file_id(sha, file_name)
+    if file_id:
+        try:
+            return await message.answer_document(file_id, caption=caption)
+        except TelegramBadRequest as e:
+            # file_id стал недействителен — загружаем файл заново
+            logger.warning(f"Stale file_id for {file_name}: {e}")
+            await artifact_store.set_file_id(sha, file_name, None)
+    sent = await message.answer_document(FSInputFile(artifact_store.blob_path(sha), filename=file_name), caption=caption)
+    document = getattr(sent, "document", None)
+    if document:
+        await artifact_store.set_file_id(sha, file_name, document.file_id)
+    return sent
+
+async def resolve_artifact(artifact: Dict) -> Optional[Dict]:
+    """Артефакт из хранилища; если его там уже нет — повторная загрузка по ссылке Manus"""
+    file_name = artifact.get("name", "file")
+    sha = artifact.get("sha256")
+    if sha and await artifact_store.get_path(sha):
+        return {"sha256": sha, "name": file_name, "size": artifact_store.blobs[sha]["size"], "url": artifact.get("url")}
+    if artifact.get("url"):
+        return await artifact_store.fetch(artifact["url"], file_name)
+    return None
+
+def record_completed_files(user_id: int, data: Dict, records: List[Dict]) -> Optional[str]:
+    """Добавляет доставленные файлы в историю «Мои задачи»; возвращает id записи"""
+    if not records:
+        return data.get("history_id")
+    files = [{"sha256": r["sha256"], "name": r["name"], "url": r.get("url")} for r in records]
+    history_id = data.get("history_id")
+    task = get_task_by_id(user_id, history_id) if history_id else None
+    if task:
+        known = {(f["sha256"], f["name"]) for f in task["files"]}
+        task["files"].extend(f for f in files if (f["sha256"], f["name"]) not in known)
+        return history_id
+    history_id = f"{int(datetime.now().timestamp())}{records[0]['sha256'][:6]}"
+    add_completed_task(user_id, {
+        "task_id": history_id,
+        "domain": data.get("domain", "unknown"),
+        "goal": data.get("goal", ""),
+        "date": datetime.now().strftime("%d.%m.%Y %H:%M"),
+        "files": files
+    })
+    return history_id
+
+async def show_document_selector(message: Message, state: FSMContext, domain: str):
+    """ЭТАП 2: меню выбора документов после досье"""
     await state.set_state(PresaleStates.selecting_docs)
     await message.answer(
         f"""✅ Досье на {domain} готово!
@@ -2402,16 +5080,17 @@ async def callback_toggle_all(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_reply_markup(reply_markup=get_document_selector_keyboard(selected))
     await callback.answer()
 
-@router.callback_query(F.data == "confirm_docs")
+async def docs_selected(callback: CallbackQuery, state: FSMContext) -> bool:
+    """Фильтр: выбран хотя бы один документ"""
+    data = await state.get_data()
+    return bool(data.get("selected_docs"))
+
+@router.callback_query(F.data == "confirm_docs", docs_selected, flags={"idempotent": "confirm_docs"})
 async def callback_confirm_docs(callback: CallbackQuery, state: FSMContext):
     """Подтверждение выбора и запуск генерации"""
     data = await state.get_data()
     selected = data.get("selected_docs", [])
     
-    if not selected:
-        await callback.answer("⚠️ Выберите хотя бы 1 документ", show_alert=True)
-        return
-    
     summary = get_selected_docs_summary(set(selected))
     await callback.message.edit_text(f"""✅ Выбрано {len(selected)} документов:
 
@@ -2421,114 +5100,531 @@ async def callback_confirm_docs(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     
     # Запускаем ЭТАП 3: Генерация выбранных документов
-    await state.set_state(PresaleStates.generating_docs)
-    await process_selected_documents(callback.message, state, callback.from_user.id)
+    await submit_selected_documents(callback.message, state, callback.from_user.id)
+
+@router.callback_query(F.data == "confirm_docs")
+async def callback_confirm_no_docs(callback: CallbackQuery):
+    await callback.answer("⚠️ Выберите хотя бы 1 документ", show_alert=True)
+
+def get_user_doc_semaphore(user_id: int) -> asyncio.Semaphore:
+    """Семафор параллельной генерации документов одного пользователя"""
+    if user_id not in user_doc_semaphores:
+        user_doc_semaphores[user_id] = asyncio.Semaphore(MAX_PARALLEL_DOCS_PER_USER)
+    return user_doc_semaphores[user_id]
+
+class DocumentPackage:
+    """Пакет документов Этапа 3: общий прогресс, выдача по мере готовности и запись для восстановления"""
+
+    def __init__(self, message: Message, user_id: int, data: Dict, start_time: datetime,
+                 status_msg: Message, package_id: str):
+        self.message = message
+        self.user_id = user_id
+        self.data = data
+        self.start_time = start_time
+        self.status_msg = status_msg
+        self.selected_docs: List[str] = data.get("selected_docs", [])
+        self.progress: Dict[str, str] = {doc_id: "waiting" for doc_id in self.selected_docs}
+        self.delivered: Dict[str, List[Dict]] = {}  # doc_id -> отправленные файлы
+        self.task_ids: Dict[str, str] = {}  # doc_id -> задача Manus
+        self.inflight = {
+            "package_id": package_id, "user_id": user_id, "chat_id": message.chat.id,
+            "created_at": start_time.isoformat(), "data": data, "job_id": current_job_id.get()
+        }
+
+    def request_key(self, doc_id: str) -> str:
+        return get_cache_key(self.data.get("domain", ""), self.data.get("goal", ""), self.data.get("constraints", "-"), [doc_id])
+
+    def remaining(self) -> Optional[float]:
+        """Оценка до готовности последнего документа; документы без задачи считаем по медиане"""
+        estimates = []
+        for doc_id, status in self.progress.items():
+            if status in ("done", "error"):
+                continue
+            progress = task_poller.progress(self.task_ids[doc_id]) if doc_id in self.task_ids else None
+            estimates.append(progress[1] if progress else duration_model.estimate(doc_id)[0])
+        return max(estimates) if estimates else None
+
+    async def update(self, final: bool = False):
+        text = msg_documents_progress(self.progress, self.start_time, None if final else self.remaining())
+        if final:
+            await progress_renderer.finish(self.status_msg, text)
+        else:
+            progress_renderer.update(self.status_msg, text)
+
+    async def set_status(self, doc_id: str, status: str):
+        self.progress[doc_id] = status
+        await self.update()
+
+    async def deliver(self, doc_id: str, task_id: str, artifacts: List[Dict]) -> List[Dict]:
+        """Отправляет файлы документа сразу после завершения его задачи"""
+        records = await send_artifacts(self.message, artifacts) if artifacts else []
+        self.delivered[doc_id] = records
+        await self.set_status(doc_id, "done" if artifacts and len(records) == len(artifacts) else "error")
+        # После перезапуска уже выданный документ не отправляется повторно
+        await remember_inflight(task_id, {**self.inflight, "kind": "document", "doc_id": doc_id, "delivered": records})
+        await journal_step("delivered", task_id=task_id, doc_id=doc_id,
+                           files=[{"sha256": r["sha256"], "name": r["name"]} for r in records])
+        return records
+
+    def delivered_files(self) -> List[Dict]:
+        return [record for doc_id in self.selected_docs for record in self.delivered.get(doc_id, [])]
+
+    async def finish(self, state: FSMContext):
+        """Итог пакета: история, кэш и финальное сообщение"""
+        domain = self.data.get("domain")
+        delivered = self.delivered_files()
+        complete = all(self.progress.get(doc_id) == "done" for doc_id in self.selected_docs)
+        for doc_id in self.selected_docs:
+            if self.progress.get(doc_id) != "done":
+                self.progress[doc_id] = "error"
+        await self.update(final=True)
+        if not delivered:
+            # Ни одного документа: это ошибка, и задание не засчитывается в дневную квоту
+            stats["errors"] += 1
+            refund_current_job()
+            logger.warning(f"Package {self.inflight['package_id']} delivered no documents")
+            await self.message.answer(msg_error("Не удалось подготовить документы"), reply_markup=get_main_keyboard())
+            await state.clear()
+            await forget_package(self.inflight["package_id"])
+            return
+        
+        stats["successful"] += 1
+        logger.info(f"Package {self.inflight['package_id']} delivered {len(delivered)} files")
+        
+        elapsed = datetime.now() - self.start_time
+        elapsed_str = f"{int(elapsed.total_seconds()) // 60:02d}:{int(elapsed.total_seconds()) % 60:02d}"
+        
+        record_completed_files(self.user_id, self.data, delivered)
+        
+        # В кэш попадает только полностью собранный и доставленный пакет
+        if complete:
+            set_cached_result(
+                get_cache_key(domain, self.data.get("goal"), self.data.get("constraints", "-"), self.selected_docs),
+                [], delivered, domain
+            )
+        
+        await self.message.answer(msg_delivery_complete(domain, len(delivered), elapsed_str), reply_markup=get_main_keyboard())
+        await state.clear()
+        await forget_package(self.inflight["package_id"])
+
+async def generate_document(doc_id: str, user_id: int, package: DocumentPackage) -> List[Dict]:
+    """Генерирует один документ отдельной задачей Manus и выдаёт его, как только он готов"""
+    url = package.data.get("url")
+    goal = package.data.get("goal")
+    constraints = package.data.get("constraints", "-")
+    request_key = package.request_key(doc_id)
+    
+    # Такой же документ уже генерируется — ждём его, не занимая слотов
+    task_id = await join_running_task(request_key)
+    if task_id:
+        logger.info(f"Document {doc_id} joined running task {task_id}")
+        task_poller.describe(task_id, doc_id)
+        package.task_ids[doc_id] = task_id
+        await package.set_status(doc_id, "running")
+        # Запись нужна и присоединившемуся пакету: иначе после сбоя его результат потеряется
+        await remember_inflight(task_id, {**package.inflight, "kind": "document", "doc_id": doc_id})
+        await journal_step("task_created", task_id=task_id, doc_id=doc_id)
+        return await follow_document(doc_id, task_id, package)
+    
+    # Сначала лимит пользователя, затем глобальный — чтобы ожидающие документы
+    # одного пользователя не занимали общие слоты
+    async with get_user_doc_semaphore(user_id):
+        async with doc_semaphore:
+            await package.set_status(doc_id, "running")
+            
+            # Получаем промпт для конкретного документа
+            prompt = get_document_prompt(doc_id, url, goal, constraints)
+            if not prompt:
+                logger.error(f"No prompt for document {doc_id}")
+                await package.set_status(doc_id, "error")
+                return []
+            
+            # Создаём задачу для этого документа
+            task_id, _ = await start_or_join_task(request_key, lambda: create_manus_task_single_doc(prompt))
+            if not task_id:
+                logger.error(f"Failed to create task for {doc_id}")
+                await package.set_status(doc_id, "error")
+                return []
+            
+            load, started_at = current_load(), datetime.now()
+            task_poller.describe(task_id, doc_id, started_at, load)
+            package.task_ids[doc_id] = task_id
+            await remember_inflight(task_id, {
+                **package.inflight, "kind": "document", "doc_id": doc_id,
+                "started_at": started_at.isoformat(), "load": load
+            })
+            await journal_step("task_created", task_id=task_id, doc_id=doc_id)
+            # Ожидаем завершения генерации
+            return await follow_document(doc_id, task_id, package)
+
+async def follow_document(doc_id: str, task_id: str, package: DocumentPackage,
+                          timeout: int = TASK_TIMEOUT, artifacts: Optional[List[Dict]] = None) -> List[Dict]:
+    """Ожидает задачу Manus одного документа и сразу отправляет его файлы
+    (artifacts — результат, полученный до перезапуска)"""
+    if artifacts is not None:
+        release_running_task(package.request_key(doc_id), task_id)
+        with drain_guard:
+            await package.set_status(doc_id, "sending")
+            return await package.deliver(doc_id, task_id, artifacts)
+    try:
+        # Опросы обновляют оценку оставшегося времени в сводке пакета
+        task_status = await task_poller.wait(task_id, timeout, lambda _: package.update())
+    finally:
+        release_running_task(package.request_key(doc_id), task_id)
+    status = task_status.get("status")
+    
+    # Результат готов: остановка бота дожидается его выдачи, включая скачивание файлов
+    with drain_guard:
+        artifacts = []
+        if status == "completed":
+            artifacts = extract_artifacts(task_status)
+            await remember_completed(task_id, package.inflight["chat_id"], artifacts)
+            await journal_step("task_completed", task_id=task_id, doc_id=doc_id, artifacts=artifacts)
+        elif status == "timeout":
+            logger.error(f"Timeout for {doc_id}")
+        else:
+            logger.error(f"Task failed for {doc_id}")
+        
+        if artifacts:
+            await package.set_status(doc_id, "sending")
+        return await package.deliver(doc_id, task_id, artifacts)
 
 async def process_selected_documents(message: Message, state: FSMContext, user_id: int):
-    """ЭТАП 3: Генерация выбранных документов (по одному)"""
+    """ЭТАП 3: Параллельная генерация выбранных документов с выдачей по мере готовности"""
     
     data = await state.get_data()
-    url = data.get("url")
-    domain = data.get("domain")
-    goal = data.get("goal")
-    constraints = data.get("constraints", "-")
     selected_docs = data.get("selected_docs", [])
     
     status_msg = await message.answer(f"🚀 Запуск генерации {len(selected_docs)} документов...")
     start_time = datetime.now()
     
-    all_artifacts = []
+    # Общее сообщение о прогрессе по всем документам; id пакета — для восстановления после перезапуска
+    package_id = f"{user_id}-{int(start_time.timestamp() * 1000)}"
+    package = DocumentPackage(message, user_id, data, start_time, status_msg, package_id)
+    unit = f"package:{package_id}"
+    await acquire_lease(unit)
     
-    # Генерируем каждый документ отдельно
-    for idx, doc_id in enumerate(selected_docs, 1):
-        doc_info = DOCUMENT_TYPES.get(doc_id, {})
-        doc_name = doc_info.get("name", doc_id)
-        
-        await status_msg.edit_text(f"📝 Генерация {idx}/{len(selected_docs)}: {doc_name}...")
-        
-        # Получаем промпт для конкретного документа
-        prompt = get_document_prompt(doc_id, url, goal, constraints)
-        if not prompt:
-            logger.error(f"No prompt for document {doc_id}")
-            continue
-        
-        # Создаём задачу для этого документа
-        task_id = await create_manus_task_single_doc(prompt)
-        
-        if not task_id:
-            logger.error(f"Failed to create task for {doc_id}")
-            continue
-        
-        # Ожидаем завершения генерации
-        doc_start = datetime.now()
-        while True:
-            if (datetime.now() - doc_start).total_seconds() > TASK_TIMEOUT:
-                logger.error(f"Timeout for {doc_id}")
-                break
-            
-            task_status = await get_task_status(task_id)
-            status = task_status.get("status", "running")
-            
-            if status == "completed":
-                # Извлекаем файлы из этой задачи
-                for output_item in task_status.get("output", []):
-                    content = output_item.get("content", [])
-                    if isinstance(content, list):
-                        for item in content:
-                            if item.get("type") == "output_file" and item.get("fileUrl"):
-                                all_artifacts.append({
-                                    "url": item.get("fileUrl"),
-                                    "name": item.get("fileName", "file")
-                                })
-                break
-            elif status == "failed":
-                logger.error(f"Task failed for {doc_id}")
-                break
-            
-            await asyncio.sleep(POLLING_INTERVAL)
+    try:
+        await run_document_package(package, state)
+    finally:
+        progress_renderer.discard(status_msg)
+        await release_lease(unit)
+
+async def run_document_package(package: DocumentPackage, state: FSMContext):
+    """Запускает генерацию всех документов пакета одновременно и подводит итог"""
+    try:
+        results = await asyncio.gather(*[
+            generate_document(doc_id, package.user_id, package)
+            for doc_id in package.selected_docs
+        ], return_exceptions=True)
+    except asyncio.CancelledError:
+        # Отмена: уже выданные документы остаются в истории
+        record_completed_files(package.user_id, package.data, package.delivered_files())
+        raise
+    for doc_id, result in zip(package.selected_docs, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error generating {doc_id}: {result}")
     
-    # Все документы сгенерированы
-    stats["successful"] += 1
-    artifacts = all_artifacts
+    await package.finish(state)
+
+@router.callback_query(F.data.startswith("download_task_"))
+async def callback_download_task(callback: CallbackQuery):
+    """Повторная выдача документов завершённой задачи из хранилища"""
+    user_id = callback.from_user.id
+    task_id = callback.data.replace("download_task_", "")
+    task = get_task_by_id(user_id, task_id)
+    if not task:
+        await callback.answer("⚠️ Задача не найдена", show_alert=True)
+        return
+    files = task.get("files", [])
+    await callback.answer(f"📁 Отправляю {len(files)} документов")
+    delivered = await send_artifacts(callback.message, files)
+    if len(delivered) < len(files):
+        await callback.message.answer(
+            f"⚠️ Доступно {len(delivered)} из {len(files)} документов.\n"
+            "Остальные удалены из хранилища — запустите новый анализ.",
+            reply_markup=get_main_keyboard()
+        )
+
+# ═══════════════════════════════════════════════════════════════
+# ОБРАБОТЧИКИ КЭША
+# ═══════════════════════════════════════════════════════════════
+
+@router.callback_query(F.data.startswith("use_cache_"), flags={"idempotent": "cache"})
+async def callback_use_cache(callback: CallbackQuery, state: FSMContext):
+    """Выдача готовых документов из кэша вместо новой задачи Manus"""
+    cache_key = callback.data.replace("use_cache_", "")
+    data = await state.get_data()
+    stage = data.get("cache_stage", "presale")
+    domain = data.get("domain", "")
+    cached = get_cached_result(cache_key)
+    await callback.answer()
     
-    logger.info(f"Found {len(artifacts)} files to send")
-    files_sent = 0
+    if not cached:
+        await callback.message.edit_text("⌛ Готовый результат устарел — запускаю новую генерацию.")
+        await regenerate(callback.message, state, callback.from_user.id, stage)
+        return
     
-    elapsed = datetime.now() - start_time
-    elapsed_str = f"{int(elapsed.total_seconds()) // 60:02d}:{int(elapsed.total_seconds()) % 60:02d}"
+    await callback.message.edit_text(f"⚡ Выдаю готовые документы для {domain}...")
+    files = cached.get("files", [])
+    delivered = await send_artifacts(callback.message, files)
+    files_sent = len(delivered)
+    history_id = record_completed_files(callback.from_user.id, data, delivered)
+    await state.update_data(history_id=history_id)
     
-    await status_msg.edit_text(msg_delivery_summary(domain, len(artifacts), elapsed_str))
+    if files_sent < len(files):
+        # Ссылки Manus могли истечь — такой кэш больше не годится
+        invalidate_cached_result(cache_key)
+        await callback.message.answer("⚠️ Часть готовых файлов недоступна — запускаю новую генерацию.")
+        await regenerate(callback.message, state, callback.from_user.id, stage)
+        return
     
-    # Отправляем файлы
-    for artifact in artifacts:
-        file_url = artifact.get("url")
-        file_name = artifact.get("name", "file")
-        
-        if file_url:
-            filepath = await download_file(file_url, file_name)
-            if filepath:
-                try:
-                    caption = msg_file_caption(file_name)
-                    await message.answer_document(FSInputFile(filepath, filename=file_name), caption=caption)
-                    files_sent += 1
-                    stats["files_sent"] += 1
-                    await asyncio.sleep(0.5)
-                except Exception as e:
-                    logger.error(f"Error sending file: {e}")
-                finally:
-                    try:
-                        os.remove(filepath)
-                    except:
-                        pass
-    
-    await message.answer(msg_delivery_complete(domain, files_sent, elapsed_str), reply_markup=get_main_keyboard())
-    await state.clear()
+    if stage == "presale":
+        await show_document_selector(callback.message, state, domain)
+    else:
+        await callback.message.answer(msg_delivery_complete(domain, files_sent, "из кэша"), reply_markup=get_main_keyboard())
+        await state.clear()
+
+@router.callback_query(F.data == "regenerate", flags={"idempotent": "cache"})
+async def callback_regenerate(callback: CallbackQuery, state: FSMContext):
+    """Новая генерация, несмотря на готовый результат в кэше"""
+    data = await state.get_data()
+    await callback.message.edit_text("🔄 Запускаю новую генерацию...")
+    await callback.answer()
+    await regenerate(callback.message, state, callback.from_user.id, data.get("cache_stage", "presale"))
+
+async def regenerate(message: Message, state: FSMContext, user_id: int, stage: str):
+    if stage == "presale":
+        await submit_presale(message, state, user_id, check_cache=False)
+    else:
+        await submit_selected_documents(message, state, user_id, check_cache=False)
 
 @router.callback_query(F.data == "noop")
 async def callback_noop(callback: CallbackQuery):
     """Пустой callback для неактивных кнопок"""
     await callback.answer()
 
+# ═══════════════════════════════════════════════════════════════
+# ВОССТАНОВЛЕНИЕ ПОСЛЕ ПЕРЕЗАПУСКА
+# ═══════════════════════════════════════════════════════════════
+
+def chat_message(chat_id: int, message_id: int = 0) -> Message:
+    """Сообщение-заглушка для ответа в чат без входящего апдейта (или для правки уже отправленного)"""
+    return Message(message_id=message_id, date=datetime.now(), chat=Chat(id=chat_id, type="private")).as_(bot)
+
+def chat_state(chat_id: int, user_id: int) -> FSMContext:
+    return FSMContext(storage=storage, key=StorageKey(bot_id=bot.id, chat_id=chat_id, user_id=user_id))
+
+def remaining_timeout(created_at: datetime) -> int:
+    """Сколько ещё ждать задачу, созданную до перезапуска"""
+    elapsed = int((datetime.now() - created_at).total_seconds())
+    return max(TASK_TIMEOUT - elapsed, POLLING_INTERVAL)
+
+async def resume_presale(task_id: str, record: Dict):
+    user_id, chat_id = record["user_id"], record["chat_id"]
+    message = chat_message(chat_id)
+    state = chat_state(chat_id, user_id)
+    created_at = datetime.fromisoformat(record["created_at"])
+    data = record.get("data", {})
+    register_running_task(get_cache_key(data.get("domain", ""), data.get("goal", ""), data.get("constraints", "-"), ["dossier"]), task_id)
+    task_poller.describe(task_id, "dossier", created_at, record.get("load"))
+    task_info = next((t for t in get_user_tasks(user_id) if t.get("task_id") == task_id), None)
+    if task_info is None:
+        task_info = {"task_id": task_id, "domain": data.get("domain"), "goal": data.get("goal"),
+                     "status": "running", "date": created_at.strftime("%d.%m.%Y %H:%M")}
+        add_user_task(user_id, task_info)
+    if not await state.get_data():
+        await state.set_data(record.get("data", {}))
+    await state.set_state(PresaleStates.processing)
+    status_msg = await message.answer("♻️ Бот был перезапущен — продолжаю отслеживать анализ...")
+    try:
+        await finish_presale(message, state, user_id, task_id, task_info, created_at, status_msg,
+                             remaining_timeout(created_at), record.get("artifacts"))
+    finally:
+        progress_renderer.discard(status_msg)
+        await release_lease(inflight_unit(record))
+
+async def resume_documents(package_id: str, records: Dict[str, Dict]):
+    first = next(iter(records.values()))
+    user_id, chat_id, data = first["user_id"], first["chat_id"], first.get("data", {})
+    message = chat_message(chat_id)
+    state = chat_state(chat_id, user_id)
+    created_at = datetime.fromisoformat(first["created_at"])
+    
+    status_msg = await message.answer("♻️ Бот был перезапущен — продолжаю генерацию документов...")
+    package = DocumentPackage(message, user_id, data, created_at, status_msg, package_id)
+    pending = {}
+    for task_id, record in records.items():
+        doc_id = record["doc_id"]
+        if "delivered" in record:
+            # Документ уже выдан до перезапуска
+            package.delivered[doc_id] = record["delivered"]
+            package.progress[doc_id] = "done" if record["delivered"] else "error"
+        else:
+            pending[doc_id] = (task_id, record.get("artifacts"))
+            package.progress[doc_id] = "running"
+            package.task_ids[doc_id] = task_id
+            task_poller.describe(task_id, doc_id, datetime.fromisoformat(record.get("started_at", first["created_at"])), record.get("load"))
+            register_running_task(package.request_key(doc_id), task_id)
+    # Документы без записи не успели запуститься до перезапуска — запускаем их сейчас
+    waiting = [doc_id for doc_id in package.selected_docs if package.progress[doc_id] == "waiting"]
+    await package.update()
+    
+    await state.set_state(PresaleStates.generating_docs)
+    try:
+        await asyncio.gather(*[
+            follow_document(doc_id, task_id, package, remaining_timeout(created_at), artifacts)
+            for doc_id, (task_id, artifacts) in pending.items()
+        ], *[generate_document(doc_id, user_id, package) for doc_id in waiting], return_exceptions=True)
+        await package.finish(state)
+    finally:
+        progress_renderer.discard(status_msg)
+        await release_lease(f"package:{package_id}")
+
+async def run_recovery(name: str, coro: Awaitable[None], job_id: Optional[str] = None):
+    # Шаги подхваченного конвейера пишутся в журнал под исходным заданием
+    current_job_id.set(job_id)
+    try:
+        await coro
+        await journal.append(job_id, "finished")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Recovery of {name} failed: {e}")
+        await forget_pipeline(unit=name)
+        await journal.append(job_id, "finished", error=str(e))
+
+async def recover_inflight_tasks() -> List[asyncio.Task]:
+    """Подхватывает задачи Manus, запущенные до перезапуска бота или брошенные упавшей репликой.
+    Конвейер, аренду которого продлевает живая реплика, не трогаем."""
+    records = await state_backend.items("inflight:")
+    units: Dict[str, Dict[str, Dict]] = {}
+    for key, record in records.items():
+        task_id = record.get("task_id") or key[len("inflight:"):]
+        record = {**record, "task_id": task_id}
+        if record.get("kind") in ("presale", "document"):
+            units.setdefault(inflight_unit(record), {})[task_id] = record
+    recovered = []
+    for unit, unit_records in units.items():
+        if unit in owned_leases or not await acquire_lease(unit, None):
+            continue
+        first = next(iter(unit_records.values()))
+        if first["kind"] == "presale":
+            task = asyncio.create_task(run_recovery(unit, resume_presale(first["task_id"], first), first.get("job_id")))
+        else:
+            task = asyncio.create_task(run_recovery(unit, resume_documents(first["package_id"], unit_records), first.get("job_id")))
+        owned_leases[unit] = task
+        track_background_job(first["user_id"], "presale" if first["kind"] == "presale" else "documents", task, first.get("job_id"))
+        recovered.append(task)
+    if recovered:
+        logger.info(f"Replica {REPLICA_ID} took over {len(recovered)} in-flight pipelines")
+    return recovered
+
+async def replay_pending(source: JobJournal) -> int:
+    """Разбирает незавершённые задания журнала. Начатые до создания задачи Manus
+    (или не начатые в локальной очереди) ставятся в очередь заново; задания с задачами
+    Manus в работе продолжит recover_inflight_tasks с сохранённого шага.
+    Возвращает, сколько заданий пока ведёт живая реплика — их трогать нельзя."""
+    pending = await source.pending()
+    if not pending or STATE_BACKEND == "memory":
+        return 0
+    inflight_jobs = {record.get("job_id") for record in (await state_backend.items("inflight:")).values()}
+    queued_jobs = {record["job_id"] for record in (await state_backend.items("queue:")).values()} if SHARED_STATE else set()
+    live_jobs = set()
+    if SHARED_STATE:
+        # Аренда задания продлевается, пока его выполняет реплика (в том числе в ожидании лимита или Manus);
+        # аренды с нашим REPLICA_ID остались от прежнего процесса
+        now = time.time()
+        live_jobs = {key.split(":", 3)[3] for key, lease in (await state_backend.items("lease:job:")).items()
+                     if lease["expires"] > now and lease["owner"] != REPLICA_ID}
+    requeued = busy = 0
+    for job_id, entries in pending.items():
+        events = {entry["event"] for entry in entries}
+        if job_id in inflight_jobs or job_id in queued_jobs:
+            continue
+        if job_id in live_jobs:
+            busy += 1
+            continue
+        if "task_created" in events or (SHARED_STATE and "started" not in events):
+            # Результаты задания выданы до сбоя, либо задание забрала другая реплика
+            await source.append(job_id, "finished", replayed=True)
+            continue
+        job = job_from_record(next(entry for entry in entries if "kind" in entry))
+        job["queue_msg"] = None
+        pending_jobs.append(job)
+        await push_job(job)
+        requeued += 1
+        try:
+            await job["message"].answer("♻️ Бот был перезапущен — ваше задание снова в очереди.")
+        except Exception:
+            pass
+    if requeued:
+        logger.info(f"Journal replay of {source.path} re-queued {requeued} jobs")
+    return busy
+
+async def replay_journal():
+    """Задания из журнала этой реплики (и журналов упавших реплик), не дошедшие до конца"""
+    await replay_pending(journal)
+    await journal.compact()
+    if SHARED_STATE:
+        await adopt_orphaned_journals()
+
+async def hold_replica_lease():
+    """Аренда реплики: пока она продлевается, журнал реплики разбирает только она сама"""
+    unit = f"replica:{REPLICA_ID}"
+    deadline = time.monotonic() + LEASE_TTL
+    # Журнал прежнего процесса с тем же REPLICA_ID может сейчас разбирать другая реплика
+    while not await state_backend.claim(f"lease:{unit}", REPLICA_ID, LEASE_TTL) and time.monotonic() < deadline:
+        await asyncio.sleep(1)
+    owned_leases[unit] = None
+
+async def adopt_orphaned_journals():
+    """Журналы реплик, переставших продлевать аренду: их незавершённые задания разбирает эта реплика"""
+    root, ext = os.path.splitext(JOURNAL_PATH)
+    for path in glob.glob(f"{glob.escape(root)}-*{ext}"):
+        replica_id = path[len(root) + 1:len(path) - len(ext)]
+        if replica_id == REPLICA_ID or not await state_backend.claim(f"lease:replica:{replica_id}", REPLICA_ID, LEASE_TTL):
+            continue
+        try:
+            orphan = JobJournal(path, JOURNAL_COMPACT_EVERY)
+            if await replay_pending(orphan) == 0:
+                await orphan.remove()
+                logger.info(f"Adopted journal of replica {replica_id}")
+        finally:
+            await state_backend.release(f"lease:replica:{replica_id}", REPLICA_ID)
+
+async def lease_keeper(recovered: List[asyncio.Task]):
+    """Продлевает аренды этой реплики и подхватывает конвейеры реплик, переставших продлевать свои"""
+    while True:
+        await asyncio.sleep(LEASE_HEARTBEAT)
+        recovered[:] = [task for task in recovered if not task.done()]
+        # Без SHARED_STATE аренды не хранятся и брошенных конвейеров нет: все подхвачены при запуске
+        if not SHARED_STATE:
+            continue
+        for unit, task in list(owned_leases.items()):
+            try:
+                if await state_backend.claim(f"lease:{unit}", REPLICA_ID, LEASE_TTL):
+                    continue
+            except Exception as e:
+                logger.error(f"Lease renewal for {unit} failed: {e}")
+                continue
+            # Аренда истекла и конвейер уже ведёт другая реплика — не выдаём результат дважды
+            logger.warning(f"Lease {unit} was taken over by another replica, stopping local pipeline")
+            owned_leases.pop(unit, None)
+            if task is not None and not task.done():
+                for info in active_tasks.values():
+                    if info["job"].get("task") is task:
+                        info["job"]["cancelled"] = True
+                task.cancel()
+        # Брошенные конвейеры бывают только у других реплик; свои подхватываются при запуске
+        if shutdown_event.is_set():
+            continue
+        try:
+            recovered.extend(await recover_inflight_tasks())
+            await adopt_orphaned_journals()
+        except Exception as e:
+            logger.error(f"Orphaned pipeline scan failed: {e}")
+
 # ═══════════════════════════════════════════════════════════════
 # ЗАПУСК БОТА
 # ═══════════════════════════════════════════════════════════════
@@ -2543,9 +5639,67 @@ async def main():
     print(f"Project ID: {MANUS_PROJECT_ID}")
     print(f"Quick Mode (default): {QUICK_MODE_DEFAULT}")
     print(f"Allowed users: {'All' if not ALLOWED_USER_IDS else ALLOWED_USER_IDS}")
+    print(f"State backend: {STATE_BACKEND}")
+    print(f"Replica: {REPLICA_ID} ({'shared queue' if SHARED_STATE else 'local queue'})")
+    print(f"Telegram updates: {'webhook' if TELEGRAM_WEBHOOK_URL else 'long polling'}")
     print("=" * 60)
     
-    await dp.start_polling(bot)
+    global manus_client, state_backend
+    manus_client = ManusClient(MANUS_BASE_URL, MANUS_API_KEY)
+    state_backend = create_state_backend()
+    # /health, /ready, /metrics и приём push-уведомлений Manus
+    web_runner = await start_web_server(create_web_app())
+    await load_state()
+    autosave = asyncio.create_task(state_autosave())
+    workers = start_job_workers()
+    task_poller.start()
+    
+    webhook_id = None
+    if MANUS_WEBHOOK_URL:
+        webhook_id = await manus_client.register_webhook(get_manus_webhook_url())
+        task_poller.push_enabled = webhook_id is not None
+        print(f"Manus push mode: {'ON' if task_poller.push_enabled else 'OFF (registration failed)'}")
+    if SHARED_STATE:
+        await hold_replica_lease()
+    await replay_journal()
+    recovered = await recover_inflight_tasks()
+    keeper = asyncio.create_task(lease_keeper(recovered))
+    install_signal_handlers()
+    try:
+        if TELEGRAM_WEBHOOK_URL:
+            await run_telegram_webhook()
+        else:
+            # Webhook, оставшийся от запуска в webhook-режиме, блокирует getUpdates
+            await bot.delete_webhook()
+            # Сигналы обрабатывает begin_shutdown; сессия нужна для отправки файлов во время остановки
+            await dp.start_polling(bot, handle_signals=False, close_bot_session=False)
+    finally:
+        begin_shutdown()
+        # Свободные воркеры больше не берут задания: оставшиеся в очереди продолжатся по журналу
+        busy = {info["worker"] for info in active_tasks.values()}
+        for worker_id, worker in enumerate(workers, 1):
+            if worker_id not in busy:
+                worker.cancel()
+        pipelines = list(dict.fromkeys(recovered + [info["job"]["task"] for info in active_tasks.values() if info["job"].get("task")]))
+        # Конвейеры освобождают аренды — другая реплика сразу подхватит их задачи
+        await drain_pipelines(pipelines)
+        keeper.cancel()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if webhook_id:
+            await manus_client.delete_webhook(webhook_id)
+        await web_runner.cleanup()
+        task_poller.stop()
+        autosave.cancel()
+        await save_state()
+        await artifact_store.flush()
+        if SHARED_STATE:
+            # Незавершённые задания журнала разберёт другая реплика
+            await state_backend.release(f"lease:replica:{REPLICA_ID}", REPLICA_ID)
+        await state_backend.close()
+        await manus_client.close()
+        await bot.session.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
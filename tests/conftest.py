@@ -0,0 +1,117 @@
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import pytest
+
+from fakes import FakeManus, FakeTelegram, free_port
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT = os.path.join(ROOT, "bot.py")
+
+# Модульные тесты импортируют bot в этот процесс: состояние в памяти, файлы — во временном каталоге
+_scratch = tempfile.mkdtemp(prefix="jarvis-tests-")
+os.environ.update({
+    "TELEGRAM_BOT_TOKEN": "123456:TEST-token",
+    "MANUS_API_KEY": "test-key",
+    "STATE_BACKEND": "memory",
+    "JOURNAL_PATH": os.path.join(_scratch, "journal.jsonl"),
+    "ARTIFACTS_DIR": os.path.join(_scratch, "artifacts"),
+})
+sys.path.insert(0, ROOT)
+
+
+def wait_for(condition, timeout: float = 20, what: str = "condition"):
+    """Ждёт, пока бот в соседнем процессе не сделает ожидаемый запрос"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(0.1)
+    raise AssertionError(f"timed out waiting for {what}")
+
+
+def is_ready(port: str) -> bool:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+class BotProcess:
+    """bot.py как в проде: отдельный процесс, состояние и журнал в каталоге теста"""
+
+    def __init__(self, env: dict, log_path: str):
+        self.log = open(log_path, "ab")
+        self.process = subprocess.Popen([sys.executable, BOT], env=env, cwd=os.path.dirname(log_path),
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    def stop(self):
+        """SIGTERM: штатная остановка с дренажём"""
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait(30)
+        self.log.close()
+
+    def kill(self):
+        """SIGKILL: падение процесса без сохранения состояния"""
+        self.process.kill()
+        self.process.wait(10)
+        self.log.close()
+
+
+@pytest.fixture
+def manus():
+    server = FakeManus().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def telegram():
+    server = FakeTelegram().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def start_bot(tmp_path, manus, telegram):
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": "123456:TEST-token",
+        "TELEGRAM_API_URL": telegram.url,
+        "MANUS_API_KEY": "test-key",
+        "MANUS_BASE_URL": manus.url,
+        "STATE_BACKEND": "sqlite",
+        "ALLOWED_USER_IDS": "",
+        "STATE_DB_PATH": str(tmp_path / "jarvis.db"),
+        "JOURNAL_PATH": str(tmp_path / "journal.jsonl"),
+        "ARTIFACTS_DIR": str(tmp_path / "artifacts"),
+        "POLLING_INTERVAL": "1",
+        "POLLER_FAST_INTERVAL": "0.3",
+        "STATE_SAVE_INTERVAL": "1",
+        "DRAIN_TIMEOUT": "5",
+        "TELEGRAM_CHAT_RATE": "20",
+    }
+    processes = []
+
+    def start(**overrides):
+        process_env = {**env, "WEB_PORT": str(free_port()), **overrides}
+        process = BotProcess(process_env, str(tmp_path / f"bot-{len(processes) + 1}.log"))
+        processes.append(process)
+        # Готовность — как у балансировщика: /ready отвечает 200, когда бот забирает апдейты
+        wait_for(lambda: is_ready(process_env["WEB_PORT"]), what="bot to become ready")
+        return process
+
+    yield start
+    for process in processes:
+        if process.process.poll() is None:
+            process.kill()
+    for log_path in sorted(tmp_path.glob("bot-*.log")):
+        print(f"--- {log_path.name}")
+        print(log_path.read_text(errors="replace"))
@@ -0,0 +1,189 @@
+"""Заглушки Manus API и Telegram Bot API для сквозных тестов (бот подключается через MANUS_BASE_URL и TELEGRAM_API_URL)"""
+
+import asyncio
+import itertools
+import socket
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeServer:
+    """aiohttp-приложение в отдельном потоке: тест синхронный, бот работает в своём процессе"""
+
+    def __init__(self):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.calls = []
+
+    def routes(self, app: web.Application):
+        raise NotImplementedError
+
+    def start(self):
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        async def serve():
+            app = web.Application()
+            self.routes(app)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+            started.set()
+
+        self.loop = loop
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(serve(), loop)
+        started.wait(5)
+        return self
+
+    def stop(self):
+        async def shutdown():
+            await self.runner.cleanup()
+            # Недождавшийся getUpdates иначе останется висеть в остановленном цикле
+            pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def called(self, method: str) -> list:
+        return [args for name, *args in self.calls if name == method]
+
+
+class FakeManus(FakeServer):
+    """Задачи выполняются, пока тест не вызовет finish(); результат — один PDF"""
+
+    def __init__(self):
+        super().__init__()
+        self.ids = itertools.count(1)
+        self.finished = False
+        self.webhook = None
+
+    def routes(self, app):
+        app.router.add_post("/v1/tasks", self.create)
+        app.router.add_get("/v1/tasks/{id}", self.status)
+        app.router.add_post("/v1/tasks/{id}/stop", self.stop_task)
+        app.router.add_get("/files/{name}", self.file)
+        app.router.add_post("/v1/webhooks", self.register_webhook)
+        app.router.add_delete("/v1/webhooks/{id}", self.delete_webhook)
+
+    def finish(self):
+        self.finished = True
+
+    def push(self, task_id: str, token: str = None) -> int:
+        """Завершает задачи и отправляет боту событие task_stopped; token подменяет токен из адреса. Возвращает HTTP-статус ответа бота"""
+        self.finished = True
+        url = self.webhook if token is None else self.webhook.split("?")[0] + f"?token={token}"
+
+        async def post():
+            async with aiohttp.ClientSession() as session:
+                event = {"event_type": "task_stopped", "task_detail": {"task_id": task_id, "stop_reason": "finish"}}
+                async with session.post(url, json=event) as response:
+                    return response.status
+
+        return asyncio.run_coroutine_threadsafe(post(), self.loop).result(10)
+
+    async def register_webhook(self, request):
+        self.webhook = (await request.json())["webhook"]["url"]
+        self.calls.append(("register_webhook", self.webhook))
+        return web.json_response({"webhook_id": "webhook1"})
+
+    async def delete_webhook(self, request):
+        self.calls.append(("delete_webhook", request.match_info["id"]))
+        return web.json_response({})
+
+    async def create(self, request):
+        task_id = f"task{next(self.ids)}"
+        self.calls.append(("create", task_id, (await request.json())["prompt"]))
+        return web.json_response({"task_id": task_id})
+
+    async def status(self, request):
+        task_id = request.match_info["id"]
+        self.calls.append(("status", task_id, "completed" if self.finished else "running"))
+        if not self.finished:
+            return web.json_response({"status": "running"})
+        file = {"type": "output_file", "fileUrl": f"{self.url}/files/{task_id}.pdf", "fileName": f"{task_id}.pdf"}
+        return web.json_response({"status": "completed", "output": [{"content": [file]}]})
+
+    async def stop_task(self, request):
+        self.calls.append(("stop", request.match_info["id"]))
+        return web.json_response({})
+
+    async def file(self, request):
+        return web.Response(body=b"%PDF-1.4 " + request.match_info["name"].encode())
+
+
+class FakeTelegram(FakeServer):
+    """Отдаёт боту апдейты через getUpdates (в webhook-режиме тест отправляет их сам) и запоминает все его запросы"""
+
+    def __init__(self):
+        super().__init__()
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.edit_delay = 0
+
+    def routes(self, app):
+        app.router.add_post("/bot{token}/{method}", self.handle)
+
+    def text_update(self, user_id: int, text: str) -> dict:
+        return {"update_id": next(self.update_ids), "message": {
+            "message_id": next(self.message_ids), "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": {"id": user_id, "is_bot": False, "first_name": "User"}}}
+
+    def send_text(self, user_id: int, text: str):
+        self.updates.append(self.text_update(user_id, text))
+
+    def callback_update(self, user_id: int, data: str, message_id: int) -> dict:
+        return {"update_id": next(self.update_ids), "callback_query": {
+            "id": str(next(self.message_ids)), "chat_instance": "1", "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "message": {"message_id": message_id, "date": int(time.time()), "text": "",
+                        "chat": {"id": user_id, "type": "private"}}}}
+
+    def press(self, user_id: int, data: str, message_id: int):
+        self.updates.append(self.callback_update(user_id, data, message_id))
+
+    def last_message_with(self, markup: str) -> int:
+        """id последнего сообщения бота, у клавиатуры которого есть кнопка с таким callback_data"""
+        sent = reversed(self.called("sendMessage"))
+        return next((message_id for message_id, data in sent if markup in data.get("reply_markup", "")), None)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = {key: value if isinstance(value, str) else value.filename for key, value in (await request.post()).items()}
+        # Файлы aiogram передаёт отдельными частями формы, а в поле — ссылку attach://<часть>
+        data = {key: data.get(value[9:], value) if value.startswith("attach://") else value for key, value in data.items()}
+        if method == "getUpdates":
+            self.calls.append((method, data))
+            offset = int(data.get("offset", 0))
+            # Как и Telegram, подтверждённые смещением апдейты больше не отдаём (в том числе после перезапуска бота)
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            deadline = time.monotonic() + min(float(data.get("timeout", 0)), 1)
+            while not [u for u in self.updates if u["update_id"] >= offset] and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            return web.json_response({"ok": True, "result": [u for u in self.updates if u["update_id"] >= offset]})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 123456, "is_bot": True, "first_name": "Jarvis"}})
+        if method == "editMessageText":
+            await asyncio.sleep(self.edit_delay)
+        if not method.startswith("send") or method == "sendChatAction":
+            self.calls.append((method, data))
+            return web.json_response({"ok": True, "result": True})
+        message_id = next(self.message_ids)
+        self.calls.append((method, message_id, data))
+        result = {"message_id": message_id, "date": int(time.time()), "chat": {"id": int(data["chat_id"]), "type": "private"}}
+        if method == "sendDocument":
+            result["document"] = {"file_id": f"file{message_id}", "file_unique_id": f"u{message_id}"}
+        return web.json_response({"ok": True, "result": result})
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+
+import bot
+
+
+def make_store(tmp_path, max_bytes=1024, max_age=timedelta(days=1)):
+    return bot.ArtifactStore(str(tmp_path / "artifacts"), max_bytes, max_age)
+
+
+async def put(store, tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return await store.put_file(str(path), name)
+
+
+def read_index(store):
+    with open(store.index_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_reads_do_not_rewrite_index_until_flush(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        record = await put(store, tmp_path, "a.pdf", b"a")
+        saved = os.stat(store.index_path).st_mtime_ns
+        assert await store.get_path(record["sha256"])
+        await store.set_file_id(record["sha256"], "a.pdf", "file1")
+        assert os.stat(store.index_path).st_mtime_ns == saved
+        await store.flush()
+        assert read_index(store)["blobs"][record["sha256"]]["file_ids"] == {"a.pdf": "file1"}
+
+    asyncio.run(scenario())
+
+
+def test_flush_keeps_entries_of_other_replica(tmp_path):
+    async def scenario():
+        first, second = make_store(tmp_path), make_store(tmp_path)
+        a = await put(first, tmp_path, "a.pdf", b"a")
+        b = await put(second, tmp_path, "b.pdf", b"b")
+        await first.set_file_id(a["sha256"], "a.pdf", "file1")
+        await first.flush()
+        assert set(read_index(first)["blobs"]) == {a["sha256"], b["sha256"]}
+        assert await first.get_path(b["sha256"])
+
+    asyncio.run(scenario())
+
+
+def test_evict_drops_old_then_least_recently_used(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path, max_bytes=2)
+        old = await put(store, tmp_path, "old.pdf", b"o")
+        used = await put(store, tmp_path, "used.pdf", b"u")
+        idle = await put(store, tmp_path, "idle.pdf", b"i")
+        assert await store.get_path(old["sha256"]) is None  # Квота в 2 байта: вытеснен самый давний
+        store.blobs[idle["sha256"]]["last_access"] = "2000-01-01T00:00:00"
+        store.blobs[used["sha256"]]["last_access"] = datetime.now().isoformat()
+        store.max_bytes = 10
+        store.evict()
+        assert await store.get_path(idle["sha256"]) is None  # Старше max_age
+        assert not os.path.exists(store.blob_path(idle["sha256"]))
+        assert await store.get_path(used["sha256"])
+        await store.flush()
+        assert set(read_index(store)["blobs"]) == {used["sha256"]}
+
+    asyncio.run(scenario())
@@ -0,0 +1,74 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+def test_recent_keys_claim_once_per_ttl():
+    keys = bot.RecentKeys(ttl=0.1)
+    assert keys.claim("a")
+    assert not keys.claim("a")
+    keys.release("a")
+    assert keys.claim("a")
+    time.sleep(0.15)
+    assert keys.claim("b")
+    assert "a" not in keys.expires  # Истёкшие ключи вычищаются при следующем claim
+    assert keys.claim("a")
+
+
+def test_update_dedup_drops_redelivered_update_and_callback():
+    middleware = bot.UpdateDedupMiddleware(ttl=60)
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.update_id)
+
+    def update(update_id, callback_id=None):
+        return SimpleNamespace(update_id=update_id, callback_query=SimpleNamespace(id=callback_id) if callback_id else None)
+
+    async def scenario():
+        await middleware(handler, update(1), {})
+        await middleware(handler, update(1), {})
+        await middleware(handler, update(2, "cb"), {})
+        await middleware(handler, update(3, "cb"), {})  # Тот же callback под новым update_id
+
+    asyncio.run(scenario())
+    assert handled == [1, 2]
+
+
+class FakeCallback:
+    from_user = SimpleNamespace(id=42)
+    message = SimpleNamespace(chat=SimpleNamespace(id=42), message_id=7)
+
+    def __init__(self):
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def test_idempotent_action_runs_once_and_again_after_failure():
+    middleware = bot.IdempotencyMiddleware(ttl=60)
+    data = {"handler": SimpleNamespace(flags={"idempotent": "generate"})}
+    calls = []
+
+    async def failing(event, data):
+        calls.append("fail")
+        raise RuntimeError("Manus down")
+
+    async def handler(event, data):
+        calls.append("run")
+
+    async def scenario():
+        callback = FakeCallback()
+        with pytest.raises(RuntimeError):
+            await middleware(failing, callback, data)
+        await middleware(handler, callback, data)
+        await middleware(handler, callback, data)
+        return callback.answers
+
+    assert asyncio.run(scenario()) == ["⏳ Уже выполняется"]
+    assert calls == ["fail", "run"]
@@ -0,0 +1,31 @@
+import bot
+
+
+def make_model(window=5, min_samples=3, default=600):
+    return bot.DurationModel({}, window, min_samples, default)
+
+
+def test_estimate_falls_back_to_broader_level_then_default():
+    model = make_model()
+    assert model.estimate("dossier", "low") == (600, 600)
+    for seconds in (100, 200, 300):
+        model.record("dossier", "high", seconds)
+    # Для загрузки low замеров нет — берётся уровень типа задачи и профиля
+    assert model.estimate("dossier", "low") == (200, 300)
+
+
+def test_window_keeps_only_recent_samples():
+    model = make_model(window=3)
+    for seconds in (1000, 1000, 10, 20, 30):
+        model.record("dossier", "low", seconds)
+    assert model.estimate("dossier", "low") == (20, 30)
+    assert model.snapshot()["dossier"]["count"] == 3
+
+
+def test_progress_reaches_80_percent_at_median_and_stops_at_95():
+    model = make_model(min_samples=1)
+    for seconds in (100, 100, 100, 200, 200):
+        model.record("dossier", "low", seconds)
+    assert model.progress("dossier", "low", 50) == (40, 50)
+    assert model.progress("dossier", "low", 150) == (87, 50)
+    assert model.progress("dossier", "low", 1000) == (95, 0)
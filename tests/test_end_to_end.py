@@ -0,0 +1,170 @@
+"""Сквозные сценарии: bot.py в отдельном процессе против заглушек Manus и Telegram"""
+
+import hashlib
+import json
+import time
+import urllib.error
+import urllib.request
+
+from conftest import wait_for
+from fakes import free_port
+
+USER = 42
+
+
+def say(telegram, text: str):
+    """Сообщение пользователя; как живой пользователь, ждёт ответа бота перед следующим"""
+    replies = len(telegram.called("sendMessage"))
+    telegram.send_text(USER, text)
+    wait_for(lambda: len(telegram.called("sendMessage")) > replies, what=f"reply to {text!r}")
+
+
+def start_presale(telegram, manus) -> str:
+    """Новый анализ до создания задачи Этапа 1; возвращает её id"""
+    say(telegram, "/start")
+    say(telegram, "🚀 Новый анализ")
+    say(telegram, "example.com")
+    telegram.press(USER, "goal_tkp", telegram.last_message_with("goal_tkp"))
+    return wait_for(lambda: manus.called("create"), what="Manus task")[0][0]
+
+
+def documents(telegram) -> list:
+    return [data["document"] for _, data in telegram.called("sendDocument")]
+
+
+def test_presale_delivers_dossier_and_offers_documents(start_bot, manus, telegram):
+    bot = start_bot()
+    task_id = start_presale(telegram, manus)
+    assert "example.com" in manus.called("create")[0][1]
+    manus.finish()
+    assert wait_for(lambda: documents(telegram), what="dossier") == [f"{task_id}.pdf"]
+    wait_for(lambda: telegram.last_message_with("toggle_doc_"), what="document selector")
+    # Webhook, оставшийся от запуска в webhook-режиме, снимается перед опросом getUpdates
+    assert telegram.called("deleteWebhook")
+    bot.stop()
+    assert bot.process.returncode == 0
+
+
+def test_stage3_generates_selected_document(start_bot, manus, telegram):
+    start_bot()
+    start_presale(telegram, manus)
+    manus.finish()
+    selector = wait_for(lambda: telegram.last_message_with("toggle_doc_"), what="document selector")
+    telegram.press(USER, "toggle_doc_roi", selector)
+    wait_for(lambda: telegram.called("editMessageReplyMarkup"), what="selection")
+    telegram.press(USER, "confirm_docs", selector)
+    wait_for(lambda: len(manus.called("create")) == 2, what="Stage 3 task")
+    wait_for(lambda: len(documents(telegram)) == 2, what="Stage 3 document")
+    assert documents(telegram)[1] == "task2.pdf"
+
+
+def test_cancel_button_stops_manus_task(start_bot, manus, telegram):
+    start_bot()
+    task_id = start_presale(telegram, manus)
+    processing = wait_for(lambda: telegram.last_message_with('"cancel"'), what="processing message")
+    telegram.press(USER, "cancel", processing)
+    wait_for(lambda: manus.called("stop"), what="Manus stop")
+    assert manus.called("stop") == [[task_id]]
+    wait_for(lambda: telegram.called("answerCallbackQuery"), what="callback answer")
+    # Отменённая задача больше не опрашивается: даже готовый результат пользователю не приходит
+    manus.finish()
+    time.sleep(2)
+    assert not documents(telegram)
+
+
+def test_restart_recovers_running_task(start_bot, manus, telegram):
+    bot = start_bot(REPLICA_ID="old-host")
+    task_id = start_presale(telegram, manus)
+    wait_for(lambda: manus.called("status"), what="first poll")
+    bot.kill()
+    # Контейнер перезапущен на другом хосте: задача подхватывается сразу, не дожидаясь LEASE_TTL
+    start_bot(REPLICA_ID="new-host")
+    manus.finish()
+    assert wait_for(lambda: documents(telegram), what="dossier after restart") == [f"{task_id}.pdf"]
+    assert len(manus.called("create")) == 1
+
+
+def test_shutdown_waits_for_delivery_of_finished_task(start_bot, manus, telegram):
+    bot = start_bot()
+    task_id = start_presale(telegram, manus)
+    # Медленная правка статуса растягивает промежуток между завершением задачи и отправкой файла
+    telegram.edit_delay = 2
+    manus.finish()
+    wait_for(lambda: [call for call in manus.called("status") if call[1] == "completed"], what="completed status")
+    bot.stop()
+    assert documents(telegram) == [f"{task_id}.pdf"]
+
+
+def start_push_mode(start_bot, fallback_interval: float):
+    """Бот в push-режиме: Manus уведомляет о завершении на его собственный HTTP-сервер"""
+    port = free_port()
+    return start_bot(WEB_PORT=str(port), MANUS_WEBHOOK_URL=f"http://127.0.0.1:{port}",
+                     MANUS_WEBHOOK_FALLBACK_INTERVAL=str(fallback_interval))
+
+
+def test_push_notification_delivers_without_polling(start_bot, manus, telegram):
+    bot = start_push_mode(start_bot, fallback_interval=60)
+    assert "?token=" in manus.webhook
+    task_id = start_presale(telegram, manus)
+    assert manus.push(task_id) == 200
+    assert wait_for(lambda: documents(telegram), what="dossier") == [f"{task_id}.pdf"]
+    # Задача опрошена один раз — по уведомлению; страховочный опрос раньше 60 с не наступает
+    assert len(manus.called("status")) == 1
+    bot.stop()
+    assert manus.called("delete_webhook") == [["webhook1"]]
+
+
+def test_push_notification_with_wrong_token_is_rejected(start_bot, manus, telegram):
+    start_push_mode(start_bot, fallback_interval=2)
+    task_id = start_presale(telegram, manus)
+    assert manus.push(task_id, token="wrong") == 403
+    # Результат всё равно приходит — страховочным опросом
+    assert wait_for(lambda: documents(telegram), what="dossier from fallback poll") == [f"{task_id}.pdf"]
+
+
+def post_update(url: str, update: dict, secret: str) -> int:
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST", headers={
+        "Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_telegram_webhook_mode_checks_secret(start_bot, manus, telegram):
+    port = free_port()
+    bot = start_bot(WEB_PORT=str(port), TELEGRAM_WEBHOOK_URL=f"http://127.0.0.1:{port}")
+    url = f"http://127.0.0.1:{port}/telegram/webhook"
+    [webhook] = telegram.called("setWebhook")
+    assert webhook[0]["url"] == url
+    # Секрет по умолчанию выводится из токена бота
+    secret = hashlib.sha256(b"123456:TEST-token").hexdigest()
+    assert webhook[0]["secret_token"] == secret
+    assert not telegram.called("getUpdates")
+
+    assert post_update(url, telegram.text_update(USER, "/start"), "wrong") == 401
+    time.sleep(1)
+    assert not telegram.called("sendMessage")
+    assert post_update(url, telegram.text_update(USER, "/start"), secret) == 200
+    wait_for(lambda: telegram.called("sendMessage"), what="reply to /start")
+
+    bot.stop()
+    assert bot.process.returncode == 0
+    # При остановке webhook остаётся: апдейты продолжают получать другие реплики
+    assert not telegram.called("deleteWebhook")
+
+
+def test_replica_takes_over_pipeline_of_killed_replica(start_bot, manus, telegram):
+    shared = {"SHARED_STATE": "1", "LEASE_TTL": "3", "LEASE_HEARTBEAT": "1"}
+    first = start_bot(REPLICA_ID="a", **shared)
+    task_id = start_presale(telegram, manus)
+    wait_for(lambda: manus.called("status"), what="first poll")
+    start_bot(REPLICA_ID="b", **shared)
+    first.kill()
+    manus.finish()
+    # Реплика b подхватывает задачу, когда истекает аренда a, и не создаёт её заново
+    assert wait_for(lambda: documents(telegram), timeout=30, what="dossier from replica b") == [f"{task_id}.pdf"]
+    assert len(manus.called("create")) == 1
+    time.sleep(2)
+    assert len(documents(telegram)) == 1
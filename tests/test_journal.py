@@ -0,0 +1,41 @@
+import asyncio
+import json
+
+import bot
+
+
+def read_entries(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_compaction_keeps_only_unfinished_jobs(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "journal.jsonl")
+        journal = bot.JobJournal(path, compact_every=6)
+        await journal.append("done", "queued")
+        await journal.append("done", "finished")
+        await journal.append("dropped", "queued")
+        await journal.append("dropped", "cancelled")
+        await journal.append("open", "queued")
+        assert len(read_entries(path)) == 5
+        await journal.append("open", "task_created", task_id="t1")  # Шестая запись — сжатие
+        assert journal.appended == 0
+        assert [(e["job_id"], e["event"]) for e in read_entries(path)] == [("open", "queued"), ("open", "task_created")]
+        assert list(await journal.pending()) == ["open"]
+
+    asyncio.run(scenario())
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    async def scenario():
+        path = tmp_path / "journal.jsonl"
+        journal = bot.JobJournal(str(path), compact_every=100)
+        await journal.append("open", "queued")
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('{"job_id": "open", "ev')  # Процесс упал посреди записи
+        assert [e["event"] for e in (await journal.pending())["open"]] == ["queued"]
+        await journal.compact()
+        assert len(read_entries(path)) == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,103 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from aiohttp import web
+
+import bot
+from fakes import free_port
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(bot, "MANUS_RETRY_ATTEMPTS", 2)
+    monkeypatch.setattr(bot, "MANUS_RETRY_BASE_DELAY", 0.01)
+
+
+async def serve_body(body: str):
+    """Manus за прокси, который отвечает 200 со страницей вместо JSON"""
+    calls = []
+
+    async def handler(request):
+        calls.append(request.path)
+        return web.Response(text=body, content_type="text/html")
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}", calls
+
+
+@pytest.mark.parametrize("body", ["<html>Bad gateway</html>", ""])
+def test_non_json_response_is_retried_and_reported_as_error(fast_retries, body):
+    async def scenario():
+        runner, url, calls = await serve_body(body)
+        client = bot.ManusClient(url, "key")
+        try:
+            status = await client.get_task("task1")
+            created = await client.create_task("prompt", "Stage 1")
+        finally:
+            await client.close()
+            await runner.cleanup()
+        assert status["status"] == "error"
+        assert created is None
+        # Статус повторяется как временный сбой; создание не повторяется — задача могла создаться
+        assert calls == ["/v1/tasks/task1", "/v1/tasks/task1", "/v1/tasks"]
+        assert client.breaker.failures == 3
+
+    asyncio.run(scenario())
+
+
+def test_open_breaker_rejects_without_spending_budget(monkeypatch):
+    async def scenario():
+        client = bot.ManusClient("http://127.0.0.1:1", "key")
+        client.breaker.opened_at = time.monotonic()
+        before = bot.manus_rate_limiter.counters["poll"]["requests"]
+        status = await client.get_task("task1")
+        await client.close()
+        assert status["status"] == "error"
+        assert bot.manus_rate_limiter.counters["poll"]["requests"] == before
+
+    asyncio.run(scenario())
+
+
+def test_breaker_opens_after_threshold_and_lets_one_probe_through():
+    breaker = bot.CircuitBreaker(threshold=2, cooldown=0.1)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.15)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()  # Второй запрос ждёт итога пробного
+    breaker.record_failure()
+    assert breaker.state == "open"
+    time.sleep(0.15)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+def test_parse_retry_after_accepts_seconds_and_http_date():
+    assert bot.parse_retry_after("7") == 7
+    assert bot.parse_retry_after("-3") == 0
+    assert bot.parse_retry_after(None) is None
+    assert bot.parse_retry_after("soon") is None
+    retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= bot.parse_retry_after(retry_at) <= 30
+
+
+def test_retry_delay_is_capped_and_prefers_retry_after(monkeypatch):
+    monkeypatch.setattr(bot, "MANUS_RETRY_BASE_DELAY", 1)
+    monkeypatch.setattr(bot, "MANUS_RETRY_MAX_DELAY", 5)
+    assert bot.retry_delay(0, retry_after=3) == 3
+    assert bot.retry_delay(0, retry_after=60) == 5
+    delays = [bot.retry_delay(attempt) for attempt in range(10) for _ in range(20)]
+    assert all(0 <= delay <= 5 for delay in delays)
+    assert all(bot.retry_delay(1) <= 2 for _ in range(20))
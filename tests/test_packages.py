@@ -0,0 +1,53 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+class FakeChatMessage:
+    """Сообщение в чате: бот только отвечает и правит прогресс"""
+
+    chat = SimpleNamespace(id=7)
+
+    def __init__(self, message_id=1, sent=None):
+        self.message_id = message_id
+        self.sent = [] if sent is None else sent
+
+    async def answer(self, text, **kwargs):
+        self.sent.append(text)
+        return FakeChatMessage(len(self.sent) + 1, self.sent)
+
+    async def edit_text(self, text, **kwargs):
+        return True
+
+
+class FakeState:
+    async def clear(self):
+        pass
+
+
+@pytest.fixture
+def package(monkeypatch):
+    monkeypatch.setattr(bot, "state_backend", bot.MemoryBackend())
+    monkeypatch.setattr(bot, "stats", {**bot.stats, "successful": 0, "errors": 0})
+    message = FakeChatMessage()
+    data = {"domain": "example.com", "goal": "sale", "selected_docs": ["proposal", "roadmap"]}
+    return bot.DocumentPackage(message, 7, data, datetime.now(), FakeChatMessage(100, message.sent), "7-1")
+
+
+def test_package_without_documents_is_reported_as_failure(package):
+    package.progress = {"proposal": "error", "roadmap": "error"}
+    asyncio.run(package.finish(FakeState()))
+    assert bot.stats["successful"] == 0 and bot.stats["errors"] == 1
+    assert "ОШИБКА" in package.message.sent[-1]
+
+
+def test_package_with_one_document_is_delivered(package):
+    package.progress = {"proposal": "done", "roadmap": "error"}
+    package.delivered["proposal"] = [{"sha256": "0" * 64, "name": "proposal.pdf", "size": 1}]
+    asyncio.run(package.finish(FakeState()))
+    assert bot.stats["successful"] == 1 and bot.stats["errors"] == 0
+    assert "ДОСТАВКА ЗАВЕРШЕНА" in package.message.sent[-1]
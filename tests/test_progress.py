@@ -0,0 +1,31 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeStatusMessage:
+    chat = SimpleNamespace(id=7)
+    message_id = 1
+
+    def __init__(self):
+        self.edits = []
+
+    async def edit_text(self, text):
+        self.edits.append(text)
+
+
+def test_discard_cancels_pending_edit_and_forgets_message():
+    async def scenario():
+        renderer = bot.ProgressRenderer(min_interval=0.2)
+        message = FakeStatusMessage()
+        renderer.update(message, "1%")
+        await asyncio.sleep(0.05)
+        renderer.update(message, "2%")  # Ждёт min_interval после первой правки
+        renderer.discard(message)
+        await asyncio.sleep(0.3)
+        assert message.edits == ["1%"]
+        for store in (renderer.messages, renderer.pending, renderer.sent, renderer.last_edit, renderer.flushers):
+            assert not store
+
+    asyncio.run(scenario())
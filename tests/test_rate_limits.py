@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import bot
+
+
+def test_bucket_spaces_requests_at_rate():
+    async def scenario():
+        bucket = bot.TokenBucket(rate=20, capacity=2)
+        start = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # Два токена из запаса сразу, ещё два — по 1/20 с
+    assert 0.08 <= asyncio.run(scenario()) < 0.5
+
+
+def test_rate_below_one_still_grants_tokens():
+    async def scenario():
+        bucket = bot.TokenBucket(rate=0.5, capacity=0.5)
+        await asyncio.wait_for(bucket.acquire(), 1)
+        assert bucket.capacity == 1
+
+    asyncio.run(scenario())
+
+
+def test_priority_request_goes_before_waiting_ones():
+    async def scenario():
+        bucket = bot.TokenBucket(rate=20, capacity=1)
+        order = []
+
+        async def take(name, priority=False):
+            await bucket.acquire(priority=priority)
+            order.append(name)
+
+        await bucket.acquire()
+        normal = asyncio.create_task(take("normal"))
+        await asyncio.sleep(0)
+        urgent = asyncio.create_task(take("urgent", priority=True))
+        await asyncio.gather(normal, urgent)
+        return order
+
+    assert asyncio.run(scenario()) == ["urgent", "normal"]
+
+
+def test_idle_bucket_refills_only_up_to_capacity():
+    async def scenario():
+        bucket = bot.TokenBucket(rate=100, capacity=3)
+        await bucket.acquire(3)
+        await asyncio.sleep(0.2)  # Хватило бы на 20 токенов
+        bucket._refill()
+        assert bucket.tokens == 3
+
+    asyncio.run(scenario())
+
+
+def test_waiters_are_served_in_order():
+    async def scenario():
+        bucket = bot.TokenBucket(rate=50, capacity=1)
+        order = []
+
+        async def take(name):
+            await bucket.acquire()
+            order.append(name)
+
+        await asyncio.gather(*[take(name) for name in "abcd"])
+        return order
+
+    assert asyncio.run(scenario()) == list("abcd")
+
+
+def test_outbound_scheduler_forgets_idle_chats_and_expired_blocks():
+    async def scenario():
+        scheduler = bot.TelegramOutboundScheduler(chat_rate=1, group_rate=1, global_rate=100, max_retries=1)
+        for chat_id in range(1, 51):
+            await scheduler._acquire(chat_id, priority=False)
+        now = time.monotonic()
+        scheduler.blocked_until.update({1: now - 1, 2: now + 30})
+        # Корзины 1..49 успевают наполниться; последний чат только что потратил токен
+        scheduler.chat_buckets[50].updated = now
+        for chat_id in range(1, 50):
+            scheduler.chat_buckets[chat_id].updated -= 1
+        scheduler.prune(now)
+        assert list(scheduler.chat_buckets) == [50]
+        assert scheduler.blocked_until == {2: now + 30}
+
+    asyncio.run(scenario())
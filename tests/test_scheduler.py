@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+class FakeMessage:
+    """Ответы бота в чат не нужны: задание только ставится в очередь"""
+
+    chat = SimpleNamespace(id=7)
+
+    async def answer(self, *args, **kwargs):
+        return SimpleNamespace(message_id=1, delete=self.delete)
+
+    async def delete(self):
+        return True
+
+
+@pytest.fixture
+def quota(monkeypatch):
+    monkeypatch.setattr(bot, "USER_DAILY_QUOTA", 3)
+    # Бэкенд создаёт main(); здесь хватит памяти процесса
+    monkeypatch.setattr(bot, "state_backend", bot.MemoryBackend())
+    bot.user_quota.clear()
+    bot.pending_jobs.clear()
+    yield
+    bot.user_quota.clear()
+    bot.pending_jobs.clear()
+
+
+async def never_runs():
+    raise AssertionError("job must not start")
+
+
+def test_cancelled_queued_job_returns_quota(quota):
+    async def scenario():
+        await bot.enqueue_job(7, "presale", never_runs, FakeMessage())
+        second = await bot.enqueue_job(7, "presale", never_runs, FakeMessage())
+        assert bot.quota_left(7) == 1
+        assert await bot.cancel_user_jobs(7, 7, second["job_id"]) == 1
+        assert bot.quota_left(7) == 2
+        # Повторная отмена того же задания квоту больше не возвращает
+        bot.refund_quota(second)
+        assert bot.quota_left(7) == 2
+
+    asyncio.run(scenario())
+
+
+def test_job_without_result_returns_quota(quota):
+    async def scenario():
+        job = await bot.enqueue_job(7, "presale", never_runs, FakeMessage())
+        bot.pending_jobs.remove(job)
+        bot.active_tasks[job["job_id"]] = {"job": job}
+        bot.current_job_id.set(job["job_id"])
+        try:
+            bot.refund_current_job()
+        finally:
+            bot.active_tasks.pop(job["job_id"])
+        assert bot.quota_left(7) == 3
+
+    asyncio.run(scenario())
+
+
+def test_refund_after_midnight_keeps_new_day_quota(quota):
+    bot.user_quota[7] = {"date": "2000-01-01", "jobs": 0}
+    bot.spend_quota(7)
+    bot.refund_quota({"user_id": 7, "quota_date": "2000-01-01"})
+    assert bot.quota_left(7) == 2
+
+
+def queued(user_id, minute, lane=bot.LANE_PRIORITY):
+    return {"user_id": user_id, "kind": "presale", "lane": lane,
+            "enqueued_at": datetime.now() - timedelta(minutes=10) + timedelta(minutes=minute)}
+
+
+def test_fair_order_interleaves_users():
+    heavy = [queued(1, minute) for minute in range(3)]
+    light = queued(2, 5)
+    order = bot.FairScheduler().order(heavy + [light])
+    assert order == [heavy[0], light, heavy[1], heavy[2]]
+
+
+def test_charge_moves_user_behind_others():
+    scheduler = bot.FairScheduler()
+    first, second, other = queued(1, 0), queued(1, 1), queued(2, 2)
+    assert scheduler.select([first, second, other], {}) is first
+    scheduler.charge(first)
+    assert scheduler.select([second, other], {}) is other
+
+
+def test_bulk_lane_waits_until_aged(monkeypatch):
+    bulk, presale = queued(1, 0, lane=bot.LANE_BULK), queued(2, 1)
+    assert bot.FairScheduler().order([bulk, presale]) == [presale, bulk]
+    monkeypatch.setattr(bot, "QUEUE_AGING_SECONDS", 60)
+    assert bot.FairScheduler().order([bulk, presale]) == [bulk, presale]
+
+
+def test_select_skips_users_at_active_limit(monkeypatch):
+    monkeypatch.setattr(bot, "USER_MAX_ACTIVE_JOBS", 1)
+    busy, free = queued(1, 0), queued(2, 1)
+    scheduler = bot.FairScheduler()
+    assert scheduler.select([busy, free], {1: 1}) is free
+    assert scheduler.select([busy], {1: 1}) is None
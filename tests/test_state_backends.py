@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def make_backend(request, tmp_path, monkeypatch):
+    """Фабрика: бэкенды одного типа над общими данными — как у двух реплик"""
+    if request.param == "memory":
+        backend = bot.MemoryBackend()
+        return lambda: backend
+    if request.param == "sqlite":
+        return lambda: bot.SQLiteBackend(str(tmp_path / "state.db"))
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")  # Lua-скрипты claim/release/take
+    import redis.asyncio as redis_asyncio
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis_asyncio, "from_url",
+                        lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs))
+    return lambda: bot.RedisBackend("redis://test")
+
+
+def test_items_returns_only_keys_with_prefix(make_backend):
+    async def scenario():
+        backend = make_backend()
+        await backend.set("queue:1", {"job_id": "a"})
+        await backend.set("queue:2", {"job_id": "b"})
+        await backend.set("inflight:1", {"task_id": "t"})
+        await backend.delete("queue:2")
+        assert await backend.items("queue:") == {"queue:1": {"job_id": "a"}}
+        assert await backend.get("queue:2") is None
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_claim_is_exclusive_until_release_or_expiry(make_backend):
+    async def scenario():
+        first, second = make_backend(), make_backend()
+        assert await first.claim("lease:unit", "a", 10)
+        assert not await second.claim("lease:unit", "b", 10)
+        assert await first.claim("lease:unit", "a", 10)  # Продление своей аренды
+        await second.release("lease:unit", "b")  # Чужую аренду не снять
+        assert not await second.claim("lease:unit", "b", 10)
+        await first.release("lease:unit", "a")
+        assert await second.claim("lease:unit", "b", 0.1)
+        await asyncio.sleep(0.3)
+        assert await first.claim("lease:unit", "a", 10)
+        await first.close()
+        await second.close()
+
+    asyncio.run(scenario())
+
+
+def test_take_gives_value_to_one_competitor(make_backend):
+    async def scenario():
+        backends = [make_backend() for _ in range(3)]
+        await backends[0].set("queue:1", {"job_id": "a"})
+        taken = await asyncio.gather(*[backend.take("queue:1") for backend in backends])
+        assert sorted(taken, key=lambda value: value is None) == [{"job_id": "a"}, None, None]
+        assert await backends[0].items("queue:") == {}
+        for backend in backends:
+            await backend.close()
+
+    asyncio.run(scenario())